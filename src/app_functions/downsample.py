@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+from db_code.tracks import group_starts
+
+'''
+Shape preserving downsampling of animal tracks for the map.
+
+Uses Largest-Triangle-Three-Buckets (LTTB): each track is split into
+max_points - 2 equal sized buckets between its first and last fix, and
+from every bucket the fix that makes the biggest triangle with the fix
+picked from the bucket before and the average of the bucket after is kept.
+Spikes and turns survive, long straight runs collapse to a few points.
+
+The triangle is measured in (longitude, latitude), so it is the shape of
+the path on the map that is kept, not the shape of any one column over time.
+
+All tracks are stepped through together one bucket at a time, so the
+Python loop runs max_points times no matter how many animals there are.
+'''
+
+# used when the dashboard doesn't say
+DEFAULT_MAX_POINTS = 500
+
+
+def lttb_indices(x: np.ndarray,
+                 y: np.ndarray,
+                 starts: np.ndarray,
+                 max_points: int) -> np.ndarray:
+    '''
+    Positions of the points to keep, in order.
+
+    Arguments
+        x, y: coordinates of every point, all tracks one after the other
+        starts: position where each track starts (see db_code.tracks.group_starts)
+        max_points: most points to keep per track, at least 3. Tracks with
+                    this many points or fewer are kept whole.
+    '''
+    if max_points < 3:
+        raise ValueError(f"max_points must be at least 3, got {max_points}")
+    n_total = len(x)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.append(starts[1:], n_total)
+    lengths = ends - starts
+
+    keep = np.zeros(n_total, dtype=bool)
+
+    # short tracks as they are
+    for s, e in zip(starts[lengths <= max_points], ends[lengths <= max_points]):
+        keep[s:e] = True
+
+    long_tracks = lengths > max_points
+    if not long_tracks.any():
+        return np.flatnonzero(keep)
+
+    s = starts[long_tracks]
+    n = lengths[long_tracks]
+    last = s + n - 1
+    keep[s] = True
+    keep[last] = True
+
+    # bucket edges, one row per track: bucket k is edges[:, k] up to edges[:, k + 1]
+    n_buckets = max_points - 2
+    steps = np.arange(n_buckets + 1)
+    edges = s[:, None] + 1 + np.floor(steps[None, :] * ((n - 2) / n_buckets)[:, None]).astype(np.int64)
+    edges[:, -1] = last
+
+    # averages of every bucket from running sums, the one after the last bucket is the last point
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    sizes = edges[:, 1:] - edges[:, :-1]
+    avg_x = np.column_stack(((cx[edges[:, 1:]] - cx[edges[:, :-1]]) / sizes, x[last]))
+    avg_y = np.column_stack(((cy[edges[:, 1:]] - cy[edges[:, :-1]]) / sizes, y[last]))
+
+    picked = s.copy()
+    for k in range(n_buckets):
+        lo = edges[:, k]
+        size = sizes[:, k]
+        offsets = np.cumsum(size) - size
+        # every point in bucket k of every track, track after track
+        idx = np.repeat(lo - offsets, size) + np.arange(size.sum())
+
+        ax = np.repeat(x[picked], size)
+        ay = np.repeat(y[picked], size)
+        bx = np.repeat(avg_x[:, k + 1], size)
+        by = np.repeat(avg_y[:, k + 1], size)
+        # twice the triangle area, the factor doesn't change which is biggest
+        area = np.abs((ax - bx) * (y[idx] - ay) - (ax - x[idx]) * (by - ay))
+        area = np.nan_to_num(area, nan=-1.0)
+
+        # first point with the biggest area in each bucket
+        best = np.repeat(np.maximum.reduceat(area, offsets), size)
+        position = np.where(area == best, np.arange(len(area)), len(area))
+        picked = idx[np.minimum.reduceat(position, offsets)]
+        keep[picked] = True
+
+    return np.flatnonzero(keep)
+
+
+def downsample_tracks(df: pd.DataFrame,
+                      max_points: int = DEFAULT_MAX_POINTS) -> pd.DataFrame:
+    '''
+    At most max_points rows per serialId, picked with LTTB over each track.
+    Only for drawing, the full result is what gets exported.
+
+    Arguments
+        df: query result with serialId, latitude and longitude, and
+            date_epoch (or date) to put each track in time order
+        max_points: most fixes kept per animal
+    '''
+    if df is None or df.empty:
+        return df
+
+    df = df[df['latitude'].notna() & df['longitude'].notna()]
+    time_col = 'date_epoch' if 'date_epoch' in df else 'date'
+
+    # tracks one after the other in time order (the query already sorts this
+    # way, but results from elsewhere might not)
+    serial_codes, _ = pd.factorize(df['serialId'], sort=True)
+    times = df[time_col]
+    if not pd.api.types.is_integer_dtype(times):
+        times = pd.to_datetime(times, utc=True).astype('int64')
+    order = np.lexsort((times, serial_codes))
+    df = df.iloc[order]
+    serial_codes = serial_codes[order]
+
+    x = df['longitude'].to_numpy(dtype=np.float64)
+    y = df['latitude'].to_numpy(dtype=np.float64)
+    keep = lttb_indices(x, y, group_starts(serial_codes), max_points)
+    return df.iloc[keep]
@@ -1,53 +1,157 @@
-def generate_query_and_params(serialIds, species_ids, datemin, datemax, lat_min, lat_max, lon_min, lon_max):
+import json
+import numbers
+from datetime import datetime, timezone
 
-    sql = """
-    SELECT tObservations.*, tAnimal.species_id, tAnimal.first_scraped, tAnimal.last_scraped, tSpecies.species_name
-    FROM tObservations
+from app_functions.geometry import prepared_shape
+
+# the columns the map needs, for the fast columnar fetch (see db_code/columnar.py)
+MAP_COLUMNS = "tObservations.serialId, tObservations.date_epoch, tObservations.latitude, tObservations.longitude, tSpecies.species_name"
+
+# the tObservations columns of the full results (the CSV export), not the
+# internal obs_id
+OBSERVATION_COLUMNS = ("tObservations.serialId, tObservations.date, tObservations.collarId, "
+                       "tObservations.latitude, tObservations.longitude, tObservations.positionId, "
+                       "tObservations.date_epoch")
+
+# default date range, 2000-01-01 and 3000-01-01 UTC as epoch seconds
+DEFAULT_EPOCH_MIN = 946684800
+DEFAULT_EPOCH_MAX = 32503680000
+
+def to_epoch(value):
+    # datetime, pandas Timestamp, ISO string or a number already in epoch seconds
+    # -> int seconds since 1970 UTC. Times without a timezone are taken as UTC,
+    # which is what the data is stored in
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise TypeError(f"expected a date or epoch seconds, got {value!r}")
+    # numbers.Real so NumPy integers and floats (e.g. out of a DataFrame) count too
+    if isinstance(value, numbers.Real):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip())
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+def _polygon_box(polygon, lat_min, lat_max, lon_min, lon_max):
+    # the lat/lon limits cut down to the polygon's bounding box, so sqlite
+    # only reads rows that could be inside it
+    p_lon_min, p_lat_min, p_lon_max, p_lat_max = prepared_shape(polygon).bounds
+    lat_min = p_lat_min if lat_min is None else max(lat_min, p_lat_min)
+    lat_max = p_lat_max if lat_max is None else min(lat_max, p_lat_max)
+    lon_min = p_lon_min if lon_min is None else max(lon_min, p_lon_min)
+    lon_max = p_lon_max if lon_max is None else min(lon_max, p_lon_max)
+    return lat_min, lat_max, lon_min, lon_max
+
+def apply_geofence(df, geofence):
+    # rows of a result from either query below that are inside its polygon
+    # (geofence, the third value they return), sqlite only narrowed them down
+    # to the polygon's bounding box. Returned unchanged when there is no polygon
+    if not geofence or df is None or len(df) == 0 or 'latitude' not in df:
+        return df
+    inside = prepared_shape(geofence).contains(df['longitude'].to_numpy(dtype=float),
+                                              df['latitude'].to_numpy(dtype=float))
+    return df[inside].reset_index(drop=True)
+
+# movement metrics of each fix from tMovement, added to the results on request
+MOVEMENT_COLUMNS = ("tMovement.step_km, tMovement.dt_s, tMovement.speed_kmh, tMovement.bearing_deg, "
+                    "tMovement.turn_deg, tMovement.day_displacement_km")
+
+def generate_query_and_params(serialIds, species_ids, datemin, datemax, lat_min, lat_max, lon_min, lon_max,
+                              columns = 'all', speed_min = None, speed_max = None, movement = False,
+                              polygon = None):
+    # columns = 'all' gives every column (what the CSV export has),
+    # 'map' gives only MAP_COLUMNS
+    # polygon: study area as GeoJSON or WKT text (Polygon / MultiPolygon, see
+    # geometry.py). Its bounding box goes into the query like the lat/lon
+    # limits, sqlite can't test the polygon itself
+    # Returns (sql, params, geofence). geofence is the polygon (None without
+    # one) and the rows the query returns have to go through
+    # apply_geofence(rows, geofence), it is kept out of params so the query
+    # can't be run as if it were the whole answer
+    # speed_min / speed_max: km/h, only fixes reached at a speed in that range
+    # since the animal's fix before (tMovement.speed_kmh)
+    # movement = True adds MOVEMENT_COLUMNS to 'all', they are also added
+    # whenever there is a speed filter. Off by default, the extra join makes
+    # a fetch of every row about 50% slower
+
+    if polygon:
+        lat_min, lat_max, lon_min, lon_max = _polygon_box(polygon, lat_min, lat_max, lon_min, lon_max)
+
+    use_speed = speed_min is not None or speed_max is not None
+    use_movement = movement or use_speed
+    if columns == 'map':
+        select = MAP_COLUMNS
+    else:
+        select = OBSERVATION_COLUMNS + ", tAnimal.species_id, tAnimal.first_scraped, tAnimal.last_scraped, tSpecies.species_name"
+        if use_movement:
+            select += ", " + MOVEMENT_COLUMNS
+
+    # --------------------------
+    # bounding box through the R*Tree
+    # --------------------------
+    # if any lat/lon limit is set, start from the rtObservations spatial index
+    # and join back to the rows. CROSS JOIN makes sqlite keep the R*Tree as the
+    # outer loop, so only rows inside the box are ever visited
+    use_rtree = any(v is not None for v in (lat_min, lat_max, lon_min, lon_max))
+    if use_rtree:
+        source = """rtObservations
+    CROSS JOIN tObservations ON tObservations.obs_id = rtObservations.id"""
+    else:
+        source = "tObservations"
+
+    sql = f"""
+    SELECT {select}
+    FROM {source}
     JOIN tAnimal ON tObservations.serialId = tAnimal.serialId
     JOIN tSpecies ON tAnimal.species_id = tSpecies.species_id
-    WHERE 1=1
     """
+    # by its primary key, one lookup per row. Fixes without metrics (no
+    # position) still come out unless there is a speed filter
+    if use_movement:
+        sql += "    LEFT JOIN tMovement ON tMovement.obs_id = tObservations.obs_id\n"
+    sql += "    WHERE 1=1\n"
 
     params = {}
 
     # --------------------------
     # serialId handling
     # --------------------------
+    # a list of any length goes in as ONE json array parameter and is unpacked
+    # by sqlite's json_each, so the sql text is the same for 2 or 50,000 ids
+    # (no huge strings, no hitting sqlite's limit on the number of parameters)
     if serialIds is not None:
-        if isinstance(serialIds, list) and len(serialIds) > 1:
-            placeholders = []
-            for i, sid in enumerate(serialIds):
-                key = f"serial{i}"
-                params[key] = sid
-                placeholders.append(f":{key}")
-            sql += f" AND tObservations.serialId IN ({', '.join(placeholders)})"
+        if isinstance(serialIds, list):
+            sql += " AND tObservations.serialId IN (SELECT value FROM json_each(:serialIds))"
+            params["serialIds"] = json.dumps(serialIds)
         else:
             sql += " AND tObservations.serialId = :serialId"
-            params["serialId"] = serialIds[0] if isinstance(serialIds, list) else serialIds
+            params["serialId"] = serialIds
 
     # --------------------------
     # species_id handling
     # --------------------------
     if species_ids is not None:
-        if isinstance(species_ids, list) and len(species_ids) > 1:
-            placeholders = []
-            for i, sid in enumerate(species_ids):
-                key = f"sp{i}"
-                params[key] = sid
-                placeholders.append(f":{key}")
-            sql += f" AND tAnimal.species_id IN ({', '.join(placeholders)})"
+        if isinstance(species_ids, list):
+            # CAST so the ids also match older databasefiles where species_id is TEXT
+            sql += " AND tAnimal.species_id IN (SELECT CAST(value AS TEXT) FROM json_each(:species_ids))"
+            params["species_ids"] = json.dumps(species_ids)
         else:
             sql += " AND tAnimal.species_id = :species_id"
-            params["species_id"] = species_ids[0] if isinstance(species_ids, list) else species_ids
+            params["species_id"] = species_ids
 
     # --------------------------
     # date range
     # --------------------------
 
+    # compared as integer epoch seconds, not as text
+    datemin = to_epoch(datemin)
+    datemax = to_epoch(datemax)
     if datemin is None:
-        datemin = "2000-01-01 00:00:00"
+        datemin = DEFAULT_EPOCH_MIN
     if datemax is None:
-        datemax = "3000-01-01 00:00:00"
+        datemax = DEFAULT_EPOCH_MAX
 
     if lat_min is None:
         lat_min = -90
@@ -58,11 +162,17 @@ def generate_query_and_params(serialIds, species_ids, datemin, datemax, lat_min,
     if lon_max is None:
         lon_max = 180
 
-    sql += " AND date >= :datemin AND date <= :datemax"
-    
+    sql += " AND tObservations.date_epoch >= :datemin AND tObservations.date_epoch <= :datemax"
+
     params["datemin"] = datemin
     params["datemax"] = datemax
 
+    if use_rtree:
+        # boxes that overlap the query box, the R*Tree stores 32 bit floats
+        # rounded outwards so the exact check on the real columns still follows
+        sql += " AND rtObservations.max_lat >= :lat_min AND rtObservations.min_lat <= :lat_max"
+        sql += " AND rtObservations.max_lon >= :lon_min AND rtObservations.min_lon <= :lon_max"
+
     sql += " AND latitude >= :lat_min AND latitude <= :lat_max"
     sql += " AND longitude >= :lon_min AND longitude <= :lon_max"
 
@@ -71,5 +181,93 @@ def generate_query_and_params(serialIds, species_ids, datemin, datemax, lat_min,
     params["lon_min"] = lon_min
     params["lon_max"] = lon_max
 
-    return sql, params
+    # --------------------------
+    # speed
+    # --------------------------
+    if speed_min is not None:
+        sql += " AND tMovement.speed_kmh >= :speed_min"
+        params["speed_min"] = speed_min
+    if speed_max is not None:
+        sql += " AND tMovement.speed_kmh <= :speed_max"
+        params["speed_max"] = speed_max
+
+    # each track in time order, the map draws its lines in this order
+    sql += " ORDER BY tObservations.serialId, tObservations.date_epoch"
+
+    return sql, params, polygon or None
+
+
+def generate_summary_query_and_params(serialIds, species_ids, datemin, datemax, lat_min, lat_max, lon_min, lon_max,
+                                      speed_min = None, speed_max = None, polygon = None):
+    # same filters as generate_query_and_params but over tAnimalDaily, one row
+    # per animal per day instead of every fix. The daily centroid comes back as
+    # latitude / longitude and midnight of the day as date_epoch, so the map
+    # can plot it like any other result. With a speed range, only days with
+    # at least one fix reached at a speed in it. With a polygon, days whose
+    # box overlaps the polygon's here and whose centroid is inside it after
+    # apply_geofence. Returns (sql, params, geofence) like generate_query_and_params
+
+    if polygon:
+        lat_min, lat_max, lon_min, lon_max = _polygon_box(polygon, lat_min, lat_max, lon_min, lon_max)
+
+    sql = """
+    SELECT tAnimalDaily.serialId, tAnimalDaily.day_epoch AS date_epoch,
+           tAnimalDaily.lat_mean AS latitude, tAnimalDaily.lon_mean AS longitude,
+           tAnimalDaily.n_fixes, tAnimalDaily.distance_km,
+           tAnimalDaily.first_epoch, tAnimalDaily.last_epoch,
+           tSpecies.species_name
+    FROM tAnimalDaily
+    JOIN tAnimal ON tAnimalDaily.serialId = tAnimal.serialId
+    JOIN tSpecies ON tAnimal.species_id = tSpecies.species_id
+    WHERE 1=1
+    """
+
+    params = {}
+
+    if serialIds is not None:
+        if isinstance(serialIds, list):
+            sql += " AND tAnimalDaily.serialId IN (SELECT value FROM json_each(:serialIds))"
+            params["serialIds"] = json.dumps(serialIds)
+        else:
+            sql += " AND tAnimalDaily.serialId = :serialId"
+            params["serialId"] = serialIds
+
+    if species_ids is not None:
+        if isinstance(species_ids, list):
+            sql += " AND tAnimal.species_id IN (SELECT CAST(value AS TEXT) FROM json_each(:species_ids))"
+            params["species_ids"] = json.dumps(species_ids)
+        else:
+            sql += " AND tAnimal.species_id = :species_id"
+            params["species_id"] = species_ids
+
+    # any day with a fix inside the range
+    datemin = to_epoch(datemin)
+    datemax = to_epoch(datemax)
+    sql += " AND tAnimalDaily.last_epoch >= :datemin AND tAnimalDaily.first_epoch <= :datemax"
+    params["datemin"] = DEFAULT_EPOCH_MIN if datemin is None else datemin
+    params["datemax"] = DEFAULT_EPOCH_MAX if datemax is None else datemax
+
+    # any day whose bounding box overlaps the box
+    sql += " AND tAnimalDaily.lat_max >= :lat_min AND tAnimalDaily.lat_min <= :lat_max"
+    sql += " AND tAnimalDaily.lon_max >= :lon_min AND tAnimalDaily.lon_min <= :lon_max"
+    params["lat_min"] = -90 if lat_min is None else lat_min
+    params["lat_max"] = 90 if lat_max is None else lat_max
+    params["lon_min"] = -180 if lon_min is None else lon_min
+    params["lon_max"] = 180 if lon_max is None else lon_max
+
+    if speed_min is not None or speed_max is not None:
+        sql += """ AND EXISTS (SELECT 1 FROM tMovement
+                               WHERE tMovement.serialId = tAnimalDaily.serialId
+                                 AND tMovement.date_epoch >= tAnimalDaily.day_epoch
+                                 AND tMovement.date_epoch < tAnimalDaily.day_epoch + 86400"""
+        if speed_min is not None:
+            sql += " AND tMovement.speed_kmh >= :speed_min"
+            params["speed_min"] = speed_min
+        if speed_max is not None:
+            sql += " AND tMovement.speed_kmh <= :speed_max"
+            params["speed_max"] = speed_max
+        sql += ")"
+
+    sql += " ORDER BY tAnimalDaily.serialId, tAnimalDaily.day_epoch"
 
+    return sql, params, polygon or None
@@ -0,0 +1,242 @@
+import json
+import re
+from functools import lru_cache
+
+import numpy as np
+
+from db_code.tracks import group_starts
+
+'''
+Polygon helpers for footprints and study areas, in plain (longitude,
+latitude) degrees. Fine at the scale of the Serengeti, nothing here handles
+polygons crossing the antimeridian.
+
+A polygon is a list of rings, each an (n, 2) array of (lon, lat) with the
+first ring the outside and the rest holes. A shape is a list of polygons
+(one for a GeoJSON Polygon, several for a MultiPolygon).
+
+Shapes come from GeoJSON (geojson_shape) or WKT (wkt_shape) text, or either
+through parse_shape. For testing lots of points against the same study area
+again and again use prepared_shape, which keeps the parsed shape with its
+edges sorted into latitude slabs.
+'''
+
+# points x edges handled at once by points_in_shape, keeps memory bounded
+_CHUNK_CELLS = 4_000_000
+
+# most latitude slabs a PreparedShape splits its edges into
+_MAX_SLABS = 1024
+
+
+def geojson_shape(geometry: dict) -> list:
+    '''
+    GeoJSON Polygon or MultiPolygon geometry (the dict, a Feature holding
+    one, or a FeatureCollection of them) -> shape.
+    '''
+    if geometry.get('type') == 'FeatureCollection':
+        # every polygon of every feature, e.g. a park boundary file
+        return [polygon for feature in geometry['features'] for polygon in geojson_shape(feature)]
+    if geometry.get('type') == 'Feature':
+        geometry = geometry['geometry']
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif kind == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise ValueError(f"expected a Polygon or MultiPolygon geometry, got {kind}")
+    return [[np.asarray(ring, dtype=np.float64)[:, :2] for ring in polygon] for polygon in polygons]
+
+
+def wkt_shape(text: str) -> list:
+    '''
+    WKT POLYGON or MULTIPOLYGON text -> shape. Z / M values are dropped.
+    '''
+    match = re.fullmatch(r'\s*(MULTIPOLYGON|POLYGON)\s*(?:ZM|Z|M)?\s*(\(.*\))\s*', text, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        raise ValueError(f"expected WKT POLYGON or MULTIPOLYGON text, got {text[:40]!r}")
+    kind = match.group(1).upper()
+
+    # the parentheses as nested lists, each run of numbers as one point
+    stack = [[]]
+    for token in re.findall(r'\(|\)|[^(),]+', match.group(2)):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) < 2:
+                raise ValueError("unbalanced parentheses in WKT text")
+            done = stack.pop()
+            stack[-1].append(done)
+        elif token.strip():
+            stack[-1].append([float(v) for v in token.split()][:2])
+    if len(stack) != 1 or len(stack[0]) != 1:
+        raise ValueError("unbalanced parentheses in WKT text")
+
+    coordinates = stack[0][0]
+    polygons = [coordinates] if kind == 'POLYGON' else coordinates
+    return [[np.asarray(ring, dtype=np.float64).reshape(-1, 2) for ring in polygon] for polygon in polygons]
+
+
+def parse_shape(geometry) -> list:
+    '''
+    Shape from a GeoJSON dict, or text that is either GeoJSON or WKT.
+    '''
+    if isinstance(geometry, dict):
+        return geojson_shape(geometry)
+    text = geometry.strip()
+    if text.startswith('{'):
+        return geojson_shape(json.loads(text))
+    return wkt_shape(text)
+
+
+def shape_bounds(shape: list) -> tuple:
+    '''
+    (lon_min, lat_min, lon_max, lat_max) of a shape.
+    '''
+    outer = np.concatenate([polygon[0] for polygon in shape])
+    lon_min, lat_min = outer.min(axis=0)
+    lon_max, lat_max = outer.max(axis=0)
+    return float(lon_min), float(lat_min), float(lon_max), float(lat_max)
+
+
+def shape_edges(shape: list) -> tuple:
+    '''
+    Every edge of every ring of a shape as four arrays x0, y0, x1, y1,
+    what points_in_shape tests against.
+    '''
+    starts, ends = [], []
+    for polygon in shape:
+        for ring in polygon:
+            # closed or not, the last point joins back to the first
+            if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+                ring = ring[:-1]
+            starts.append(ring)
+            ends.append(np.roll(ring, -1, axis=0))
+    starts = np.concatenate(starts)
+    ends = np.concatenate(ends)
+    return starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+
+def points_in_shape(lon: np.ndarray,
+                    lat: np.ndarray,
+                    shape=None,
+                    edges: tuple = None) -> np.ndarray:
+    '''
+    True for every point inside the shape, by ray casting: a point is inside
+    if a ray going east from it crosses the shape's edges an odd number of
+    times, so holes and the parts of a MultiPolygon come out right without
+    treating them separately. Points exactly on an edge can go either way.
+
+    Arguments
+        lon, lat: Arrays of point coordinates
+        shape: See the module docstring
+        edges: Or the shape's shape_edges, to skip working them out again
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    if edges is None:
+        edges = shape_edges(shape)
+    x0, y0, x1, y1 = edges
+    inside = np.zeros(len(lon), dtype=bool)
+    if len(lon) == 0 or len(x0) == 0:
+        return inside
+
+    # points along the rows, edges along the columns, a chunk of points at a time
+    step = max(1, _CHUNK_CELLS // len(x0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, len(lon), step):
+            px = lon[start:start + step, None]
+            py = lat[start:start + step, None]
+            # edges the horizontal line through the point crosses (horizontal edges never do)
+            spans = (y0 > py) != (y1 > py)
+            x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            crossings = np.count_nonzero(spans & (px < x_cross), axis=1)
+            inside[start:start + step] = crossings % 2 == 1
+    return inside
+
+
+class PreparedShape:
+    '''
+    A shape ready for testing many points against: its bounding box, and its
+    edges sorted into horizontal slabs so each point is only ray cast
+    against the edges of the slab it is in, not all of them (a park boundary
+    can have thousands).
+    '''
+
+    def __init__(self,
+                 shape: list,
+                 slabs: int = None
+                ):
+        '''
+        Arguments
+            shape: See the module docstring
+            slabs: How many slabs, default one per 8 edges up to _MAX_SLABS
+        '''
+        self.shape = shape
+        self.bounds = shape_bounds(shape)
+        x0, y0, x1, y1 = shape_edges(shape)
+        self.n_edges = len(x0)
+        self.slabs = int(slabs or np.clip(len(x0) // 8, 1, _MAX_SLABS))
+
+        lat_min, lat_max = self.bounds[1], self.bounds[3]
+        self._lat_min = lat_min
+        self._height = (lat_max - lat_min) / self.slabs or 1.0
+
+        # every edge goes in each slab its latitude range touches
+        first = self._slab(np.minimum(y0, y1))
+        last = self._slab(np.maximum(y0, y1))
+        counts = last - first + 1
+        offsets = np.cumsum(counts) - counts
+        slab = np.repeat(first - offsets, counts) + np.arange(counts.sum())
+        edge = np.repeat(np.arange(len(x0)), counts)
+        order = np.argsort(slab, kind='stable')
+        edge = edge[order]
+        # each slab's edges one after the other, slab k is _starts[k]:_starts[k + 1]
+        self._starts = np.searchsorted(slab[order], np.arange(self.slabs + 1))
+        self._edges = (x0[edge], y0[edge], x1[edge], y1[edge])
+        return
+
+    def _slab(self, lat: np.ndarray) -> np.ndarray:
+        return np.clip(np.floor((lat - self._lat_min) / self._height), 0, self.slabs - 1).astype(np.int64)
+
+    def contains(self,
+                 lon: np.ndarray,
+                 lat: np.ndarray) -> np.ndarray:
+        '''
+        True for every point inside the shape, same answer as points_in_shape.
+        '''
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon_min, lat_min, lon_max, lat_max = self.bounds
+        inside = np.zeros(len(lon), dtype=bool)
+        candidates = np.flatnonzero((lon >= lon_min) & (lon <= lon_max) & (lat >= lat_min) & (lat <= lat_max))
+        if len(candidates) == 0:
+            return inside
+
+        # points in the bounding box, grouped by slab
+        slab = self._slab(lat[candidates])
+        order = np.argsort(slab, kind='stable')
+        candidates, slab = candidates[order], slab[order]
+        starts = group_starts(slab)
+        for s, e in zip(starts, np.append(starts[1:], len(candidates))):
+            k = slab[s]
+            edges = tuple(a[self._starts[k]:self._starts[k + 1]] for a in self._edges)
+            points = candidates[s:e]
+            inside[points] = points_in_shape(lon[points], lat[points], edges=edges)
+        return inside
+
+
+@lru_cache(maxsize=32)
+def _prepared_from_text(text: str) -> PreparedShape:
+    return PreparedShape(parse_shape(text))
+
+
+def prepared_shape(geometry) -> PreparedShape:
+    '''
+    PreparedShape of GeoJSON / WKT text or a GeoJSON dict. The last 32 are
+    kept, so asking again for the same study area doesn't parse and sort
+    its edges again.
+    '''
+    if isinstance(geometry, dict):
+        geometry = json.dumps(geometry, sort_keys=True)
+    return _prepared_from_text(geometry.strip())
@@ -0,0 +1,252 @@
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from app_functions.generate_sql_query import to_epoch
+from db_code.interact_db import PATH_TO_DB, read_db_columnar
+from db_code.tracks import great_circle_interpolate
+
+'''
+Where was an animal at a given time? Collars report at irregular intervals,
+so positions at e.g. a SAR overpass are interpolated along the great circle
+between the fixes either side of it.
+
+A TrackIndex holds every animal's fixes in one set of arrays sorted by
+animal and then time, with a sort key combining the two, so any number of
+(animal, time) targets are looked up together with one searchsorted.
+Build it once (TrackIndex.from_db) and ask it as many times as needed.
+
+From the src folder:
+    uv run python -m app_functions.interpolation targets.csv -o positions.csv
+where targets.csv has columns serialId (left empty for every animal) and
+time (ISO, UTC if no timezone).
+'''
+
+# fixes of the animals asked for between start and end, plus each animal's
+# last fix at or before start and first at or after end so every target in
+# between has the fixes either side of it. Each animal is a range search of
+# the (serialId, date_epoch, latitude, longitude) index
+TRACKS_SQL = """
+    WITH edges AS (
+        SELECT a.serialId,
+               coalesce((SELECT max(o.date_epoch) FROM tObservations o
+                         WHERE o.serialId = a.serialId AND o.date_epoch <= :start), :start) AS t0,
+               coalesce((SELECT min(o.date_epoch) FROM tObservations o
+                         WHERE o.serialId = a.serialId AND o.date_epoch >= :end), :end) AS t1
+        FROM tAnimal a
+        WHERE :all_serials OR a.serialId IN (SELECT value FROM json_each(:serialIds))
+    )
+    SELECT o.serialId, o.date_epoch, o.latitude, o.longitude
+    FROM edges e
+    CROSS JOIN tObservations o INDEXED BY idx_tObservations_map_epoch
+    WHERE o.serialId = e.serialId AND o.date_epoch >= e.t0 AND o.date_epoch <= e.t1
+    """
+
+# low bits of the sort key, the rest is the animal
+_TIME_BITS = 32
+
+
+class TrackIndex:
+    '''
+    Every animal's fixes, ready for interpolating positions at any times.
+    '''
+
+    def __init__(self,
+                 serials: np.ndarray,
+                 epochs: np.ndarray,
+                 lat: np.ndarray,
+                 lon: np.ndarray,
+                 labels: np.ndarray = None
+                ):
+        '''
+        Arguments
+            serials: serialId of each fix, or when labels is given its
+                        position in labels (category codes)
+            epochs: int64 seconds since 1970 UTC of each fix
+            lat, lon: position of each fix, no missing values
+            labels: The serialIds serials points into
+            In any order, they are sorted here.
+        '''
+        if labels is None:
+            labels, codes = np.unique(np.asarray(serials), return_inverse=True)
+        else:
+            # renumber so codes follow the sorted labels
+            labels = np.asarray(labels)
+            order = np.argsort(labels, kind='stable')
+            rank = np.empty(len(labels), dtype=np.int64)
+            rank[order] = np.arange(len(labels))
+            labels = labels[order]
+            codes = rank[np.asarray(serials)]
+        codes = np.asarray(codes, dtype=np.int64)
+        epochs = np.asarray(epochs, dtype=np.int64)
+
+        order = np.lexsort((epochs, codes))
+        self.labels = labels.astype(object)
+        self._label_index = pd.Index(self.labels)
+        self.codes = codes[order]
+        self.epochs = epochs[order]
+        self.lat = np.asarray(lat, dtype=np.float64)[order]
+        self.lon = np.asarray(lon, dtype=np.float64)[order]
+
+        # animal in the high bits, seconds since the first fix in the low bits
+        self._base = int(self.epochs.min()) if len(self.epochs) else 0
+        span = int(self.epochs.max()) - self._base if len(self.epochs) else 0
+        if span >= 1 << _TIME_BITS:
+            raise ValueError("fixes span more than 136 years, check the epochs are in seconds")
+        self._keys = (self.codes << _TIME_BITS) | (self.epochs - self._base)
+        return
+
+    def __len__(self) -> int:
+        return len(self.epochs)
+
+    @classmethod
+    def from_db(cls,
+                start,
+                end,
+                serialIds: list = None,
+                path_string = PATH_TO_DB) -> 'TrackIndex':
+        '''
+        Index of the fixes needed to interpolate anywhere between start and
+        end, including the nearest fix of each animal outside them.
+
+        Arguments
+            start, end: datetime, ISO string or epoch seconds
+            serialIds: Animals to load, every animal if None
+            path_string: Database to read
+        '''
+        params = {
+            'start': to_epoch(start),
+            'end': to_epoch(end),
+            'all_serials': serialIds is None,
+            'serialIds': json.dumps(list(serialIds or [])),
+        }
+        fixes = read_db_columnar(TRACKS_SQL, params, dtypes={'date_epoch': 'int64'}, path_string=path_string)
+        if len(fixes) == 0:
+            return cls(np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))
+        return cls(fixes['serialId'], fixes['date_epoch'], fixes['latitude'], fixes['longitude'],
+                   labels=fixes.categories['serialId'])
+
+    def positions(self,
+                  serialIds,
+                  times) -> pd.DataFrame:
+        '''
+        Interpolated position of each animal at each time, in the order given.
+
+        Arguments
+            serialIds: Array of serialIds, one per target
+            times: Array of int64 epoch seconds, one per target
+
+        Returns a DataFrame with one row per target:
+            serialId, date_epoch: the target
+            latitude, longitude: NaN before the animal's first fix, after its
+                                 last one, or for an animal not in the index
+            gap_s: seconds to the animal's nearest fix (NaN if it has none)
+            prev_epoch, next_epoch: the fixes either side (-1 if there is none)
+        '''
+        serialIds = np.asarray(serialIds, dtype=object)
+        times = np.asarray(times, dtype=np.int64)
+        n = len(times)
+
+        lat = np.full(n, np.nan)
+        lon = np.full(n, np.nan)
+        gap = np.full(n, np.nan)
+        prev_epoch = np.full(n, -1, dtype=np.int64)
+        next_epoch = np.full(n, -1, dtype=np.int64)
+        result = {'serialId': serialIds, 'date_epoch': times, 'latitude': lat, 'longitude': lon,
+                  'gap_s': gap, 'prev_epoch': prev_epoch, 'next_epoch': next_epoch}
+        if len(self) == 0 or n == 0:
+            return pd.DataFrame(result)
+
+        # code of each target's animal, -1 when the index doesn't have it
+        codes = self._label_index.get_indexer(serialIds).astype(np.int64)
+
+        # first fix after the target time, the one before it is at or before
+        # the target. Either only counts if it is the same animal's
+        offset = np.clip(times - self._base, -1, (1 << _TIME_BITS) - 1)
+        after = np.searchsorted(self._keys, (codes << _TIME_BITS) + offset, side='right')
+        b = (after - 1).clip(0, len(self) - 1)
+        a = after.clip(0, len(self) - 1)
+        known = codes >= 0
+        has_before = known & (after > 0) & (self.codes[b] == codes)
+        has_after = known & (after < len(self)) & (self.codes[a] == codes)
+        prev_epoch[has_before] = self.epochs[b[has_before]]
+        next_epoch[has_after] = self.epochs[a[has_after]]
+
+        gap[:] = np.fmin(np.where(has_before, times - prev_epoch, np.nan),
+                         np.where(has_after, next_epoch - times, np.nan))
+
+        # exactly on a fix
+        on_fix = has_before & (prev_epoch == times)
+        lat[on_fix] = self.lat[b[on_fix]]
+        lon[on_fix] = self.lon[b[on_fix]]
+        # between two fixes
+        between = has_before & has_after & ~on_fix
+        i, j = b[between], a[between]
+        fraction = (times[between] - self.epochs[i]) / (self.epochs[j] - self.epochs[i])
+        lat[between], lon[between] = great_circle_interpolate(self.lat[i], self.lon[i],
+                                                              self.lat[j], self.lon[j], fraction)
+        return pd.DataFrame(result)
+
+    def positions_all(self, times) -> pd.DataFrame:
+        '''
+        positions for every animal in the index at each time, keeping only
+        the animals with a fix either side of (or exactly at) that time.
+        Rows are ordered by time and then serialId.
+        '''
+        times = np.asarray(times, dtype=np.int64)
+        result = self.positions(np.tile(self.labels, len(times)), np.repeat(times, len(self.labels)))
+        return result[result['latitude'].notna()].reset_index(drop=True)
+
+
+def interpolate_positions(targets,
+                          path_string = PATH_TO_DB) -> pd.DataFrame:
+    '''
+    Interpolated positions for a batch of (serialId, time) targets, loading
+    only the fixes they need. To ask many times over the same period build a
+    TrackIndex once instead.
+
+    Arguments
+        targets: List of (serialId, time) pairs, time as a datetime, ISO
+                    string or epoch seconds. A serialId of None means every
+                    animal that has fixes either side of that time.
+        path_string: Database to read
+
+    Returns the DataFrame from TrackIndex.positions, targets for named
+    animals first in the order given, then the every-animal ones.
+    '''
+    columns = ['serialId', 'date_epoch', 'latitude', 'longitude', 'gap_s', 'prev_epoch', 'next_epoch']
+    if not targets:
+        return pd.DataFrame(columns=columns)
+    serials = [serialId for serialId, _ in targets]
+    times = np.array([to_epoch(time) for _, time in targets], dtype=np.int64)
+    named = np.array([serialId is not None for serialId in serials])
+
+    wanted = None if not named.all() else sorted(set(serials))
+    index = TrackIndex.from_db(int(times.min()), int(times.max()), serialIds=wanted, path_string=path_string)
+
+    parts = [index.positions(np.array(serials, dtype=object)[named], times[named])]
+    if not named.all():
+        parts.append(index.positions_all(np.unique(times[~named])))
+    return pd.concat(parts, ignore_index=True)[columns]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Interpolate animal positions at given times")
+    parser.add_argument('targets', help="CSV with columns serialId (empty for every animal) and time")
+    parser.add_argument('-o', '--output', default='positions.csv', help="CSV file to write")
+    parser.add_argument('--db', default=PATH_TO_DB, help="database file")
+    args = parser.parse_args(argv)
+
+    table = pd.read_csv(args.targets, dtype={'serialId': str, 'time': str})
+    targets = [(None if pd.isna(serialId) else serialId, time)
+               for serialId, time in zip(table['serialId'], table['time'])]
+    positions = interpolate_positions(targets, path_string=args.db)
+    positions.to_csv(args.output, index=False)
+    print(f"{len(targets)} targets, {positions['latitude'].notna().sum()} positions written to {args.output}")
+    return
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from app_functions.generate_sql_query import generate_query_and_params, to_epoch
+from app_functions.geometry import prepared_shape
+from db_code.interact_db import PATH_TO_DB, read_db, read_db_columnar
+from db_code.tracks import EARTH_RADIUS_KM, group_starts, haversine_km
+
+'''
+Finds animals that were close to each other: every pair of fixes from two
+different animals at most distance_km apart and at most window_s apart in
+time.
+
+Instead of comparing every fix with every other one, fixes are hashed into
+grid cells of (time bucket, latitude band, longitude band), each side as
+big as the time / distance limit, so two fixes close enough to count are
+always in the same cell or in neighbouring ones. Each fix is checked
+against the fixes after it in its own cell and against the 13 neighbouring
+cells "after" its cell (the other 13 neighbours check it from their side),
+so every candidate pair is looked at once.
+
+The archive is worked through in time chunks read with the same filters as
+the map query (generate_query_and_params). Chunks overlap by window_s so
+pairs across a boundary aren't missed, and a pair belongs to the chunk
+holding its earlier fix, so memory stays flat however much data there is.
+
+From the src folder:
+    uv run python -m app_functions.proximity --km 1 --minutes 30 -o pairs.csv
+'''
+
+# days of fixes read and searched at a time
+DEFAULT_CHUNK_S = 7 * 86400
+
+# candidate pairs checked at once, keeps memory bounded when animals bunch up
+_MAX_CANDIDATES = 4_000_000
+
+# (time, latitude, longitude) offsets of the neighbouring cells after a cell
+_FORWARD_CELLS = [(dt, dy, dx) for dt in (0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                  if (dt, dy, dx) > (0, 0, 0)]
+
+# the filters of generate_query_and_params that apply here
+_FILTER_NAMES = ('serialIds', 'species_ids', 'datemin', 'datemax', 'lat_min', 'lat_max',
+                 'lon_min', 'lon_max', 'speed_min', 'speed_max', 'polygon')
+
+PAIR_COLUMNS = ['serialId_a', 'serialId_b', 'species_a', 'species_b', 'date_epoch_a', 'date_epoch_b',
+                'latitude_a', 'longitude_a', 'latitude_b', 'longitude_b', 'dt_s', 'distance_km']
+
+SUMMARY_COLUMNS = ['serialId_a', 'serialId_b', 'species_a', 'species_b', 'n_contacts',
+                   'first_epoch', 'last_epoch', 'min_distance_km']
+
+
+def close_pairs(serials: np.ndarray,
+                epochs: np.ndarray,
+                lat: np.ndarray,
+                lon: np.ndarray,
+                distance_km: float,
+                window_s: int) -> tuple:
+    '''
+    Positions (i, j) of every pair of fixes from different animals no more
+    than distance_km (great circle) and window_s apart, each pair once.
+
+    Arguments
+        serials: serial of each fix (labels or category codes)
+        epochs: int64 seconds since 1970 UTC of each fix
+        lat, lon: position of each fix, no missing values
+        In any order.
+    '''
+    if distance_km <= 0 or window_s <= 0:
+        raise ValueError(f"distance_km and window_s must be positive, got {distance_km} and {window_s}")
+    n = len(epochs)
+    if n < 2:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    serials = np.asarray(serials)
+    epochs = np.asarray(epochs, dtype=np.int64)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+
+    # cell sizes in degrees: fixes distance_km apart can't differ by more
+    # than this much latitude, or longitude at the latitude furthest from the equator
+    dlat = np.degrees(distance_km / EARTH_RADIUS_KM)
+    reach = np.sin(distance_km / (2 * EARTH_RADIUS_KM)) / np.cos(np.radians(min(np.abs(lat).max(), 90.0)))
+    dlon = 360.0 if reach >= 1 else np.degrees(2 * np.arcsin(reach))
+
+    t = epochs // int(window_s)
+    y = np.floor(lat / dlat).astype(np.int64)
+    x = np.floor(lon / dlon).astype(np.int64)
+    # room for a band either side so a neighbour's key never wraps into another row
+    t -= t.min()
+    y -= y.min() - 1
+    x -= x.min() - 1
+    ny = int(y.max()) + 2
+    nx = int(x.max()) + 2
+    keys = (t * ny + y) * nx + x
+
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    cell_starts = group_starts(keys)
+    cell_ends = np.append(cell_starts[1:], n)
+    cell_keys = keys[cell_starts]
+    # cell of every fix, and where it sits in the sorted order
+    own_cell = np.repeat(np.arange(len(cell_starts)), cell_ends - cell_starts)
+    position = np.arange(n)
+
+    found_i, found_j = [], []
+    for dt, dy, dx in [(0, 0, 0)] + _FORWARD_CELLS:
+        if (dt, dy, dx) == (0, 0, 0):
+            # the fixes after this one in its own cell
+            probe = position
+            lo = position + 1
+            hi = cell_ends[own_cell]
+        else:
+            wanted = keys + (dt * ny + dy) * nx + dx
+            cell = np.searchsorted(cell_keys, wanted).clip(max=len(cell_keys) - 1)
+            hit = cell_keys[cell] == wanted
+            probe = position[hit]
+            lo = cell_starts[cell[hit]]
+            hi = cell_ends[cell[hit]]
+        sizes = hi - lo
+        keep = sizes > 0
+        probe, lo, sizes = probe[keep], lo[keep], sizes[keep]
+
+        # a slice of probes at a time, each expanded into all its candidates
+        total = np.cumsum(sizes)
+        begin = 0
+        while begin < len(probe):
+            done = total[begin - 1] if begin else 0
+            end = max(int(np.searchsorted(total, done + _MAX_CANDIDATES, side='right')), begin + 1)
+            s = sizes[begin:end]
+            offsets = np.cumsum(s) - s
+            i = order[np.repeat(probe[begin:end], s)]
+            j = order[np.repeat(lo[begin:end] - offsets, s) + np.arange(int(s.sum()))]
+            close = ((serials[i] != serials[j])
+                     & (np.abs(epochs[i] - epochs[j]) <= window_s)
+                     & (haversine_km(lat[i], lon[i], lat[j], lon[j]) <= distance_km))
+            found_i.append(i[close])
+            found_j.append(j[close])
+            begin = end
+
+    if not found_i:
+        # no two fixes even share a cell
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+
+def _time_range(filters: dict,
+                path_string) -> tuple:
+    # first and last fix time to go through, the archive's cut down to the filter's dates
+    df = read_db("SELECT MIN(date_epoch) AS first, MAX(date_epoch) AS last FROM tObservations",
+                 path_string=path_string)
+    first, last = df.iloc[0]['first'], df.iloc[0]['last']
+    if pd.isna(first):
+        return None, None
+    first, last = int(first), int(last)
+    if filters.get('datemin') is not None:
+        first = max(first, to_epoch(filters['datemin']))
+    if filters.get('datemax') is not None:
+        last = min(last, to_epoch(filters['datemax']))
+    return first, last
+
+
+def iter_close_pairs(distance_km: float,
+                     window_s: int,
+                     filters: dict = None,
+                     chunk_s: int = DEFAULT_CHUNK_S,
+                     path_string = PATH_TO_DB):
+    '''
+    Close pairs (see close_pairs) over the whole archive, yielded as one
+    DataFrame of PAIR_COLUMNS per time chunk. In each pair serialId_a is
+    the smaller serialId, dt_s is date_epoch_b - date_epoch_a.
+
+    Arguments
+        distance_km: Furthest apart two fixes can be
+        window_s: Most seconds between two fixes
+        filters: Keyword arguments of generate_query_and_params (serialIds,
+                    species_ids, datemin, datemax, lat_min, ..., polygon),
+                    only fixes matching them are paired
+        chunk_s: Seconds of fixes searched at a time
+        path_string: Database to read
+    '''
+    # everything generate_query_and_params takes, unset ones as None
+    filters = {name: None for name in _FILTER_NAMES} | dict(filters or {})
+    first, last = _time_range(filters, path_string)
+    if first is None:
+        return
+    chunk_s = max(int(chunk_s), 1)
+    box = {name: filters[name] for name in ('lat_min', 'lat_max', 'lon_min', 'lon_max')
+           if filters[name] is not None}
+    area = prepared_shape(filters['polygon']) if filters['polygon'] else None
+    unboxed = {name: None for name in box} | {'polygon': None}
+
+    for start in range(first, last + 1, chunk_s):
+        end = start + chunk_s
+        # pairs whose earlier fix is in [start, end), the later one may be up to window_s past end
+        # the latitude / longitude limits and the polygon are checked here rather than in the
+        # query, with them the query goes through the R*Tree, which reads the whole box for
+        # every chunk
+        sql, params, _ = generate_query_and_params(**{**filters, **unboxed, 'datemin': start,
+                                                   'datemax': min(end - 1 + window_s, last)},
+                                                columns='map')
+        fixes = read_db_columnar(sql, params, dtypes={'date_epoch': 'int64'}, path_string=path_string)
+        if box:
+            inside = np.ones(len(fixes), dtype=bool)
+            for name, limit in box.items():
+                column = fixes['latitude' if name.startswith('lat') else 'longitude']
+                inside &= column >= limit if name.endswith('min') else column <= limit
+            fixes = fixes.take(inside)
+        if area is not None:
+            fixes = fixes.take(area.contains(fixes['longitude'], fixes['latitude']))
+        if len(fixes) < 2:
+            continue
+        serials = fixes['serialId']
+        epochs = fixes['date_epoch']
+        lat = fixes['latitude']
+        lon = fixes['longitude']
+        i, j = close_pairs(serials, epochs, lat, lon, distance_km, window_s)
+        keep = np.minimum(epochs[i], epochs[j]) < end
+        i, j = i[keep], j[keep]
+
+        # smaller serialId first
+        labels = fixes.categories['serialId']
+        rank = np.empty(len(labels), dtype=np.int64)
+        rank[np.argsort(labels, kind='stable')] = np.arange(len(labels))
+        swap = rank[serials[i]] > rank[serials[j]]
+        i, j = np.where(swap, j, i), np.where(swap, i, j)
+
+        species = fixes.labels('species_name')
+        yield pd.DataFrame({
+            'serialId_a': labels[serials[i]],
+            'serialId_b': labels[serials[j]],
+            'species_a': species[i],
+            'species_b': species[j],
+            'date_epoch_a': epochs[i],
+            'date_epoch_b': epochs[j],
+            'latitude_a': lat[i],
+            'longitude_a': lon[i],
+            'latitude_b': lat[j],
+            'longitude_b': lon[j],
+            'dt_s': epochs[j] - epochs[i],
+            'distance_km': haversine_km(lat[i], lon[i], lat[j], lon[j]),
+        }, columns=PAIR_COLUMNS)
+
+
+def find_close_pairs(distance_km: float,
+                     window_s: int,
+                     filters: dict = None,
+                     chunk_s: int = DEFAULT_CHUNK_S,
+                     path_string = PATH_TO_DB) -> pd.DataFrame:
+    '''
+    Every close pair at once, see iter_close_pairs. Ordered by the earlier
+    fix's time.
+    '''
+    parts = list(iter_close_pairs(distance_km, window_s, filters, chunk_s, path_string))
+    if not parts:
+        return pd.DataFrame(columns=PAIR_COLUMNS)
+    pairs = pd.concat(parts, ignore_index=True)
+    earlier = np.minimum(pairs['date_epoch_a'].to_numpy(), pairs['date_epoch_b'].to_numpy())
+    return pairs.iloc[np.argsort(earlier, kind='stable')].reset_index(drop=True)
+
+
+def summarise_pairs(pairs: pd.DataFrame) -> pd.DataFrame:
+    '''
+    One row per pair of animals: how many close fix pairs they had, the
+    first and last time and how close they got. Most contacts first.
+    '''
+    if pairs.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    earlier = np.minimum(pairs['date_epoch_a'], pairs['date_epoch_b'])
+    summary = (pairs.assign(earlier=earlier)
+                    .groupby(['serialId_a', 'serialId_b'], sort=False)
+                    .agg(species_a=('species_a', 'first'),
+                         species_b=('species_b', 'first'),
+                         n_contacts=('distance_km', 'size'),
+                         first_epoch=('earlier', 'min'),
+                         last_epoch=('earlier', 'max'),
+                         min_distance_km=('distance_km', 'min'))
+                    .reset_index())
+    return summary.sort_values(['n_contacts', 'serialId_a', 'serialId_b'],
+                               ascending=[False, True, True], ignore_index=True)[SUMMARY_COLUMNS]
+
+
+def write_close_pairs_csv(file,
+                          distance_km: float,
+                          window_s: int,
+                          filters: dict = None,
+                          chunk_s: int = DEFAULT_CHUNK_S,
+                          path_string = PATH_TO_DB) -> int:
+    '''
+    Write every close pair as CSV to file (a path or an open text file) one
+    chunk at a time, like interact_db.write_csv. Returns the number of pairs.
+    '''
+    n_rows = 0
+    header = True
+    for chunk in iter_close_pairs(distance_km, window_s, filters, chunk_s, path_string):
+        chunk.to_csv(file, header = header, index = False, mode = 'w' if header else 'a')
+        header = False
+        n_rows += len(chunk)
+    if header:
+        # nothing found, still write the header
+        pd.DataFrame(columns=PAIR_COLUMNS).to_csv(file, index = False)
+    return n_rows
+
+
+def iter_close_pairs_csv(distance_km: float,
+                         window_s: int,
+                         filters: dict = None,
+                         chunk_s: int = DEFAULT_CHUNK_S,
+                         path_string = PATH_TO_DB):
+    '''
+    Every close pair as CSV text, yielded one chunk at a time like
+    interact_db.iter_csv. The first piece has the header.
+    '''
+    header = True
+    for chunk in iter_close_pairs(distance_km, window_s, filters, chunk_s, path_string):
+        yield chunk.to_csv(header = header, index = False)
+        header = False
+    if header:
+        yield pd.DataFrame(columns=PAIR_COLUMNS).to_csv(index = False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find pairs of animals close to each other")
+    parser.add_argument('--km', type=float, required=True, help="furthest apart two fixes can be")
+    parser.add_argument('--minutes', type=float, required=True, help="most minutes between two fixes")
+    parser.add_argument('--start', default=None, help="first date (ISO), default the whole archive")
+    parser.add_argument('--end', default=None, help="last date (ISO)")
+    parser.add_argument('--serial', action='append', default=None, help="only this serialId, can be repeated")
+    parser.add_argument('--area', default=None, help="GeoJSON or WKT file of a study area, only fixes inside it")
+    parser.add_argument('-o', '--output', default='close_pairs.csv', help="CSV file to write")
+    parser.add_argument('--summary', default=None, help="also write one row per pair of animals here")
+    parser.add_argument('--db', default=PATH_TO_DB, help="database file")
+    args = parser.parse_args(argv)
+
+    filters = {'serialIds': args.serial, 'datemin': args.start, 'datemax': args.end}
+    if args.area:
+        with open(args.area) as f:
+            filters['polygon'] = f.read()
+    window_s = int(args.minutes * 60)
+    if args.summary:
+        pairs = find_close_pairs(args.km, window_s, filters, path_string=args.db)
+        pairs.to_csv(args.output, index=False)
+        summarise_pairs(pairs).to_csv(args.summary, index=False)
+        n_rows = len(pairs)
+    else:
+        n_rows = write_close_pairs_csv(args.output, args.km, window_s, filters, path_string=args.db)
+    print(f"{n_rows} close pairs written to {args.output}")
+    return
+
+
+if __name__ == '__main__':
+    main()
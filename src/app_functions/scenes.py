@@ -0,0 +1,199 @@
+import argparse
+import json
+
+import numpy as np
+import pandas as pd
+
+from app_functions.generate_sql_query import to_epoch
+from app_functions.geometry import geojson_shape, points_in_shape, shape_bounds, shape_edges
+from db_code.interact_db import PATH_TO_DB, read_db, read_db_columnar
+from db_code.tracks import group_starts
+
+'''
+Matches SAR scenes to the GPS fixes they can be checked against: every fix
+inside a scene's footprint and within its tolerance of the acquisition time.
+
+All scenes are matched together instead of one query each:
+    1. The scenes' time windows are merged where they overlap and sent to
+       sqlite as one json list. One query walks the (date_epoch, latitude,
+       longitude) index over each merged window and its bounding box,
+       reading nothing but the index.
+    2. Those fixes, sorted by time, are cut into each scene's window with
+       searchsorted, checked against the scene's bounding box and then its
+       footprint polygon (geometry.points_in_shape).
+    3. The rest of the columns are read for the matched fixes only.
+
+From the src folder:
+    uv run python -m app_functions.scenes scenes.geojson -o matches.csv
+where scenes.geojson is a FeatureCollection with one Polygon / MultiPolygon
+Feature per scene and properties scene_id (or id), time (ISO, UTC if no
+timezone) and optionally tolerance_minutes.
+'''
+
+# used for scenes that don't give their own
+DEFAULT_TOLERANCE_S = 3600
+
+# one row per merged window: [t0, t1, lat0, lat1, lon0, lon1]. CROSS JOIN keeps
+# the windows as the outer loop so each one is a range search of the index
+WINDOWS_SQL = """
+    SELECT o.obs_id, o.date_epoch, o.latitude, o.longitude
+    FROM (SELECT json_extract(value, '$[0]') AS t0, json_extract(value, '$[1]') AS t1,
+                 json_extract(value, '$[2]') AS lat0, json_extract(value, '$[3]') AS lat1,
+                 json_extract(value, '$[4]') AS lon0, json_extract(value, '$[5]') AS lon1
+          FROM json_each(:windows)) w
+    CROSS JOIN tObservations o INDEXED BY idx_tObservations_time
+    WHERE o.date_epoch >= w.t0 AND o.date_epoch <= w.t1
+      AND o.latitude >= w.lat0 AND o.latitude <= w.lat1
+      AND o.longitude >= w.lon0 AND o.longitude <= w.lon1
+    """
+
+DETAILS_SQL = """
+    SELECT o.obs_id, o.serialId, o.date, o.collarId, o.positionId, tSpecies.species_name
+    FROM json_each(:obs_ids) j
+    CROSS JOIN tObservations o ON o.obs_id = j.value
+    JOIN tAnimal ON o.serialId = tAnimal.serialId
+    JOIN tSpecies ON tAnimal.species_id = tSpecies.species_id
+    """
+
+
+def read_scenes(path: str) -> list:
+    '''
+    Scenes from a GeoJSON FeatureCollection file, as the dicts match_scenes takes.
+    '''
+    with open(path) as f:
+        collection = json.load(f)
+    scenes = []
+    for n, feature in enumerate(collection['features']):
+        properties = feature.get('properties') or {}
+        scene = {
+            'scene_id': properties.get('scene_id', properties.get('id', feature.get('id', n))),
+            'time': properties['time'],
+            'footprint': feature['geometry'],
+        }
+        if properties.get('tolerance_minutes') is not None:
+            scene['tolerance_s'] = float(properties['tolerance_minutes']) * 60
+        scenes.append(scene)
+    return scenes
+
+
+def _merge_windows(start: np.ndarray,
+                   end: np.ndarray,
+                   bounds: np.ndarray) -> list:
+    # overlapping time windows -> one window spanning them, with a bounding
+    # box around all of theirs. Returns rows [t0, t1, lat0, lat1, lon0, lon1]
+    order = np.argsort(start, kind='stable')
+    start, end, bounds = start[order], end[order], bounds[order]
+    reach = np.maximum.accumulate(end)
+    starts = np.flatnonzero(np.concatenate(([True], start[1:] > reach[:-1])))
+    return np.column_stack((
+        start[starts],
+        np.maximum.reduceat(end, starts),
+        np.minimum.reduceat(bounds[:, 1], starts),
+        np.maximum.reduceat(bounds[:, 3], starts),
+        np.minimum.reduceat(bounds[:, 0], starts),
+        np.maximum.reduceat(bounds[:, 2], starts),
+    )).tolist()
+
+
+def match_scenes(scenes: list,
+                 tolerance_s: float = DEFAULT_TOLERANCE_S,
+                 details: bool = True,
+                 path_string = PATH_TO_DB) -> pd.DataFrame:
+    '''
+    Every (scene, fix) pair where the fix is inside the scene's footprint
+    and no more than the tolerance from the scene's acquisition time.
+
+    Arguments
+        scenes: List of dicts with
+                    scene_id: anything, copied to the results
+                    time: acquisition time (datetime, ISO string or epoch seconds)
+                    footprint: GeoJSON Polygon / MultiPolygon geometry, or a
+                               shape (see geometry.py)
+                    tolerance_s: optional, seconds either side of time
+        tolerance_s: For scenes without their own
+        details: Also return serialId, date, collarId, positionId and species_name
+        path_string: Database to match against
+
+    Returns a DataFrame with scene_id, obs_id (of the fix in tObservations),
+    date_epoch, latitude, longitude, dt_s (fix time minus scene time) and
+    the details columns, ordered by scene and then fix time.
+    '''
+    columns = ['scene_id', 'obs_id', 'date_epoch', 'latitude', 'longitude', 'dt_s']
+    if details:
+        columns += ['serialId', 'date', 'collarId', 'positionId', 'species_name']
+    if not scenes:
+        return pd.DataFrame(columns=columns)
+
+    shapes = [geojson_shape(s['footprint']) if isinstance(s['footprint'], dict) else s['footprint']
+              for s in scenes]
+    times = np.array([to_epoch(s['time']) for s in scenes], dtype=np.int64)
+    tolerances = np.array([s.get('tolerance_s', tolerance_s) for s in scenes], dtype=np.float64)
+    start = times - tolerances
+    end = times + tolerances
+    bounds = np.array([shape_bounds(shape) for shape in shapes])  # lon_min, lat_min, lon_max, lat_max
+
+    # 1. one pass over the index for all the windows
+    fixes = read_db_columnar(WINDOWS_SQL, {'windows': json.dumps(_merge_windows(start, end, bounds))},
+                             dtypes={'obs_id': 'int64', 'date_epoch': 'int64',
+                                     'latitude': 'float64', 'longitude': 'float64'},
+                             path_string=path_string)
+    order = np.argsort(fixes['date_epoch'], kind='stable')
+    fix_time = fixes['date_epoch'][order]
+    fix_lat = fixes['latitude'][order]
+    fix_lon = fixes['longitude'][order]
+    fix_id = fixes['obs_id'][order]
+
+    # 2. each scene's slice of that, all scenes one after the other
+    lo = np.searchsorted(fix_time, start, side='left')
+    hi = np.searchsorted(fix_time, end, side='right')
+    sizes = hi - lo
+    offsets = np.cumsum(sizes) - sizes
+    idx = np.repeat(lo - offsets, sizes) + np.arange(sizes.sum())
+    scene = np.repeat(np.arange(len(scenes)), sizes)
+
+    in_box = ((fix_lon[idx] >= bounds[scene, 0]) & (fix_lon[idx] <= bounds[scene, 2])
+              & (fix_lat[idx] >= bounds[scene, 1]) & (fix_lat[idx] <= bounds[scene, 3]))
+    idx, scene = idx[in_box], scene[in_box]
+
+    inside = np.zeros(len(idx), dtype=bool)
+    starts = group_starts(scene)
+    for s, e in zip(starts, np.append(starts[1:], len(idx))):
+        inside[s:e] = points_in_shape(fix_lon[idx[s:e]], fix_lat[idx[s:e]], edges=shape_edges(shapes[scene[s]]))
+    idx, scene = idx[inside], scene[inside]
+
+    scene_ids = [s['scene_id'] for s in scenes]
+    result = pd.DataFrame({
+        'scene_id': [scene_ids[i] for i in scene.tolist()],
+        'obs_id': fix_id[idx],
+        'date_epoch': fix_time[idx],
+        'latitude': fix_lat[idx],
+        'longitude': fix_lon[idx],
+        'dt_s': fix_time[idx] - times[scene],
+    })
+
+    # 3. the other columns, only for fixes that matched
+    if details:
+        extra = read_db(DETAILS_SQL, {'obs_ids': json.dumps(np.unique(result['obs_id']).tolist())},
+                        path_string=path_string)
+        result = result.merge(extra, on='obs_id', how='left', sort=False)
+    return result[columns]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Match SAR scenes to GPS fixes")
+    parser.add_argument('scenes', help="GeoJSON FeatureCollection of scene footprints")
+    parser.add_argument('-o', '--output', default='scene_matches.csv', help="CSV file to write")
+    parser.add_argument('--tolerance-minutes', type=float, default=DEFAULT_TOLERANCE_S / 60,
+                        help="for scenes without their own tolerance_minutes")
+    parser.add_argument('--db', default=PATH_TO_DB, help="database file")
+    args = parser.parse_args(argv)
+
+    scenes = read_scenes(args.scenes)
+    matches = match_scenes(scenes, tolerance_s=args.tolerance_minutes * 60, path_string=args.db)
+    matches.to_csv(args.output, index=False)
+    print(f"{len(scenes)} scenes, {len(matches)} matches written to {args.output}")
+    return
+
+
+if __name__ == '__main__':
+    main()
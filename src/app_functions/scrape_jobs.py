@@ -0,0 +1,260 @@
+import atexit
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+Runs webscrapes in the background so the Dash callback that starts one
+returns straight away, and the dashboard polls for progress instead.
+
+Jobs run on a worker thread in this same process, not in a separate one:
+the scrape spends its time waiting on the network and on Chrome (neither
+holds the GIL) so query callbacks stay responsive, and the ingest at the
+end has to run in the process serving the dashboard so that it empties
+that process's query cache (see db_code/query_cache.py).
+
+Only one scrape runs at a time, asking for another while one is going
+hands back the running one.
+
+Inside a job the scrape is a pipeline (see webscraping.stream_webscrape):
+download, species lookup and ingest run at the same time joined by
+bounded queues, each with a StageMetrics the dashboard can show.
+'''
+
+class ScrapeCancelled(Exception):
+    '''
+    Raised inside a scrape when its job has been cancelled.
+    '''
+    pass
+
+
+class StageMetrics:
+    '''
+    Throughput of one pipeline stage, written by the stage's thread and
+    read by the dashboard.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.status = 'waiting'  # waiting, running, done, failed, cancelled
+        self.items = 0           # batches / serials handled
+        self.rows = 0            # observation rows handled
+        self.busy_seconds = 0.0  # time spent working
+        self.wait_seconds = 0.0  # time spent blocked on a queue
+        self.queue_depth = 0     # items waiting in this stage's output queue
+        self._lock = threading.Lock()
+        return
+
+    def add(self,
+            items: int = 0,
+            rows: int = 0,
+            busy: float = 0.0,
+            wait: float = 0.0) -> None:
+        with self._lock:
+            self.items += items
+            self.rows += rows
+            self.busy_seconds += busy
+            self.wait_seconds += wait
+        return
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'status': self.status,
+                'items': self.items,
+                'rows': self.rows,
+                'busy_seconds': self.busy_seconds,
+                'wait_seconds': self.wait_seconds,
+                'queue_depth': self.queue_depth,
+                'rows_per_second': self.rows / self.busy_seconds if self.busy_seconds else None,
+            }
+
+
+class ScrapeJob:
+    '''
+    State and progress counters of one scrape, updated from the worker
+    thread and read by the dashboard.
+    '''
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.status = 'queued'  # queued, running, done, failed, cancelled
+        self.counts = {
+            'records_downloaded': 0,
+            'records_new': 0,       # downloaded records newer than what the database had
+            'species_cached': 0,    # serials whose species was already in the database
+            'species_fetched': 0,   # serials whose track page has to be visited
+            'serials_total': 0,     # pages to visit
+            'serials_resolved': 0,  # pages visited so far
+            'records_ingested': 0,
+        }
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.result = None
+        self.stages = {}  # stage name -> StageMetrics, filled by the pipeline
+
+        self._resolve_started_at = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+        return
+
+    def update(self, **counts) -> None:
+        '''
+        Set some of the counters, e.g. job.update(serials_resolved=10).
+        Passed to the scrape as its progress function.
+        '''
+        with self._lock:
+            for name, value in counts.items():
+                if name not in self.counts:
+                    raise KeyError(f"unknown progress counter {name}, expected one of {list(self.counts)}")
+                self.counts[name] = value
+            if counts.get('serials_total') and self._resolve_started_at is None:
+                self._resolve_started_at = time.time()
+        return
+
+    def cancel(self) -> None:
+        self._cancel.set()
+        return
+
+    def cancelled(self) -> bool:
+        '''
+        True once cancel has been called, the scrape checks this between serials.
+        '''
+        return self._cancel.is_set()
+
+    def finished(self) -> bool:
+        return self.status in ('done', 'failed', 'cancelled')
+
+    def eta_seconds(self) -> float:
+        '''
+        Estimated seconds left, from how fast serials have been resolved so
+        far (that is nearly all of a scrape). None until there is a rate.
+        '''
+        with self._lock:
+            done = self.counts['serials_resolved']
+            total = self.counts['serials_total']
+            if self.finished():
+                return 0.0
+            if not done or self._resolve_started_at is None:
+                return None
+            rate = done / (time.time() - self._resolve_started_at)
+            return (total - done) / rate
+
+    def snapshot(self) -> dict:
+        '''
+        Everything the dashboard shows, as plain values (it goes through dcc.Store).
+        '''
+        eta = self.eta_seconds()
+        with self._lock:
+            return {
+                'id': self.id,
+                'status': self.status,
+                **self.counts,
+                'elapsed_seconds': (self.finished_at or time.time()) - self.started_at if self.started_at else 0.0,
+                'eta_seconds': eta,
+                'error': self.error,
+                'stages': {name: stage.snapshot() for name, stage in self.stages.items()},
+            }
+
+
+class JobRegistry:
+    '''
+    Keeps track of scrape jobs and runs them on a small thread pool.
+    '''
+
+    def __init__(self,
+                 max_workers: int = 1,
+                 keep: int = 20
+                ):
+        '''
+        Arguments
+            max_workers: Scrapes that may run at once.
+            keep: How many finished jobs to remember for the dashboard.
+        '''
+        self.keep = keep
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scrape')
+        self._jobs = {}  # job id -> ScrapeJob, oldest first
+        self._lock = threading.Lock()
+        return
+
+    def start(self,
+              scrape,
+              ingest) -> str:
+        '''
+        Start a scrape in the background and return its job id. If one is
+        already queued or running its id is returned instead.
+
+        Arguments
+            scrape: Function called as scrape(progress=..., should_stop=...,
+                        ingest=..., stages=...) that loads what it scrapes
+                        by calling ingest (possibly many times) and returns
+                        the summed per-table counts
+            ingest: Function taking a DataFrame and loading it, returns
+                        the per-table counts from CWFACDB._load_data
+        '''
+        with self._lock:
+            for job in self._jobs.values():
+                if not job.finished():
+                    return job.id
+            job = ScrapeJob(uuid.uuid4().hex)
+            self._jobs[job.id] = job
+            # forget the oldest finished jobs
+            finished = [j.id for j in self._jobs.values() if j.finished()]
+            for job_id in finished[:max(len(finished) - self.keep, 0)]:
+                del self._jobs[job_id]
+        self._pool.submit(self._run, job, scrape, ingest)
+        return job.id
+
+    @staticmethod
+    def _run(job: ScrapeJob,
+             scrape,
+             ingest) -> None:
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            # every batch ingest returns is committed, whatever happens later
+            job.result = scrape(progress=job.update, should_stop=job.cancelled,
+                                ingest=ingest, stages=job.stages)
+            job.status = 'done'
+        except ScrapeCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            print("Webscrape error:", e)
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+        return
+
+    def get(self, job_id: str) -> ScrapeJob:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        '''
+        Ask a job to stop. Returns False if there is no such job.
+        '''
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def shutdown(self) -> None:
+        '''
+        Cancel everything and stop the pool, called when the app exits.
+        '''
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job.cancel()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        return
+
+
+# the one registry the dashboard uses
+JOBS = JobRegistry()
+atexit.register(JOBS.shutdown)
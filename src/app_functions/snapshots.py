@@ -0,0 +1,251 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from itertools import compress
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from app_functions.webscraping import add_counts, parse_records, RECORD_COLUMNS
+
+'''
+Archive of every records.json the scraper downloads, so the database can be
+built again from scratch (the website only keeps the last three months, so
+otherwise the databasefile is the only copy of anything older).
+
+Layout under the archive folder:
+    objects/ab/abcdef...gz   gzipped blobs named by the sha256 of their
+                             content, a blob seen twice is stored once
+    index.jsonl              one line per scrape, oldest first:
+                             {"fetched_at", "url", "records", "species",
+                              "etag", "last_modified"}
+                             records / species are blob names, species is
+                             the serialId -> species map the scrape used
+
+Rebuild from the src folder with
+    uv run python -m app_functions.snapshots rebuild <path of new db>
+'''
+
+SNAPSHOT_DIR = os.path.join('db_code', 'snapshots')
+
+
+class SnapshotArchive:
+    '''
+    Content addressed, gzipped store of downloads plus the index of scrapes.
+    '''
+
+    def __init__(self,
+                 root: str = SNAPSHOT_DIR,
+                 compresslevel: int = 6
+                ):
+        '''
+        Arguments
+            root: Folder the archive lives in, made by the first put
+            compresslevel: gzip level for new blobs
+        '''
+        self.root = root
+        self.compresslevel = compresslevel
+        self._index_path = os.path.join(root, 'index.jsonl')
+        self._lock = threading.Lock()
+        return
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.gz')
+
+    def put(self, data: bytes) -> str:
+        '''
+        Store data (if it isn't already) and return its name, the sha256 hex digest.
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written to a temp name first so a crash never leaves half a blob
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, 'wb', compresslevel=self.compresslevel) as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        with gzip.open(self._blob_path(digest), 'rb') as f:
+            return f.read()
+
+    def put_species(self, species: dict) -> str:
+        '''
+        Store a serialId -> species map, same map gives the same name.
+        '''
+        return self.put(json.dumps(species, sort_keys=True).encode())
+
+    def get_species(self, digest: str) -> dict:
+        return json.loads(self.get(digest))
+
+    def record(self,
+               records: str,
+               species: dict,
+               url: str = None,
+               fetched_at: str = None,
+               etag: str = None,
+               last_modified: str = None) -> dict:
+        '''
+        Add a scrape to the index.
+
+        Arguments
+            records: Name of the records.json blob (from put)
+            species: serialId -> species map the scrape used
+            url, etag, last_modified: Where it came from, see webscraping.fetch_records
+            fetched_at: ISO time of the download, now if not given
+        '''
+        entry = {
+            'fetched_at': fetched_at or pd.Timestamp.now(tz='UTC').isoformat(),
+            'url': url,
+            'records': records,
+            'species': self.put_species(species),
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+        with self._lock, open(self._index_path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    def entries(self) -> list:
+        '''
+        Every scrape in the index, oldest first.
+        '''
+        if not os.path.exists(self._index_path):
+            return []
+        with open(self._index_path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def _read_snapshot(root: str,
+                   digest: str) -> pd.DataFrame:
+    # decompress and parse one records.json, run on a worker process
+    return parse_records(SnapshotArchive(root).get(digest))
+
+
+def rebuild(db_path: str,
+            root: str = SNAPSHOT_DIR,
+            workers: int = None,
+            window: int = None) -> dict:
+    '''
+    Build a new database at db_path from every snapshot in the archive, in
+    the order they were scraped, through CWFACDB._load_data. Snapshots are
+    decompressed and parsed on a pool of processes while the ones before
+    them are being loaded. Each row goes in with the first snapshot that
+    had it, first_scraped / last_scraped are the snapshots' fetch times.
+
+    Arguments
+        db_path: Where to make the database, must not exist yet
+        root: Archive folder
+        workers: Processes parsing snapshots, default one per CPU
+        window: Snapshots parsed ahead of the one being loaded, default 2 * workers
+
+    Returns the per-table counts summed over all snapshots.
+    '''
+    # imported here so the scraper side doesn't pull in the database code
+    from db_code.CWFAC_db import CWFACDB
+
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} already exists, rebuild only makes a new database")
+    archive = SnapshotArchive(root)
+    entries = archive.entries()
+    workers = workers or os.cpu_count() or 1
+    window = window or 2 * workers
+
+    db = CWFACDB(path=db_path, create=True, profile='ingest')
+
+    totals = {}
+    seen = {}        # serialId -> dates already loaded, the table's real (serialId, date) key
+    species = {}     # everything known so far, a later real species beats 'unknown'
+    started = time.perf_counter()
+
+    # with one worker there is nothing to overlap, parse right here and skip
+    # sending every frame between processes
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        pending = deque()
+        upcoming = iter(entries)
+
+        # the same download scraped twice only needs parsing and loading once
+        submitted = set()
+
+        def submit_next():
+            entry = next(upcoming, None)
+            if entry is None:
+                return
+            if entry['records'] in submitted:
+                pending.append((entry, None))
+            else:
+                submitted.add(entry['records'])
+                if pool is None:
+                    pending.append((entry, 'here'))
+                else:
+                    pending.append((entry, pool.submit(_read_snapshot, root, entry['records'])))
+
+        for _ in range(window):
+            submit_next()
+
+        n = 0
+        while pending:
+            entry, future = pending.popleft()
+            submit_next()
+            for serialId, name in archive.get_species(entry['species']).items():
+                if name != 'unknown' or serialId not in species:
+                    species[serialId] = name
+
+            if future is None:
+                df = pd.DataFrame(columns=RECORD_COLUMNS)
+            else:
+                df = _read_snapshot(root, entry['records']) if future == 'here' else future.result()
+                keys = list(zip(df['serialId'].tolist(), df['date'].tolist()))
+                new = np.fromiter((date not in seen.get(serialId, ()) for serialId, date in keys),
+                                  dtype=bool, count=len(keys))
+                for serialId, date in compress(keys, new):
+                    seen.setdefault(serialId, set()).add(date)
+                df = df[new]
+
+            df = df.assign(species=df['serialId'].map(species).fillna('unknown'))
+            df.attrs['download_state'] = {'url': entry['url'], 'etag': entry['etag'],
+                                          'last_modified': entry['last_modified']} if entry['url'] else None
+            add_counts(totals, db._load_data(df, now=entry['fetched_at']))
+            n += 1
+            print(f"rebuild: {n}/{len(entries)} snapshots, {time.perf_counter() - started:.1f}s")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot archive of scraped records.json files")
+    parser.add_argument('--archive', default=SNAPSHOT_DIR, help="archive folder")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rebuild_parser = commands.add_parser('rebuild', help="build a new database from every snapshot")
+    rebuild_parser.add_argument('db_path', help="path of the new database, must not exist")
+    rebuild_parser.add_argument('--workers', type=int, default=None, help="parsing processes")
+    commands.add_parser('list', help="show the scrapes in the archive")
+    parser_args = parser.parse_args(argv)
+
+    if parser_args.command == 'rebuild':
+        print(rebuild(parser_args.db_path, root=parser_args.archive, workers=parser_args.workers))
+    elif parser_args.command == 'list':
+        for entry in SnapshotArchive(parser_args.archive).entries():
+            print(entry['fetched_at'], entry['records'][:12], entry['etag'])
+    return
+
+
+if __name__ == '__main__':
+    # through the package so worker processes find the functions by their real module name
+    from app_functions import snapshots
+    snapshots.main()
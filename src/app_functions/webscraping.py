@@ -1,4 +1,7 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
 from bs4 import BeautifulSoup 
 
@@ -8,82 +11,510 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
 
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support.ui import WebDriverWait
 
 import re
+import json
+from operator import itemgetter
+
+from app_functions.scrape_jobs import ScrapeCancelled, StageMetrics
+from db_code.columnar import parse_epoch
+
+# where the data comes from, both can be passed in to do_webscrape instead
+# (e.g. to point it at a local test server)
+# url for json request
+RECORDS_URL = "https://sleepy-poincare-71343e.netlify.app/tracking/records.json"
+# sub page url with info on the species, given a serial id
+TRACK_PAGE_URL = "https://www.serengeti-tracker.org/track/"
+
+# columns of a scraped record, in this order, plus species once it is resolved
+RECORD_COLUMNS = ["latitude", "longitude", "date", "collarId", "serialId", "positionId", "date_epoch"]
+
+# one session for every download, keeps the connection to the host open
+# between scrapes and retries the odd gateway error
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections = 4, pool_maxsize = 8,
+                                      max_retries = Retry(total = 3, backoff_factor = 1,
+                                                          status_forcelist = [502, 503, 504])))
+
+SPECIES_PATTERN = re.compile(r"SPECIES\s+(.+?)\s+LAST TRACKED", re.DOTALL)
+
+def make_chrome_driver():
+    # Setup headless Chrome
+    options = Options()
+    options.add_argument("--headless")
+    return webdriver.Chrome(options=options)
+
+def read_species(driver, url, page_timeout = 15):
+    # open a track page and wait (up to page_timeout seconds) until the JS has
+    # rendered the species into the 'details' element, instead of a fixed sleep
+    driver.get(url)
 
-def do_webscrape() -> pd.DataFrame:
+    def species_shown(d):
+        # Find the element containing species
+        elements = d.find_elements(By.CLASS_NAME, "details")
+        if not elements:
+            return False
+        match = SPECIES_PATTERN.search(elements[0].text)
+        return match.group(1).strip() if match else False
 
-    # 1. Get the JSON data from the URL
-    # and other constants
+    return WebDriverWait(driver, page_timeout).until(species_shown)
 
-    # url for json request
-    url = "https://sleepy-poincare-71343e.netlify.app/tracking/records.json"
-    response = requests.get(url)
-    data = response.json()
+def iter_species(serialIds,
+                 track_page_url = TRACK_PAGE_URL,
+                 workers = 4,
+                 page_timeout = 15,
+                 retries = 2,
+                 backoff = 2.0,
+                 progress = None,
+                 should_stop = None,
+                 make_driver = make_chrome_driver):
+    # look up the species of every serialId on its track page, with a pool of
+    # workers that each drive their own browser. Yields (serialId, species)
+    # as each page finishes, so in whatever order they finish.
+    #   workers: how many pages are loaded at once
+    #   page_timeout: seconds to wait for a page's species to show up
+    #   retries / backoff: a failed page is tried again up to retries more times,
+    #       waiting backoff, 2*backoff, 4*backoff... seconds in between
+    #   make_driver: function with no arguments returning a new webdriver
+    # Pages that never worked give species 'unknown'. Once should_stop returns
+    # True nothing more is yielded.
+    if progress is None:
+        progress = lambda **counts: None
+    if should_stop is None:
+        should_stop = lambda: False
 
-    # sub page url with info on the species, given a serial id
-    sub_page_url = "https://www.serengeti-tracker.org/track/"
+    local = threading.local()  # one driver per worker thread
+    drivers = []
+    lock = threading.Lock()
+    resolved = [0]
 
-    # adjust, potentially increase if page with species isn't loading
-    time_to_wait = 5
+    def get_driver():
+        if getattr(local, 'driver', None) is None:
+            local.driver = make_driver()
+            with lock:
+                drivers.append(local.driver)
+        return local.driver
 
-    # 2. Flatten the nested structure and convert to pandas DataFrame
-    records = []
-    for item in data:
-        record = {
-            "latitude": item["la"],
-            "longitude": item["ln"],
-            "date": item["d"]["date"],
-            "collarId": item["d"]["collarId"],
-            "serialId": item["d"]["serialId"],
-            "positionId": item["d"]["positionId"]
-        }
-        records.append(record)
+    def resolve_one(serialId):
+        if should_stop():
+            return None
+        url = f"{track_page_url}{serialId}"  # page with species
+        species = "unknown"
+        for attempt in range(retries + 1):
+            try:
+                species = read_species(get_driver(), url, page_timeout)
+                print(f"species of Serial ID {serialId} is {species}")
+                break
+            except (TimeoutException, WebDriverException) as e:
+                if attempt == retries:
+                    print(f"SOMETHING WENT WRONG WITH Serial ID {serialId}, setting species name as 'unknown' ({type(e).__name__})")
+                    break
+                if should_stop():
+                    return None
+                time.sleep(backoff * 2 ** attempt)
+                # a driver that errored may be in a bad state, start a fresh one
+                if isinstance(e, WebDriverException) and not isinstance(e, TimeoutException):
+                    try:
+                        local.driver.quit()
+                    except Exception:
+                        pass
+                    local.driver = None
+        with lock:
+            resolved[0] += 1
+            progress(serials_resolved = resolved[0])
+        return species
 
-    df = pd.DataFrame(records)
+    pool = ThreadPoolExecutor(max_workers = workers, thread_name_prefix = 'species')
+    try:
+        futures = {pool.submit(resolve_one, serialId): serialId for serialId in serialIds}
+        for future in as_completed(futures):
+            species = future.result()
+            if species is None or should_stop():
+                continue
+            yield futures[future], species
+    finally:
+        # also runs if the caller stops early, pages not started yet are dropped
+        pool.shutdown(wait = True, cancel_futures = True)
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+def resolve_species(serialIds,
+                    track_page_url = TRACK_PAGE_URL,
+                    workers = 4,
+                    page_timeout = 15,
+                    retries = 2,
+                    backoff = 2.0,
+                    progress = None,
+                    should_stop = None,
+                    make_driver = make_chrome_driver) -> pd.DataFrame:
+    # all of iter_species at once, as a DataFrame with columns serialId and
+    # species in the order of serialIds
+    species = dict(iter_species(serialIds, track_page_url, workers = workers, page_timeout = page_timeout,
+                                retries = retries, backoff = backoff, progress = progress,
+                                should_stop = should_stop, make_driver = make_driver))
+
+    if should_stop is not None and should_stop():
+        raise ScrapeCancelled()
+
+    return pd.DataFrame({'serialId': list(serialIds), 'species': [species[s] for s in serialIds]},
+                        columns = ['serialId', 'species'])
+
+def fetch_records(url = RECORDS_URL,
+                  state = None,
+                  session = SESSION,
+                  timeout = 60):
+    # conditional download of records.json
+    #   state: {'etag': ..., 'last_modified': ...} from the last download that
+    #       was loaded (see interact_db.download_state), or None
+    # Returns (content, new_state). content is None when the server says
+    # nothing changed since state (304), otherwise the raw bytes
+    headers = {}
+    if state:
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+
+    response = session.get(url, headers = headers, timeout = timeout)
+    if response.status_code == 304:
+        return None, state
+    response.raise_for_status()
+
+    new_state = {'url': url,
+                 'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified')}
+    return response.content, new_state
+
+def parse_records(content) -> pd.DataFrame:
+    # records.json -> DataFrame with RECORD_COLUMNS. Pulls each field out of
+    # all the records at once instead of building a dict per record, floats as
+    # float64 and date_epoch as int64 seconds (see db_code/columnar.py)
+    data = json.loads(content)
+    details = list(map(itemgetter("d"), data))
+    df = pd.DataFrame({
+        "latitude": np.array(list(map(itemgetter("la"), data)), dtype = np.float64),
+        "longitude": np.array(list(map(itemgetter("ln"), data)), dtype = np.float64),
+        "date": list(map(itemgetter("date"), details)),
+        "collarId": list(map(itemgetter("collarId"), details)),
+        "serialId": list(map(itemgetter("serialId"), details)),
+        "positionId": list(map(itemgetter("positionId"), details)),
+    }, columns = RECORD_COLUMNS[:-1])
+    df["date_epoch"] = parse_epoch(df["date"].tolist())
+    return df
+
+def keep_new(df, high_water_marks) -> pd.DataFrame:
+    # only the fixes newer than the latest one already in tObservations for
+    # their serial (high_water_marks: serialId -> max date_epoch, see
+    # interact_db.high_water_marks). New serials are kept whole
+    if not high_water_marks or df.empty:
+        return df
+    latest = df["serialId"].map(high_water_marks)
+    return df[latest.isna() | (df["date_epoch"] > latest)].reset_index(drop = True)
+
+def download_new(records_url = RECORDS_URL,
+                 download_state = None,
+                 high_water_marks = None,
+                 archive = None):
+    # steps 1 and 2 of a scrape: conditional download, parse, drop fixes
+    # already in the database.
+    # archive: optional snapshots.SnapshotArchive, the download is stored in
+    #   it and its name put in df.attrs['snapshot']
+    # Every serialId in the download, new fixes or not, goes in df.attrs['serialIds']
+    # Returns (df, downloaded, new_state), df is None if nothing changed
+    fetched_at = pd.Timestamp.now(tz = 'UTC').isoformat()
+    content, new_state = fetch_records(records_url, download_state)
+    if content is None:
+        print("records.json unchanged since the last scrape, nothing to do")
+        return None, 0, download_state
+
+    # Typed columns straight from the JSON, then drop fixes already in the database
+    df = parse_records(content)
+    downloaded = len(df)
+    serialIds = df['serialId'].unique().tolist()
+    df = keep_new(df, high_water_marks)
+    df.attrs['serialIds'] = serialIds
+    print(f"{downloaded} records downloaded, {len(df)} newer than what is in the database")
+    df.attrs['fetched_at'] = fetched_at
+    if archive is not None:
+        df.attrs['snapshot'] = archive.put(content)
 
     # Optional: preview the DataFrame
     print(df) # this has all the data we need except the species
+    return df, downloaded, new_state
 
-    # 3. Setup loop, based on serial IDs scraped, to open subpages and get the species based on html of the page
-    # Setup headless Chrome
-    options = Options()
-    options.add_argument("--headless")
-    driver = webdriver.Chrome(options=options)
+def split_known(serialIds, known_species):
+    # (serials whose species is already known, serials whose page has to be visited)
+    if known_species is None:
+        known_species = {}
+    cached = [s for s in serialIds if known_species.get(s, 'unknown') != 'unknown']
+    to_fetch = [s for s in serialIds if known_species.get(s, 'unknown') == 'unknown']
+    print(f"species: {len(cached)} already known, {len(to_fetch)} to look up")
+    return cached, to_fetch
 
-    species_df = pd.DataFrame(columns = ['serialId', 'species'])
+def do_webscrape(progress = None,
+                 should_stop = None,
+                 records_url = RECORDS_URL,
+                 track_page_url = TRACK_PAGE_URL,
+                 workers = 4,
+                 make_driver = make_chrome_driver,
+                 known_species = None,
+                 download_state = None,
+                 high_water_marks = None) -> pd.DataFrame:
+    # The whole scrape in one go, returns everything as one DataFrame ready
+    # for CWFACDB._load_data. The dashboard uses stream_webscrape instead.
+    # progress: optional function called with counters as keyword arguments
+    #   (records_downloaded, serials_total, serials_resolved), see ScrapeJob.update
+    # should_stop: optional function, when it returns True the scrape stops
+    #   by raising ScrapeCancelled
+    # records_url / track_page_url: where to scrape from
+    # workers / make_driver: browsers resolving species at once and how to
+    #   start one, see iter_species
+    # known_species: optional dict serialId -> species already known (from
+    #   tAnimal, see interact_db.known_species). Only serials not in it have
+    #   their track page visited
+    # download_state: validators of the last download that was loaded, see
+    #   fetch_records. The new ones go in the returned DataFrame's
+    #   attrs['download_state'], CWFACDB._load_data saves them with the data
+    # high_water_marks: see keep_new
+    if progress is None:
+        progress = lambda **counts: None
+    if should_stop is None:
+        should_stop = lambda: False
 
-    for serialId in df['serialId'].unique():
+    # 1. and 2. Get the JSON data from the URL, unless it hasn't changed since the last scrape
+    df, downloaded, new_state = download_new(records_url, download_state, high_water_marks)
+    if df is None:
+        progress(records_downloaded = 0)
+        return pd.DataFrame(columns = RECORD_COLUMNS + ["species"])
 
-        url = f"{sub_page_url}{serialId}"  # page with species
-        try:
-            driver.get(url)
-
-            # Wait for the species element to load
-       
-            time.sleep(time_to_wait)  # wait for JS to render content
-
-            # Find the element containing species
-            species_element = driver.find_element(By.CLASS_NAME, "details")
-            # print(species_element.text)  # should print 'zebra'
-            species = re.search(r"SPECIES\s+(.+?)\s+LAST TRACKED", species_element.text, re.DOTALL).group(1).strip()
-            print(f"species of Serial ID {serialId} is {species}")
-        except:
-            print(f"SOMETHING WENT WRONG WITH Serial ID {serialId}, setting species name as 'unknown'")
-            species = "unknown"
-
-        new_row_df = pd.DataFrame([{'serialId': serialId, 'species': species}])
-        species_df = pd.concat([species_df, new_row_df], ignore_index = True)
-            
-    driver.quit()
-
-    # 4. Merge the species to the rest of the data, should now be in the form that is accepted by load_data
+    # 3. Species already known don't need their page loaded again
+    cached, to_fetch = split_known(df['serialId'].unique(), known_species)
+    progress(records_downloaded = downloaded, records_new = len(df), serials_total = len(to_fetch),
+             species_cached = len(cached), species_fetched = len(to_fetch))
+
+    # 4. Open the subpage of every other serial ID, several at once, and get the species from the html of the page
+    fetched_df = resolve_species(to_fetch, track_page_url, workers = workers,
+                                 progress = progress, should_stop = should_stop,
+                                 make_driver = make_driver)
+    cached_df = pd.DataFrame({'serialId': cached, 'species': [known_species[s] for s in cached]},
+                             columns = ['serialId', 'species'])
+    species_df = pd.concat([cached_df, fetched_df], ignore_index = True)
+
+    # 5. Merge the species to the rest of the data, should now be in the form that is accepted by load_data
     merged_df = pd.merge(left = df, right = species_df, left_on = 'serialId', right_on = 'serialId')
 
     print(merged_df)
 
+    merged_df.attrs['download_state'] = new_state
     return merged_df
 
+def add_counts(totals, counts):
+    # sum per-table counts from CWFACDB._load_data into totals
+    for table, table_counts in counts.items():
+        into = totals.setdefault(table, {})
+        for key, value in table_counts.items():
+            into[key] = into.get(key, 0) + value
+    return totals
+
+def stream_webscrape(ingest,
+                     progress = None,
+                     should_stop = None,
+                     stages = None,
+                     records_url = RECORDS_URL,
+                     track_page_url = TRACK_PAGE_URL,
+                     workers = 4,
+                     make_driver = make_chrome_driver,
+                     known_species = None,
+                     download_state = None,
+                     high_water_marks = None,
+                     batch_rows = 20000,
+                     queue_size = 8,
+                     archive = None,
+                     save_state = None,
+                     mark_scraped = None) -> dict:
+    # The same scrape as do_webscrape, but as a pipeline that loads data as
+    # soon as its species is known instead of all at the end:
+    #   download: fetch and parse records.json (once, the rest needs it all)
+    #   resolve: known species straight away, then each looked up serial as
+    #       its page finishes, onto a queue of at most queue_size items
+    #   ingest: takes whatever is on the queue (up to about batch_rows rows)
+    #       and calls ingest on it, one committed transaction per batch
+    # All of one serial's new fixes always go in the same batch, so if the
+    # scrape fails or is cancelled partway, what was ingested stays and the
+    # high water marks skip it next time. The download only counts as loaded
+    # (tDownloadState) once every batch is in.
+    # ingest: function taking a DataFrame, returns per-table counts (add_new)
+    # stages: optional dict, filled with a StageMetrics per stage
+    # archive: optional snapshots.SnapshotArchive, the download and the
+    #   species used are recorded in it, even if the scrape doesn't finish
+    # save_state: optional function (url, state) saving the download's validators
+    #   once every batch is in (interact_db.save_download_state), without it the
+    #   next scrape downloads records.json again whatever happens
+    # mark_scraped: optional function (url, serialIds) called once the scrape
+    #   has finished (interact_db.mark_scraped), with every serial in the
+    #   download even if it had nothing new, or none if records.json hadn't changed
+    # other arguments as do_webscrape
+    # Returns the per-table counts summed over every batch
+    if progress is None:
+        progress = lambda **counts: None
+    if should_stop is None:
+        should_stop = lambda: False
+    if stages is None:
+        stages = {}
+    for name in ('download', 'resolve', 'ingest'):
+        stages[name] = StageMetrics(name)
+    totals = {}
+
+    # the ingest side failing stops the resolve side too
+    failed = threading.Event()
+    def stopping():
+        return should_stop() or failed.is_set()
+
+    # ---- download ----
+    stage = stages['download']
+    stage.status = 'running'
+    t = time.perf_counter()
+    df, downloaded, new_state = download_new(records_url, download_state, high_water_marks, archive)
+    if df is None:
+        if mark_scraped is not None:
+            mark_scraped(records_url, [])
+        stage.status = 'done'
+        progress(records_downloaded = 0)
+        return totals
+    stage.add(items = 1, rows = len(df), busy = time.perf_counter() - t)
+    stage.status = 'done'
+
+    rows_of = df.groupby('serialId', sort = False).indices  # serialId -> row positions
+    cached, to_fetch = split_known(list(rows_of), known_species)
+    progress(records_downloaded = downloaded, records_new = len(df), serials_total = len(to_fetch),
+             species_cached = len(cached), species_fetched = len(to_fetch))
+
+    # ---- resolve, on its own thread ----
+    resolved = queue.Queue(maxsize = queue_size)  # lists of (serialId, species)
+    finished = object()  # put last, whatever happened
+    errors = []
+
+    def put(item):
+        # waits while the queue is full, gives up if the ingest side failed
+        t = time.perf_counter()
+        while not failed.is_set():
+            try:
+                resolved.put(item, timeout = 0.5)
+                break
+            except queue.Full:
+                pass
+        stages['resolve'].add(wait = time.perf_counter() - t)
+        stages['resolve'].queue_depth = resolved.qsize()
+
+    def resolve_stage():
+        stage = stages['resolve']
+        stage.status = 'running'
+        try:
+            # known species go through straight away, about batch_rows rows at a time
+            chunk, rows = [], 0
+            for serialId in cached:
+                chunk.append((serialId, known_species[serialId]))
+                rows += len(rows_of[serialId])
+                if rows >= batch_rows:
+                    stage.add(items = len(chunk), rows = rows)
+                    put(chunk)
+                    chunk, rows = [], 0
+            if chunk:
+                stage.add(items = len(chunk), rows = rows)
+                put(chunk)
+
+            t = time.perf_counter()
+            for serialId, species in iter_species(to_fetch, track_page_url, workers = workers,
+                                                  progress = progress, should_stop = stopping,
+                                                  make_driver = make_driver):
+                stage.add(items = 1, rows = len(rows_of[serialId]), busy = time.perf_counter() - t)
+                put([(serialId, species)])
+                t = time.perf_counter()
+            stage.status = 'done'
+        except BaseException as e:
+            errors.append(e)
+            stage.status = 'failed'
+        finally:
+            put(finished)
+
+    resolver = threading.Thread(target = resolve_stage, name = 'scrape-resolve', daemon = True)
+    resolver.start()
+
+    # ---- ingest, on this thread ----
+    stage = stages['ingest']
+    stage.status = 'running'
+    species_used = {}  # serialId -> species of everything ingested, for the archive
+    try:
+        done = False
+        while not done and not should_stop():
+            t = time.perf_counter()
+            item = resolved.get()
+            stage.add(wait = time.perf_counter() - t)
+
+            # take everything already waiting, up to about batch_rows rows
+            batch, rows = [], 0
+            while True:
+                if item is finished:
+                    done = True
+                    break
+                batch.extend(item)
+                rows += sum(len(rows_of[serialId]) for serialId, _ in item)
+                if rows >= batch_rows:
+                    break
+                try:
+                    item = resolved.get_nowait()
+                except queue.Empty:
+                    break
+            stages['resolve'].queue_depth = resolved.qsize()
+            if not batch or should_stop():
+                continue
+
+            t = time.perf_counter()
+            positions = np.sort(np.concatenate([rows_of[serialId] for serialId, _ in batch]))
+            part = df.iloc[positions]
+            part = part.assign(species = part['serialId'].map(dict(batch)))
+            add_counts(totals, ingest(part))
+            species_used.update(batch)
+            stage.add(items = 1, rows = len(part), busy = time.perf_counter() - t)
+            progress(records_ingested = totals.get('tObservations', {}).get('inserted', 0))
+
+        if should_stop():
+            failed.set()  # lets the resolve side give up on a full queue
+        resolver.join()
+        if errors:
+            raise errors[0]
+        if should_stop():
+            raise ScrapeCancelled()
+
+        # every batch is in, now the download counts as loaded
+        if save_state is not None:
+            save_state(records_url, new_state)
+        if mark_scraped is not None:
+            mark_scraped(records_url, df.attrs['serialIds'])
+        stage.status = 'done'
+    except BaseException:
+        failed.set()
+        stage.status = 'cancelled' if should_stop() else 'failed'
+        resolver.join()
+        raise
+    finally:
+        if archive is not None:
+            archive.record(df.attrs['snapshot'], species_used, url = records_url,
+                           fetched_at = df.attrs['fetched_at'], etag = new_state.get('etag'),
+                           last_modified = new_state.get('last_modified'))
+
+    print(totals)
+    return totals
+
 # ### TESTING THIS, coment out later
 # if __name__ == '__main__':
 #     do_webscrape()
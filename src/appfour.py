@@ -6,6 +6,7 @@ import plotly.graph_objects as go
 # to make the plotly graph quick - vis on the right work
 
 import pandas as pd
+import numpy as np
 # basic
 
 import datetime
@@ -15,6 +16,15 @@ from datetime import datetime as dt, timezone, timedelta
 import webbrowser
 # app will open in the default web browser
 
+import base64
+# uploaded polygon files come in base64
+
+import threading
+import uuid
+from collections import OrderedDict
+from flask import Response, abort, stream_with_context
+# CSV exports are streamed straight from the Flask server behind Dash
+
 from threading import Timer
 # these above two just used to make app start automatically
 
@@ -24,10 +34,12 @@ from threading import Timer
 # Keeping these in for any future development in case something breaks and I need to fall back on them
 
 try:
-    from app_functions.generate_sql_query import generate_query_and_params
+    from app_functions.generate_sql_query import generate_query_and_params, generate_summary_query_and_params, apply_geofence
     print("generate_query_and_params successfully imported")
 except Exception as e:
     generate_query_and_params = None
+    generate_summary_query_and_params = None
+    apply_geofence = None
     _IMPORT_GENERATE_QUERY_ERROR = str(e)
 
 try:
@@ -38,7 +50,7 @@ except Exception as e:
     _IMPORT_READ_DB_ERROR = str(e)
 
 try:
-    from app_functions.webscraping import do_webscrape
+    from app_functions.webscraping import do_webscrape, stream_webscrape, RECORDS_URL
     print("do_webscrape successfully imported")
 except Exception as e:
     do_webscrape = None
@@ -51,6 +63,65 @@ except Exception as e:
     add_new = None
     _IMPORT_ADD_NEW_ERROR = str(e)
 
+try:
+    from db_code.interact_db import (known_species, download_state, high_water_marks, save_download_state,
+                                     mark_scraped, last_scraped)
+    print("known_species successfully imported")
+except Exception as e:
+    known_species = None
+    save_download_state = None
+    mark_scraped = None
+    last_scraped = None
+    _IMPORT_KNOWN_SPECIES_ERROR = str(e)
+
+try:
+    from app_functions.snapshots import SnapshotArchive
+    # every download is kept here so the database can be rebuilt (see app_functions/snapshots.py)
+    ARCHIVE = SnapshotArchive()
+    print("SnapshotArchive successfully imported")
+except Exception as e:
+    ARCHIVE = None
+    _IMPORT_SNAPSHOTS_ERROR = str(e)
+
+try:
+    from db_code.interact_db import iter_csv
+    print("iter_csv successfully imported")
+except Exception as e:
+    iter_csv = None
+    _IMPORT_WRITE_CSV_ERROR = str(e)
+
+try:
+    from db_code.interact_db import store_result, resolve_result
+    print("store_result successfully imported")
+except Exception as e:
+    store_result = None
+    resolve_result = None
+    _IMPORT_STORE_RESULT_ERROR = str(e)
+
+try:
+    from app_functions.scrape_jobs import JOBS
+    print("scrape JOBS successfully imported")
+except Exception as e:
+    JOBS = None
+    _IMPORT_SCRAPE_JOBS_ERROR = str(e)
+
+try:
+    from app_functions.downsample import downsample_tracks, DEFAULT_MAX_POINTS
+    print("downsample_tracks successfully imported")
+except Exception as e:
+    downsample_tracks = None
+    DEFAULT_MAX_POINTS = 500
+    _IMPORT_DOWNSAMPLE_ERROR = str(e)
+
+try:
+    from app_functions.proximity import find_close_pairs, summarise_pairs, iter_close_pairs_csv
+    print("find_close_pairs successfully imported")
+except Exception as e:
+    find_close_pairs = None
+    summarise_pairs = None
+    iter_close_pairs_csv = None
+    _IMPORT_PROXIMITY_ERROR = str(e)
+
 # -------------------------
 # Helper helpers & fallback demo data
 # -------------------------
@@ -103,7 +174,17 @@ def build_sql_and_params_from_selections(species_wanted,
                                          lat_min,
                                          lat_max,
                                          lon_min,
-                                         lon_max):
+                                         lon_max,
+                                         resolution='full',
+                                         speed_min=None,
+                                         speed_max=None,
+                                         movement=False,
+                                         polygon=None):
+    # resolution 'daily' queries the per animal per day summary (tAnimalDaily)
+    # instead of every fix, the fallback below ignores it
+    # speed_min / speed_max (km/h) filter on tMovement and movement adds its
+    # columns to the results (not to the daily overview), the fallback ignores them too
+    # polygon is the study area as GeoJSON or WKT text, the fallback ignores it as well
     
     # THIS WHOLE IF IS A FALLBACK
     if generate_query_and_params is None:
@@ -135,8 +216,22 @@ def build_sql_and_params_from_selections(species_wanted,
             params['lon_max'] = lon_max
         where = " AND ".join(where_clauses) if where_clauses else "1=1"
         sql = f"SELECT * FROM observations WHERE {where};"
-        return sql, params
+        return sql, params, None
     # ELSE if it is working as intended
+    elif resolution == 'daily' and generate_summary_query_and_params is not None:
+        return generate_summary_query_and_params(
+            serialIds=serialId_wanted,
+            species_ids=species_wanted,
+            datemin=datemin,
+            datemax=datemax,
+            lat_min=lat_min,
+            lat_max=lat_max,
+            lon_min=lon_min,
+            lon_max=lon_max,
+            speed_min=speed_min,
+            speed_max=speed_max,
+            polygon=polygon
+        )
     else:
         return generate_query_and_params(
             serialIds=serialId_wanted,
@@ -146,20 +241,46 @@ def build_sql_and_params_from_selections(species_wanted,
             lat_min=lat_min,
             lat_max=lat_max,
             lon_min=lon_min,
-            lon_max=lon_max
+            lon_max=lon_max,
+            speed_min=speed_min,
+            speed_max=speed_max,
+            movement=movement,
+            polygon=polygon
         )
 
 # Includes fallbacks but basically try and do read_db or account for several ways it could go wrong
-def execute_sql(sql, params):
+# geofence is the study area polygon the query came with (None for none)
+def execute_sql(sql, params, geofence=None):
     if read_db is None:
         return pd.DataFrame()
     try:
-        return read_db(sql, params)
-    except TypeError:
-        return read_db(sql)
+        # same filters again hit the query cache, until the next webscrape
+        return in_geofence(read_db(sql, params, cache=True), geofence)
     except Exception:
         return pd.DataFrame()
 
+# Rows inside the query's study area polygon, sqlite only narrows them down to its bounding box
+def in_geofence(df, geofence):
+    if apply_geofence is None:
+        return df
+    return apply_geofence(df, geofence)
+
+# Results of the last query, looked up on the server from the handle in store-results-query.
+# If the handle has been dropped from the server's store the query is run again
+def resolve_results(results_query):
+    if not results_query:
+        return pd.DataFrame()
+    if resolve_result is not None:
+        try:
+            # a dropped handle runs the query again, through the polygon test
+            df = resolve_result(results_query.get('handle'), results_query.get('sql'), results_query.get('params'),
+                                row_filter=lambda rows: in_geofence(rows, results_query.get('geofence')))
+            if df is not None:
+                return df
+        except Exception as e:
+            print("Resolving results error:", e)
+    return execute_sql(results_query.get('sql'), results_query.get('params'), results_query.get('geofence'))
+
 # Blank initial figure to show 1. initially or 2. if the query results in no data
 def blank_map():
     df_empty = pd.DataFrame({'lat': [], 'lon': []})
@@ -179,6 +300,38 @@ def blank_map():
 app = Dash(__name__)
 server = app.server
 
+# CSV exports are served from /export/<id> on the Flask server and sent to the browser
+# a chunk at a time as they are written, so the whole file is never in memory
+# (dcc.Download would build it, then send it again as base64).
+# id -> (file name prefix, function returning the CSV text chunks), the newest few kept
+EXPORTS = OrderedDict()
+EXPORTS_LOCK = threading.Lock()
+MAX_EXPORTS = 64
+
+def register_export(prefix, make_chunks):
+    export_id = uuid.uuid4().hex
+    with EXPORTS_LOCK:
+        EXPORTS[export_id] = (prefix, make_chunks)
+        while len(EXPORTS) > MAX_EXPORTS:
+            EXPORTS.popitem(last=False)
+    return f"/export/{export_id}"
+
+@server.route('/export/<export_id>')
+def serve_export(export_id):
+    with EXPORTS_LOCK:
+        export = EXPORTS.get(export_id)
+    if export is None:
+        abort(404)
+    prefix, make_chunks = export
+    filename = f'{prefix}_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
+    return Response(stream_with_context(make_chunks()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+# A DataFrame already on the server as CSV text chunks, for serve_export
+def frame_csv_chunks(df, chunksize=50000):
+    for start in range(0, max(len(df), 1), chunksize):
+        yield df.iloc[start:start + chunksize].to_csv(header=start == 0, index=False)
+
 # ------------------------------
 # RUN AT APP STARTUP (module import time)
 # ------------------------------
@@ -195,11 +348,15 @@ initial_species_store = _startup_species_df.to_dict(orient='records')
 initial_observations_store = _startup_observations_df.to_dict(orient='records')
 
 def get_last_scraped():
-    # Query the DB once during app startup
+    # Query the DB once during app startup, and again after a scrape.
+    # A scrape that found nothing new (or an unchanged records.json) still counts
     try:
-        df = read_db("SELECT MAX(last_scraped) AS last FROM tAnimal")
-        if df.iloc[0]["last"] is not None:
-            return df.iloc[0]["last"]
+        if last_scraped is not None:
+            last = last_scraped()
+        else:
+            last = read_db("SELECT MAX(last_scraped) AS last FROM tAnimal").iloc[0]["last"]
+        if last is not None:
+            return str(last)
     except:
         pass
     return "Unknown"
@@ -219,8 +376,13 @@ app.layout = html.Div([
     dcc.Store(id='store-observations-df', data=initial_observations_store),
     dcc.Store(id='store-sql', data=None),
     dcc.Store(id='store-params', data=None),
-    dcc.Store(id='store-results-df', data=None),
+    dcc.Store(id='store-geofence', data=None), # study area polygon of the generated query, tested after it runs
+    # handle + sql + params + geofence of the last query that was run, the rows themselves stay on the server
+    dcc.Store(id='store-results-query', data=None),
     dcc.Store(id='store-last-scraped', data=initial_last_scraped),
+    dcc.Store(id='store-scrape-job', data=None), # id of the background scrape job being watched
+    dcc.Store(id='store-selections', data=None), # filters of the last generated query, for the close pairs search
+    dcc.Store(id='store-close-pairs', data=None), # handle + settings of the last close pairs search
 
     html.H1('Serengeti Mammal Analysis & Research Tool', style={'textAlign': 'center'}),
 
@@ -281,12 +443,48 @@ app.layout = html.Div([
 
                html.Label("Longitude Max"),
                dcc.Input(id='lon-max', type='number', placeholder='Max Longitude', style={'width': '100%'}),
+
+
+               html.Label("Speed Min (km/h)"),
+               dcc.Input(id='speed-min', type='number', min=0, placeholder='Min Speed', style={'width': '100%'}),
+
+
+               html.Label("Speed Max (km/h)"),
+               dcc.Input(id='speed-max', type='number', min=0, placeholder='Max Speed', style={'width': '100%'}),
            ], style={'display': 'grid', 'gridTemplateColumns': '1fr 1fr', 'gap': '10px', 'marginBottom': '20px'}),
 
+            # park boundary, SAR swath... only fixes inside it (app_functions/geometry.py)
+            html.Label("Study area (GeoJSON or WKT polygon, optional)"),
+            dcc.Textarea(id='geofence', placeholder='POLYGON ((34.5 -2.5, 35.5 -2.5, 35.5 -1.5, 34.5 -2.5))',
+                         style={'width': '100%', 'height': '60px'}),
+            dcc.Upload(id='upload-geofence', children=html.Button("Load polygon file"), multiple=False),
+            html.Br(),
+
+            html.Label("Resolution"),
+            dcc.RadioItems(
+                id='query-resolution',
+                options=[
+                    {'label': 'Every fix', 'value': 'full'},
+                    {'label': 'Simplified tracks (keeps the shape, fewer points)', 'value': 'downsampled'},
+                    {'label': 'Daily overview (one point per animal per day)', 'value': 'daily'}
+                ],
+                value='full',
+                labelStyle={'display': 'block'}
+            ),
+            html.Label("Max points per animal (simplified tracks)"),
+            dcc.Input(id='max-points', type='number', min=3, step=1, value=DEFAULT_MAX_POINTS, debounce=True, style={'width': '100%'}),
+            html.Br(),
+            # step length, speed, turning angle... of every fix as extra result / CSV columns
+            dcc.Checklist(
+                id='chk-movement',
+                options=[{'label': 'Include movement metrics (step, speed, turn)', 'value': 'movement'}],
+                value=[]
+            ),
+
 
            # Red warning message
            html.Div(
-               "🐾 Warning: Setting min/max latitude or longitude may cut off parts of an animal's path. "
+               "🐾 Warning: Setting min/max latitude, longitude, speed or a study area may cut off parts of an animal's path. "
                "The points on the map may be misleading if your range intersects the animals' paths.🐾",
                style={'color': 'red', 'marginBottom': '10px', 'font-weight':'bold'}
            ),
@@ -323,11 +521,11 @@ app.layout = html.Div([
         html.Div([
             html.Div([
                 html.Span(id='display-last-scraped', style={'marginRight': '20px', 'marginLeft': '20px', 'text-align':'left'}),
-                dcc.Loading(
-                    id='webscrape-loading',
-                    type='circle',
-                    children=html.Button("Webscrape", id='btn-webscrape', n_clicks=0, style={'marginRight': '20px'})
-                ),
+                html.Button("Webscrape", id='btn-webscrape', n_clicks=0),
+                html.Button("Cancel", id='btn-cancel-scrape', n_clicks=0, disabled=True, style={'marginRight': '20px'}),
+                # progress of a running scrape, filled in by polling
+                html.Span(id='display-scrape-progress', style={'fontSize': '12px'}),
+                dcc.Interval(id='interval-scrape', interval=1000, disabled=True),
                 # Removed "Update current" button per request
             ], style={'textAlign': 'right', 'marginBottom': '10px', 'display': 'flex', 'alignItems': 'center', 'gap': '10px'}),
 
@@ -347,9 +545,28 @@ app.layout = html.Div([
 
             html.Br(),
             html.Div([
-                html.Button("Export CSV (current results)", id='btn-export-csv', n_clicks=0),
-                dcc.Download(id='download-results-csv')
-            ], style={'textAlign': 'right', 'marginTop': '10px'})
+                # href is set once there are results, see export_results_link
+                html.A(html.Button("Export CSV (current results)", id='btn-export-csv', n_clicks=0, disabled=True),
+                       id='link-export-csv', href=None)
+            ], style={'textAlign': 'right', 'marginTop': '10px'}),
+
+            # animals near each other, over every fix matching the generated query's filters
+            html.Div([
+                html.H3("Close pairs"),
+                html.Div("Pairs of animals within a distance of each other within a time, "
+                         "using the filters of the last generated query"),
+                html.Br(),
+                html.Div([
+                    html.Label("Within (km)"),
+                    dcc.Input(id='proximity-km', type='number', min=0, value=1, style={'width': '100%'}),
+                    html.Label("Within (minutes)"),
+                    dcc.Input(id='proximity-minutes', type='number', min=1, value=30, style={'width': '100%'}),
+                ], style={'display': 'grid', 'gridTemplateColumns': '1fr 1fr', 'gap': '10px', 'marginBottom': '10px', 'maxWidth': '400px'}),
+                html.Button("Find close pairs", id='btn-find-pairs', n_clicks=0),
+                html.A(html.Button("Export CSV (close pairs)", id='btn-export-pairs', n_clicks=0, disabled=True),
+                       id='link-export-pairs', href=None, style={'marginLeft': '10px'}),
+                html.Div(id='display-close-pairs', style={'fontSize': '12px', 'marginTop': '10px'})
+            ], style={'marginTop': '20px'})
         ], style={'width': '68%', 'display': 'inline-block', 'padding': '10px', 'boxSizing': 'border-box', 'verticalAlign': 'top'})
     ], style={'width': '100%', 'display': 'flex', 'justifyContent': 'space-between'}),
     html.Div([
@@ -413,7 +630,9 @@ def select_all_serials(n_clicks, options):
 @callback(
     Output('store-sql', 'data'),
     Output('store-params', 'data'),
+    Output('store-geofence', 'data'),
     Output('sql-display', 'children'),
+    Output('store-selections', 'data'),
     Input('btn-generate-query', 'n_clicks'),
     Input('chk-show-sql', 'value'),
     State('dropdown-species', 'value'),
@@ -426,10 +645,15 @@ def select_all_serials(n_clicks, options):
     State('lat-max', 'value'),
     State('lon-min', 'value'),
     State('lon-max', 'value'),
+    State('query-resolution', 'value'),
+    State('speed-min', 'value'),
+    State('speed-max', 'value'),
+    State('chk-movement', 'value'),
+    State('geofence', 'value'),
     prevent_initial_call=False
 )
 def on_generate_query(n_clicks, show_sql_vals, species_selected, serial_selected, date_min, date_max, species_options, serial_options,
-                      lat_min, lat_max, lon_min, lon_max):
+                      lat_min, lat_max, lon_min, lon_max, resolution, speed_min, speed_max, movement_vals, polygon):
     all_species_values = [opt['value'] for opt in species_options] if species_options else []
     all_serial_values = [opt['value'] for opt in serial_options] if serial_options else []
 
@@ -445,23 +669,50 @@ def on_generate_query(n_clicks, show_sql_vals, species_selected, serial_selected
 
     datemin = pd.to_datetime(date_min).to_pydatetime() if date_min else None
     datemax = pd.to_datetime(date_max).to_pydatetime() if date_max else None
+    polygon = polygon.strip() if polygon and polygon.strip() else None
 
-    sql, params = build_sql_and_params_from_selections(
-       species_wanted,
-       serialId_wanted,
-       datemin,
-       datemax,
-       lat_min=lat_min,
-       lat_max=lat_max,
-       lon_min=lon_min,
-       lon_max=lon_max
-   )
+    try:
+        sql, params, geofence = build_sql_and_params_from_selections(
+           species_wanted,
+           serialId_wanted,
+           datemin,
+           datemax,
+           lat_min=lat_min,
+           lat_max=lat_max,
+           lon_min=lon_min,
+           lon_max=lon_max,
+           resolution=resolution,
+           speed_min=speed_min,
+           speed_max=speed_max,
+           movement='movement' in (movement_vals or []),
+           polygon=polygon
+       )
+    except (ValueError, KeyError, TypeError, IndexError) as e:
+        # a study area that isn't a polygon, keep the last query
+        return no_update, no_update, no_update, f"Study area not understood: {e}", no_update
 
 
     show_sql = 'show' in (show_sql_vals or [])
     sql_text = str(sql) + "\n Params: \n" + str(params) if (show_sql and sql) else ""
+    if sql_text and geofence:
+        sql_text += "\n Study area (tested after the query): \n" + geofence
+
+    # the same filters as plain values, the close pairs search builds its own queries from them
+    selections = {
+        'serialIds': serialId_wanted,
+        'species_ids': species_wanted,
+        'datemin': datemin.isoformat() if datemin else None,
+        'datemax': datemax.isoformat() if datemax else None,
+        'lat_min': lat_min,
+        'lat_max': lat_max,
+        'lon_min': lon_min,
+        'lon_max': lon_max,
+        'speed_min': speed_min,
+        'speed_max': speed_max,
+        'polygon': polygon,
+    }
 
-    return sql, params, sql_text
+    return sql, params, geofence, sql_text, selections
 
 
 # Enable/disable Run Query button depending on whether SQL exists in memory
@@ -475,22 +726,41 @@ def toggle_run_button(sql):
     return False
 
 
-# Run query button: run the query (using read_db) and store result df and return a map figure
+# Run query button: run the query (using read_db), keep the result on the server
+# and only send its handle to the browser. The map is drawn by update_map below
 @callback(
-    Output('store-results-df', 'data'),
-    Output('graph-content', 'figure'),
+    Output('store-results-query', 'data'),
     Input('btn-run-query', 'n_clicks'),
     State('store-sql', 'data'),
     State('store-params', 'data'),
+    State('store-geofence', 'data'),
     prevent_initial_call=True
 )
-def on_run_query(n_clicks, sql, params):
-    df = execute_sql(sql, params)
+def on_run_query(n_clicks, sql, params, geofence):
+    df = execute_sql(sql, params, geofence)
     if df is None:
         df = pd.DataFrame()
-    results_data = df.to_dict(orient='records')
-    fig = build_map_figure_from_df(df)
-    return results_data, fig
+    handle = store_result(df) if store_result is not None else None
+    return {'handle': handle, 'sql': sql, 'params': params, 'geofence': geofence}
+
+
+# Draw the map for the last results, again when the resolution or max points change
+# (no new query, the results are looked up from the handle)
+@callback(
+    Output('graph-content', 'figure'),
+    Input('store-results-query', 'data'),
+    Input('query-resolution', 'value'),
+    Input('max-points', 'value'),
+    prevent_initial_call=True
+)
+def update_map(results_query, resolution, max_points):
+    if not results_query:
+        return no_update
+    df = resolve_results(results_query)
+    # only the map is simplified, the stored results and export keep every fix
+    if resolution == 'downsampled' and downsample_tracks is not None and df is not None and 'serialId' in df:
+        df = downsample_tracks(df, max(int(max_points or DEFAULT_MAX_POINTS), 3))
+    return build_map_figure_from_df(df)
 
 
 # Display "Last scraped:" in three time zones
@@ -535,93 +805,149 @@ def show_last_scraped(last_scraped):
         return f"Last scraped: {str(last_scraped)}"
 
 
-# Webscrape button: disable while running, change text, run scraper and add_new, then update stores
+# Stores refreshed from the DB, for after a scrape
+def refreshed_stores():
+    results = run_all_update_funcs()
+    species_df = results.get('species_df', pd.DataFrame(columns=['species_name', 'species_id']))
+    observations_df = results.get('observations_df', pd.DataFrame())
+
+    return (species_df.to_dict(orient='records'),
+            observations_df.to_dict(orient='records'),
+            get_last_scraped())
+
+def describe_scrape(progress):
+    # one line of text for display-scrape-progress
+    text = (f"{progress['status']}: {progress['records_downloaded']} records downloaded "
+            f"({progress['records_new']} new), "
+            f"{progress['species_cached']} species already known, "
+            f"{progress['serials_resolved']}/{progress['serials_total']} species pages looked up, "
+            f"{progress['records_ingested']} new records ingested")
+    if progress['status'] == 'running' and progress['eta_seconds'] is not None:
+        text += f", about {int(progress['eta_seconds'] // 60)} min {int(progress['eta_seconds'] % 60)} s left"
+    # rows per second of each pipeline stage, shows which one is holding it up
+    rates = [f"{name} {stage['rows_per_second']:.0f}/s" for name, stage in progress.get('stages', {}).items()
+             if stage['rows_per_second'] is not None]
+    if rates:
+        text += f" [{', '.join(rates)}]"
+    if progress['error']:
+        text += f" ({progress['error']})"
+    return text
+
+# Webscrape button: start the scrape as a background job (app_functions/scrape_jobs.py) and
+# poll it with interval-scrape until it finishes, then update stores. Data is loaded
+# in batches while the scrape runs (webscraping.stream_webscrape).
+# The callback returns right away so queries keep working while it runs
 @callback(
     Output('store-species-df', 'data'),
     Output('store-observations-df', 'data'),
     Output('store-last-scraped', 'data'),
+    Output('store-scrape-job', 'data'),
+    Output('interval-scrape', 'disabled'),
+    Output('display-scrape-progress', 'children'),
     Output('btn-webscrape', 'disabled'),
     Output('btn-webscrape', 'children'),
+    Output('btn-cancel-scrape', 'disabled'),
     Input('btn-webscrape', 'n_clicks'),
+    Input('interval-scrape', 'n_intervals'),
+    Input('btn-cancel-scrape', 'n_clicks'),
+    State('store-scrape-job', 'data'),
     prevent_initial_call=True
 )
-def on_webscrape(n_clicks):
-    # Immediately set button disabled and text — Dash will send these outputs once the callback completes.
-    # If webscrape function missing, just return no_update for stores and re-enable button
-    if do_webscrape is None or add_new is None:
+def on_webscrape(n_clicks, n_intervals, cancel_clicks, job_id):
+    # If webscrape function missing, refresh the stores from the DB and leave the button enabled
+    if do_webscrape is None or add_new is None or JOBS is None:
         print("Webscraping or add_new function unavailable.")
-        # still run run_all_update_funcs to refresh from DB if possible
-        results = run_all_update_funcs()
-        species_df = results.get('species_df', pd.DataFrame(columns=['species_name', 'species_id']))
-        observations_df = results.get('observations_df', pd.DataFrame())
-        # try to get last_scraped from DB
-        try:
-            last_df = read_db("SELECT last_scraped FROM tAnimal")
-            last_scraped = last_df['last_scraped'].max()
-            last_scraped = str(last_scraped) if last_scraped is not None else "Unknown"
-        except Exception:
-            last_scraped = "Unknown"
-        return (species_df.to_dict(orient='records'),
-                observations_df.to_dict(orient='records'),
-                last_scraped,
-                False,
-                "Webscrape")
-
-    # If real webscrape available, run it (synchronously)
-    try:
-        # Run webscrape; depending on your implementation, this could take time.
-        # The callback will run synchronously on the server process.
-        df_new = do_webscrape()
-        add_new(df_new)
-    except Exception as e:
-        print("Webscrape error:", e)
-
-    # After webscraping finishes, re-run the update functions 
-    results = run_all_update_funcs()
-    species_df = results.get('species_df', pd.DataFrame(columns=['species_name', 'species_id']))
-    observations_df = results.get('observations_df', pd.DataFrame())
-
-    # Try to get last_scraped timestamp from DB
-    try:
-        last_df = read_db("SELECT last_scraped FROM tAnimal")
-        last_scraped = last_df['last_scraped'].max()
-        last_scraped = str(last_scraped) if last_scraped is not None else "Unknown"
-    except Exception:
-        last_scraped = "Unknown"
-
-    # Return stores + re-enabled button + normal label
-    return (species_df.to_dict(orient='records'),
-            observations_df.to_dict(orient='records'),
-            last_scraped,
-            False,
-            "Webscrape")
-
-
-def build_map_figure_from_df(df):
+        return (*refreshed_stores(), None, True, "", False, "Webscrape", True)
+
+    trigger = ctx.triggered_id
+
+    if trigger == 'btn-webscrape':
+        def scrape(**kwargs):
+            # species already in tAnimal aren't looked up again, an unchanged
+            # records.json isn't downloaded again and fixes already in
+            # tObservations aren't loaded again
+            try:
+                known = known_species() if known_species is not None else None
+                state = download_state(RECORDS_URL) if known_species is not None else None
+                marks = high_water_marks() if known_species is not None else None
+            except Exception as e:
+                print("Could not read what the database already has:", e)
+                known, state, marks = None, None, None
+            return stream_webscrape(known_species=known, download_state=state, high_water_marks=marks,
+                                    archive=ARCHIVE, save_state=save_download_state,
+                                    mark_scraped=mark_scraped, **kwargs)
+        job_id = JOBS.start(scrape, add_new)
+        return (no_update, no_update, no_update, job_id, False, "starting...", True, "Scraping...", False)
+
+    if trigger == 'btn-cancel-scrape' and job_id:
+        JOBS.cancel(job_id)
+        return (no_update, no_update, no_update, no_update, no_update, "cancelling...", no_update, no_update, True)
+
+    # interval tick: report progress, and finish up once the job is done
+    job = JOBS.get(job_id) if job_id else None
+    if job is None:
+        return (no_update, no_update, no_update, None, True, "", False, "Webscrape", True)
+
+    progress = job.snapshot()
+    if not job.finished():
+        return (no_update, no_update, no_update, no_update, no_update, describe_scrape(progress), no_update, no_update, no_update)
+
+    return (*refreshed_stores(), None, True, describe_scrape(progress), False, "Webscrape", True)
+
+
+# with more animals than this the map puts them into one trace per species,
+# a legend with hundreds of entries is unusable and every trace slows the browser down
+MAX_ANIMAL_TRACES = 50
+
+def build_map_figure_from_df(df, merge='auto'):
     """
     Build a map figure that:
      - Plots all points (latitude/longitude) colored by serialId
      - Links points for the same serialId in chronological order
-     - Shows hovertext with serialId, date, latitude, longitude, species_name
+     - Shows hover with serialId, date, latitude, longitude, species_name
+    merge:
+     - False: one trace per serial with mode='lines+markers' so legend isolation (double-click) hides both markers and lines together
+     - True: one trace per species, the animals' tracks joined with NaN gaps (so lines don't connect
+       different animals) and markers colored per animal. The legend then toggles a whole species
+     - 'auto': merged when there are more than MAX_ANIMAL_TRACES animals
     Implementation note:
-     - Uses one trace per serial with mode='lines+markers' so legend isolation (double-click) hides both markers and lines together
-     - Markers and lines will share the same color per trace (automatic Plotly coloring)
+     - Everything is done on whole NumPy arrays, the hover text is filled in by Plotly from
+       customdata + hovertemplate in the browser instead of one string per row here
     """
     if df is None or df.empty:
         return blank_map()
 
-    df2 = df.copy()
-
-    # Ensures works with isoformat
-    df2['date'] = pd.to_datetime(df2['date'])
+    # times as int64 seconds, one conversion for the whole column
+    if 'date_epoch' in df and pd.api.types.is_integer_dtype(df['date_epoch']):
+        times = df['date_epoch'].to_numpy()
+    else:
+        date_col = df['date_epoch'] if 'date_epoch' in df else df['date']
+        times = pd.to_datetime(date_col, utc=True).astype('int64').to_numpy() // 10**9
+
+    # one track after another, each in time order
+    serial_codes, serials = pd.factorize(df['serialId'], sort=True)
+    order = np.lexsort((times, serial_codes))
+    # rows without a serialId (code -1) sort first, groupby used to drop them too
+    order = order[serial_codes[order] >= 0]
+    serial_codes = serial_codes[order]
+    lat = df['latitude'].to_numpy(dtype=float)[order]
+    lon = df['longitude'].to_numpy(dtype=float)[order]
+    # object arrays, Plotly copies fixed width string arrays one element at a time
+    dates = np.datetime_as_string(times[order].astype('datetime64[s]'), unit='s', timezone='UTC').astype(object)
+    species = df['species_name'].to_numpy(dtype=object)[order] if 'species_name' in df else np.full(len(order), '', dtype=object)
+    species = np.where(pd.isna(species), '', species)
+    serial_labels = np.asarray(serials, dtype=object).astype(str)
+
+    starts = np.flatnonzero(np.diff(serial_codes, prepend=-1))
+    ends = np.append(starts[1:], len(order))
 
     # center map
     # NOTE to future editors
     # Override here is a design choice. Remove to allow default logic,
     # Which is to center over queried area.
     try:
-        center_lat = df2['latitude'].astype(float).mean()
-        center_lon = df2['longitude'].astype(float).mean()
+        center_lat = np.nanmean(lat)
+        center_lon = np.nanmean(lon)
         map_center = {"lat": center_lat, "lon": center_lon}
 
         ## OVERRIDE
@@ -632,34 +958,54 @@ def build_map_figure_from_df(df):
     except Exception:
         map_center = {"lat": -1.9, "lon": 34.81076841740793}
 
+    if merge == 'auto':
+        merge = len(starts) > MAX_ANIMAL_TRACES
+
+    # filled in by Plotly in the browser, species comes from tAnimal so it is the same for every fix of an animal
+    hover_points = "date: %{customdata[0]}<br>lat: %{lat}<br>lon: %{lon}"
+
     fig = go.Figure()
 
-    # iterate by serialId and create one trace per serial (lines+markers)
-    for sid, group in df2.groupby('serialId'):
-        g = group.sort_values('date')
-        lat_list = g['latitude'].astype(float).tolist()
-        lon_list = g['longitude'].astype(float).tolist()
-        hover_texts = []
-        for _, row in g.iterrows():
-            dt_str = row['date'].isoformat() if pd.notnull(row['date']) else ''
-            species_str = row['species_name'] if 'species_name' in row and pd.notnull(row['species_name']) else ''
-            hover_texts.append(
-                f"serialId: {sid}<br>date: {dt_str}<br>lat: {row['latitude']}<br>lon: {row['longitude']}<br>species_name: {species_str}"
-            )
-
-        # mode 'lines+markers' will draw either markers only (if single point) or both
-        fig.add_trace(go.Scattermap(
-            lat=lat_list,
-            lon=lon_list,
-            mode='lines+markers',
-            name=str(sid),           # legend entry per serial
-            legendgroup=str(sid),    # group traces (not strictly necessary here but kept consistent)
-            hoverinfo='text',
-            hovertext=hover_texts,
-            marker=dict(size=8),
-            line=dict(width=2),
-            showlegend=True,
-        ))
+    if not merge:
+        # one trace per serial (lines+markers), slices of the sorted arrays
+        for code, s, e in zip(serial_codes[starts], starts, ends):
+            sid = serial_labels[code]
+            # mode 'lines+markers' will draw either markers only (if single point) or both
+            fig.add_trace(go.Scattermap(
+                lat=lat[s:e],
+                lon=lon[s:e],
+                mode='lines+markers',
+                name=sid,                # legend entry per serial
+                legendgroup=sid,         # group traces (not strictly necessary here but kept consistent)
+                customdata=dates[s:e, None],
+                hovertemplate=f"serialId: {sid}<br>" + hover_points + f"<br>species_name: {species[s]}<extra></extra>",
+                marker=dict(size=8),
+                line=dict(width=2),
+                showlegend=True,
+            ))
+    else:
+        # one trace per species, NaN between animals breaks the line
+        # serial codes run 0, 1, 2, ... one per track, so track_species[code] is an animal's species
+        track_species = species[starts]
+        for sp in pd.unique(track_species):
+            rows = np.flatnonzero(track_species[serial_codes] == sp)
+            # where the next animal starts within rows
+            gaps = np.flatnonzero(np.diff(serial_codes[rows])) + 1
+            customdata = np.column_stack((dates[rows], serial_labels[serial_codes[rows]]))
+            fig.add_trace(go.Scattermap(
+                lat=np.insert(lat[rows], gaps, np.nan),
+                lon=np.insert(lon[rows], gaps, np.nan),
+                mode='lines+markers',
+                name=f"{sp or 'unknown'} ({len(gaps) + 1} animals)",
+                legendgroup=str(sp),
+                customdata=np.insert(customdata, gaps, None, axis=0),
+                hovertemplate="serialId: %{customdata[1]}<br>" + hover_points + f"<br>species_name: {sp}<extra></extra>",
+                # markers colored by animal (its number on a color scale), the line is one color per species
+                marker=dict(size=8, color=np.insert(serial_codes[rows].astype(float), gaps, np.nan),
+                            colorscale='Turbo', cmin=0, cmax=max(len(starts) - 1, 1)),
+                line=dict(width=2),
+                showlegend=True,
+            ))
 
     # Layout using mapb (open-street-map style)
     fig.update_layout(
@@ -674,18 +1020,115 @@ def build_map_figure_from_df(df):
     return fig
 
 
-# Export CSV: create and send CSV from store-results-df
+# Export CSV link: points at an export (see serve_export) that re-runs the last query
+# and streams it to the browser as CSV chunk by chunk, so exporting the whole archive
+# never builds the full DataFrame or the full file.
+# Falls back to the results kept on the server if streaming isn't available.
 @callback(
-    Output('download-results-csv', 'data'),
-    Input('btn-export-csv', 'n_clicks'),
-    State('store-results-df', 'data'),
+    Output('link-export-csv', 'href'),
+    Output('btn-export-csv', 'disabled'),
+    Input('store-results-query', 'data'),
     prevent_initial_call=True
 )
-def export_csv(n_clicks, results_store):
-    if not results_store:
+def export_results_link(results_query):
+    if not results_query:
+        return None, True
+    if iter_csv is not None:
+        def make_chunks():
+            return iter_csv(results_query['sql'], results_query['params'],
+                            row_filter=lambda chunk: in_geofence(chunk, results_query.get('geofence')))
+    else:
+        def make_chunks():
+            return frame_csv_chunks(resolve_results(results_query))
+    return register_export('results', make_chunks), False
+
+
+# Small table of the animal pairs with the most contacts, for display-close-pairs
+def close_pairs_table(summary, rows=10):
+    header = ['Serial A', 'Serial B', 'Species', 'Contacts', 'First', 'Last', 'Closest (km)']
+    body = []
+    for r in summary.head(rows).itertuples():
+        body.append(html.Tr([
+            html.Td(r.serialId_a),
+            html.Td(r.serialId_b),
+            html.Td(f"{r.species_a} / {r.species_b}"),
+            html.Td(r.n_contacts),
+            html.Td(pd.to_datetime(r.first_epoch, unit='s').strftime("%Y-%m-%d %H:%M")),
+            html.Td(pd.to_datetime(r.last_epoch, unit='s').strftime("%Y-%m-%d %H:%M")),
+            html.Td(f"{r.min_distance_km:.2f}"),
+        ]))
+    return html.Table([html.Thead(html.Tr([html.Th(h) for h in header])), html.Tbody(body)])
+
+
+# Find close pairs button: pair up every fix matching the last generated query's filters
+# (app_functions/proximity.py), keep the pairs on the server and show the pairs of
+# animals with the most contacts. The pairs are exported with the button below
+@callback(
+    Output('store-close-pairs', 'data'),
+    Output('display-close-pairs', 'children'),
+    Output('btn-export-pairs', 'disabled'),
+    Input('btn-find-pairs', 'n_clicks'),
+    State('store-selections', 'data'),
+    State('proximity-km', 'value'),
+    State('proximity-minutes', 'value'),
+    prevent_initial_call=True
+)
+def on_find_pairs(n_clicks, selections, distance_km, minutes):
+    if find_close_pairs is None:
+        return None, "Close pairs search unavailable.", True
+    if not distance_km or not minutes or distance_km <= 0 or minutes <= 0:
+        return None, "Enter a distance and a time above zero.", True
+
+    window_s = int(minutes * 60)
+    try:
+        pairs = find_close_pairs(distance_km, window_s, selections)
+    except Exception as e:
+        print("Close pairs error:", e)
+        return None, f"Close pairs search failed ({e})", True
+
+    summary = summarise_pairs(pairs)
+    handle = store_result(pairs) if store_result is not None else None
+    text = (f"{len(pairs)} pairs of fixes within {distance_km} km and {minutes} minutes, "
+            f"between {len(summary)} pairs of animals")
+    search = {'handle': handle, 'distance_km': distance_km, 'window_s': window_s, 'filters': selections}
+    return search, html.Div([html.Div(text), close_pairs_table(summary)]), False
+
+
+# Export close pairs link: streams the pairs kept on the server, or if they have been
+# dropped searches again and streams them chunk by chunk (see serve_export)
+@callback(
+    Output('link-export-pairs', 'href'),
+    Input('store-close-pairs', 'data'),
+    prevent_initial_call=True
+)
+def export_pairs_link(search):
+    if not search:
+        return None
+    def make_chunks():
+        pairs = resolve_result(search['handle']) if resolve_result is not None and search.get('handle') else None
+        if pairs is not None:
+            return frame_csv_chunks(pairs)
+        if iter_close_pairs_csv is None:
+            return iter([])
+        return iter_close_pairs_csv(search['distance_km'], search['window_s'], search['filters'])
+    return register_export('close_pairs', make_chunks)
+
+
+# Load polygon file: put the uploaded GeoJSON / WKT file's text in the study area box
+@callback(
+    Output('geofence', 'value'),
+    Input('upload-geofence', 'contents'),
+    prevent_initial_call=True
+)
+def load_geofence(contents):
+    if not contents:
+        return no_update
+    # contents is "data:<type>;base64,<data>"
+    try:
+        return base64.b64decode(contents.split(',', 1)[1]).decode('utf-8')
+    except Exception as e:
+        print("Polygon file error:", e)
         return no_update
-    df = pd.DataFrame(results_store)
-    return dcc.send_data_frame(df.to_csv, filename=f'results_{datetime.datetime.now().strftime("%Y%m%d_%H%M%S")}.csv', index=False)
 
 
 # Theme selector: update the CSS href to switch themes 
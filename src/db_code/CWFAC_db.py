@@ -1,8 +1,12 @@
 # imports
 from db_code.base_db import BaseDB
+from db_code.CWFAC_migrations import MIGRATIONS
+from db_code.query_cache import bump_generation
+from db_code.tracks import SECONDS_PER_DAY, daily_summary, movement_metrics
 
 from datetime import datetime, timezone
 
+import json
 import os
 import sqlite3
 import numpy as np
@@ -14,12 +18,15 @@ class CWFACDB(BaseDB):
     This class should extend BaseDB by adding
     functionality specific to the Serengeti data.
     '''
+
+    MIGRATIONS = MIGRATIONS
    
     def __init__(self,
                  path: str,
                  create: bool = False,
+                 profile: str = 'interactive-read',
                 ): # need to include this and then call super() to get init for the parent class
-        super().__init__(path, create)
+        super().__init__(path, create, profile)
         return
 
     def _create_tables(self) -> None:
@@ -58,134 +65,408 @@ class CWFACDB(BaseDB):
         
         return
 
-    def _load_data(self, df: pd.DataFrame) -> None:
+    def _load_data(self, df: pd.DataFrame, now: str = None) -> dict:
         """
         Load Serengeti data into:
-            tSpecies, tAnimal, tObservations
+            tSpecies, tAnimal, tObservations (and the tables kept from them)
         following foreign key constraints and conflict rules.
+
+        The incoming frame is staged into a temporary table in one
+        executemany, then merged into the real tables with a handful of
+        set-based statements inside a single transaction.
+
+        now is the ISO time written to first_scraped / last_scraped,
+        the current time if not given (a rebuild passes the time the
+        snapshot was scraped).
+
+        Returns a dictionary of per-table counts, for example
+            {'tObservations': {'inserted': 120, 'updated': 0}, ...}
         """
 
         print("loading data")
 
-        now = datetime.now(timezone.utc).isoformat()
+        if now is None:
+            now = datetime.now(timezone.utc).isoformat()
+
+        counts = {table: {"inserted": 0, "updated": 0}
+                  for table in ("tSpecies", "tAnimal", "tObservations")}
 
         # ---------------------------------------------------------
-        # 1. tSpecies: Insert species if it doesn't already exist
+        # 0. Stage the incoming frame into a temp table
         # ---------------------------------------------------------
-        # Ensure 'unknown' species exists
-        sql_insert_species = """
-            INSERT INTO tSpecies (species_name)
-            VALUES (:species_name)
-            ON CONFLICT(species_name) DO NOTHING;
+        # blank / missing species are treated as 'unknown', same as before
+        species = df["species"].fillna("").astype(str).str.strip()
+        species = species.where(species != "", "unknown")
+
+        staged_rows = zip(
+            df["serialId"].tolist(),
+            df["date"].tolist(),  # already ISO string
+            df["collarId"].tolist(),
+            df["latitude"].astype(float).tolist(),
+            df["longitude"].astype(float).tolist(),
+            df["positionId"].tolist(),
+            species.tolist(),
+        )
+
+        # loading always uses the ingest profile, whatever this object was opened with
+        self._connect(profile='ingest')
+        self.run_action("DROP TABLE IF EXISTS temp.tStageObservations;", keep_open=True)
+        self.run_action("""
+            CREATE TEMP TABLE tStageObservations (
+                serialId TEXT,
+                date TIMESTAMP,
+                collarId TEXT,
+                latitude FLOAT,
+                longitude FLOAT,
+                positionId TEXT,
+                species TEXT
+            )
+            ;""", keep_open=True)
+
+        # everything from here on is one transaction. run_action/run_many roll
+        # back and close on their own errors, anything else raised in between
+        # (a bad frame, the numpy summaries) is rolled back here so the pooled
+        # ingest connection is never handed back mid transaction
+        self.run_action("BEGIN;", keep_open=True)
+        try:
+            self.run_many("""
+                INSERT INTO temp.tStageObservations
+                    (serialId, date, collarId, latitude, longitude, positionId, species)
+                VALUES (?, ?, ?, ?, ?, ?, ?);
+                """, staged_rows, keep_open=True)
+
+            # ---------------------------------------------------------
+            # 1. tSpecies: Insert species if it doesn't already exist
+            # ---------------------------------------------------------
+            # Ensure 'unknown' species exists
+            self.run_action("""
+                INSERT INTO tSpecies (species_name)
+                SELECT species FROM (
+                    SELECT 'unknown' AS species
+                    UNION
+                    SELECT DISTINCT species FROM temp.tStageObservations
+                )
+                WHERE true
+                ON CONFLICT(species_name) DO NOTHING;
+                """, keep_open=True)
+            counts["tSpecies"]["inserted"] = self._curs.rowcount
+
+            unknown_id = self.run_query("""
+                SELECT species_id
+                FROM tSpecies
+                WHERE species_name = 'unknown';
+                """, keep_open=True).iloc[0]["species_id"]
+
+            # ---------------------------------------------------------
+            # 2. tAnimal: Ensure animals exist and update last_scraped
+            # ---------------------------------------------------------
+            # one row per incoming serial, a real species wins over 'unknown'
+            self.run_action("DROP TABLE IF EXISTS temp.tStageAnimal;", keep_open=True)
+            self.run_action("""
+                CREATE TEMP TABLE tStageAnimal AS
+                SELECT st.serialId AS serialId,
+                       COALESCE(MIN(CASE WHEN sp.species_id <> :unknown_id THEN sp.species_id END),
+                                :unknown_id) AS species_id
+                FROM temp.tStageObservations st
+                JOIN tSpecies sp ON sp.species_name = st.species
+                GROUP BY st.serialId
+                ;""", {"unknown_id": unknown_id}, keep_open=True)
+
+            # Existing animals: update last_scraped, and upgrade unknown → real species
+            # Otherwise: do nothing to species
+            self.run_action("""
+                UPDATE tAnimal
+                SET last_scraped = :now,
+                    species_id = CASE
+                        WHEN tAnimal.species_id = :unknown_id AND sa.species_id <> :unknown_id
+                            THEN sa.species_id
+                        ELSE tAnimal.species_id
+                    END
+                FROM temp.tStageAnimal sa
+                WHERE tAnimal.serialId = sa.serialId;
+                """, {"now": now, "unknown_id": unknown_id}, keep_open=True)
+            counts["tAnimal"]["updated"] = self._curs.rowcount
+
+            # New animals → insert
+            self.run_action("""
+                INSERT INTO tAnimal (serialId, species_id, first_scraped, last_scraped)
+                SELECT sa.serialId, sa.species_id, :now, :now
+                FROM temp.tStageAnimal sa
+                WHERE NOT EXISTS (SELECT 1 FROM tAnimal a WHERE a.serialId = sa.serialId);
+                """, {"now": now}, keep_open=True)
+            counts["tAnimal"]["inserted"] = self._curs.rowcount
+
+            # ---------------------------------------------------------
+            # 3. tObservations: Insert only if (serialId, date) not present
+            # ---------------------------------------------------------
+            # new rows get obs_ids above this, used to find them again below
+            obs_id_before = self.run_query("SELECT COALESCE(MAX(obs_id), 0) AS max_obs_id FROM tObservations;",
+                                           keep_open=True).iloc[0]["max_obs_id"]
+
+            # ORDER BY the staging table's rowid so a duplicate inside the batch keeps its first row
+            self.run_action("""
+                INSERT INTO tObservations (serialId, date, date_epoch, collarId, latitude, longitude, positionId)
+                SELECT serialId, date, CAST(strftime('%s', date) AS INTEGER),
+                       collarId, latitude, longitude, positionId
+                FROM temp.tStageObservations
+                WHERE true
+                ORDER BY rowid
+                ON CONFLICT(serialId, date) DO NOTHING;
+                """, keep_open=True)
+            counts["tObservations"]["inserted"] = self._curs.rowcount
+
+            # ---------------------------------------------------------
+            # 4. rtObservations: keep the spatial index in step
+            # ---------------------------------------------------------
+            self.run_action("""
+                INSERT INTO rtObservations (id, min_lat, max_lat, min_lon, max_lon)
+                SELECT obs_id, latitude, latitude, longitude, longitude
+                FROM tObservations
+                WHERE obs_id > :obs_id_before
+                  AND latitude IS NOT NULL AND longitude IS NOT NULL;
+                """, {"obs_id_before": obs_id_before}, keep_open=True)
+
+            # ---------------------------------------------------------
+            # 5. tAnimalDaily: redo only the days that got new fixes
+            # ---------------------------------------------------------
+            counts["tAnimalDaily"] = {"inserted": 0,
+                                      "updated": self._update_daily_summary(obs_id_before)}
+
+            # ---------------------------------------------------------
+            # 6. tMovement: redo the end of every track that got new fixes
+            # ---------------------------------------------------------
+            counts["tMovement"] = {"inserted": 0,
+                                   "updated": self._update_movement(obs_id_before)}
+
+            # ---------------------------------------------------------
+            # 7. tDownloadState: remember what was downloaded, only if this commits
+            # ---------------------------------------------------------
+            # the scraper puts the validators of the download in df.attrs
+            state = df.attrs.get("download_state")
+            if state:
+                self._save_download_state(state["url"], state, now, commit=False)
+
+            self._conn.commit()
+        except BaseException:
+            if self._connected:
+                self._conn.rollback()
+                self._close()
+            raise
+
+        self.run_action("DROP TABLE IF EXISTS temp.tStageAnimal;", keep_open=True)
+        self.run_action("DROP TABLE IF EXISTS temp.tStageObservations;", keep_open=True)
+
+        self._commit_and_close()
+
+        # cached query results are now out of date
+        bump_generation()
+
+        return counts
+
+    def _save_download_state(self, url: str, state: dict, now: str = None, commit: bool = True) -> None:
         """
-        sql_select_species_id = """
-            SELECT species_id
-            FROM tSpecies
-            WHERE species_name = :species_name;
+        Upsert the validators of the last loaded download of url into
+        tDownloadState. state is {'etag': ..., 'last_modified': ...}, other
+        keys are ignored. now is the ISO time written to updated_at, the
+        current time if not given.
+
+        With commit False it runs inside whatever transaction is open and
+        leaves the connection open (_load_data saves it with the data).
         """
+        if now is None:
+            now = datetime.now(timezone.utc).isoformat()
+
+        self._connect(profile='ingest')
+        self.run_action("""
+            INSERT INTO tDownloadState (url, etag, last_modified, updated_at)
+            VALUES (:url, :etag, :last_modified, :now)
+            ON CONFLICT(url) DO UPDATE SET
+                etag = excluded.etag,
+                last_modified = excluded.last_modified,
+                updated_at = excluded.updated_at;
+            """, {"url": url, "etag": state.get("etag"), "last_modified": state.get("last_modified"),
+                  "now": now}, keep_open=True)
+        if commit:
+            self._commit_and_close()
+        return
 
-        species_to_id = {}
+    def _mark_scraped(self, url: str, serialIds, now: str = None) -> int:
+        """
+        Record a finished scrape of url: last_scraped of every animal in the
+        download, new fixes or not (_load_data only sees the animals that
+        had some), and tDownloadState.updated_at of url. When the server
+        said the file hadn't changed serialIds is empty and only updated_at
+        moves.
 
-        # Insert all unique species in the DataFrame
-        species_list = [s for s in df["species"].dropna().str.strip() if s]
-        species_list.append("unknown")
-        for sp in set(species_list): 
-            # basically a convoluted way to get all the species including unknown always
-            self.run_action(sql_insert_species, {"species_name": sp}, keep_open=True, commit = True)
-            result = self.run_query(sql_select_species_id, {"species_name": sp}, keep_open = True)
-            species_to_id[sp] = result.iloc[0]["species_id"]
+        now is the ISO time written, the current time if not given.
 
-        # ---------------------------------------------------------
-        # 2. tAnimal: Ensure animals exist and update last_scraped
-        # ---------------------------------------------------------
-        sql_select_animal = """
-            SELECT a.species_id
-            FROM tAnimal a
-            WHERE a.serialId = :serialId;
+        Returns the number of animals updated.
         """
+        if now is None:
+            now = datetime.now(timezone.utc).isoformat()
 
-        sql_update_animal_last = """
+        self._connect(profile='ingest')
+        self.run_action("""
             UPDATE tAnimal
             SET last_scraped = :now
-            WHERE serialId = :serialId;
-        """
+            WHERE serialId IN (SELECT value FROM json_each(:serialIds));
+            """, {"now": now, "serialIds": json.dumps([str(s) for s in serialIds])}, keep_open=True)
+        updated = self._curs.rowcount
+        self.run_action("""
+            UPDATE tDownloadState
+            SET updated_at = :now
+            WHERE url = :url;
+            """, {"now": now, "url": url}, keep_open=True)
+        self._commit_and_close()
 
-        sql_update_animal_species = """
-            UPDATE tAnimal
-            SET species_id = :new_species_id
-            WHERE serialId = :serialId;
-        """
+        # last_scraped is one of the columns of the full results
+        if updated > 0:
+            bump_generation()
+        return max(updated, 0)
 
-        sql_insert_animal = """
-            INSERT INTO tAnimal (serialId, species_id, first_scraped, last_scraped)
-            VALUES (:serialId, :species_id, :now, :now);
+    def _update_daily_summary(self, obs_id_after: int = 0) -> int:
         """
+        Recompute the tAnimalDaily rows for every (serialId, day) bucket
+        that has an observation with obs_id > obs_id_after. 0 rebuilds the
+        whole table. Runs inside whatever transaction is open and leaves
+        the connection open.
 
-        sql_get_species_name = """
-            SELECT species_name 
-            FROM tSpecies 
-            WHERE species_id = :species_id;
+        Returns the number of buckets written.
         """
+        self._connect()
+        self.run_action("DROP TABLE IF EXISTS temp.tStageBuckets;", keep_open=True)
+        self.run_action("""
+            CREATE TEMP TABLE tStageBuckets (
+                serialId TEXT,
+                day_epoch INTEGER,
+                PRIMARY KEY (serialId, day_epoch)
+            )
+            ;""", keep_open=True)
+        self.run_action("""
+            INSERT INTO temp.tStageBuckets (serialId, day_epoch)
+            SELECT DISTINCT serialId, date_epoch - date_epoch % :day
+            FROM tObservations
+            WHERE obs_id > :obs_id_after
+              AND date_epoch IS NOT NULL;
+            """, {"day": SECONDS_PER_DAY, "obs_id_after": obs_id_after}, keep_open=True)
 
-        unique_animals = df[["serialId", "species"]].drop_duplicates()
-
-        for _, row in unique_animals.iterrows():
-            serialId = row["serialId"]
-            incoming_species = row["species"]
-            incoming_species_id = species_to_id.get(incoming_species, species_to_id["unknown"])
+        # every fix in those buckets, old ones included. Walking the buckets
+        # in key order and range searching the (serialId, date_epoch) index
+        # for each keeps this fast for a handful of buckets or for all of them
+        fixes = self.run_query_columnar("""
+            SELECT o.serialId, o.date_epoch, o.latitude, o.longitude
+            FROM temp.tStageBuckets b
+            JOIN tObservations o
+              ON o.serialId = b.serialId
+             AND o.date_epoch >= b.day_epoch AND o.date_epoch < b.day_epoch + :day
+            WHERE o.latitude IS NOT NULL AND o.longitude IS NOT NULL
+            ORDER BY b.serialId, b.day_epoch, o.date_epoch;
+            """, {"day": SECONDS_PER_DAY},
+            dtypes={"serialId": "category", "date_epoch": "int64"}, keep_open=True)
 
-            existing = self.run_query(sql_select_animal, {"serialId": serialId}, keep_open = True)
+        summary = daily_summary(fixes["serialId"], fixes["date_epoch"],
+                                fixes["latitude"], fixes["longitude"])
+        summary["serial"] = fixes.categories["serialId"][summary["serial"].astype(np.int64)]
 
-            if existing.empty:
-                # New animal → insert
-                self.run_action(sql_insert_animal,
-                                {"serialId": serialId, "species_id": incoming_species_id, "now": now},
-                                keep_open=True, commit = True)
-            else:
-                # Update last_scraped
-                self.run_action(sql_update_animal_last, {"serialId": serialId, "now": now}, keep_open=True, commit = True)
+        self.run_action("""
+            DELETE FROM tAnimalDaily
+            WHERE (serialId, day_epoch) IN (SELECT serialId, day_epoch FROM temp.tStageBuckets);
+            """, keep_open=True)
+        written = self.run_many("""
+            INSERT INTO tAnimalDaily
+                (serialId, day_epoch, n_fixes, lat_mean, lon_mean, lat_min, lat_max,
+                 lon_min, lon_max, first_epoch, last_epoch, distance_km)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """, zip(*(summary[name].tolist() for name in
+                       ("serial", "day_epoch", "n_fixes", "lat_mean", "lon_mean", "lat_min", "lat_max",
+                        "lon_min", "lon_max", "first_epoch", "last_epoch", "distance_km"))),
+            keep_open=True)
 
-                # Handle species logic
-                existing_species_id = existing.iloc[0]["species_id"]
-                existing_species_df = self.run_query(sql_get_species_name, {"species_id": existing_species_id}, keep_open = True)
-                existing_species_name = existing_species_df.iloc[0]["species_name"]
+        self.run_action("DROP TABLE IF EXISTS temp.tStageBuckets;", keep_open=True)
+        return max(written, 0)
 
-                if incoming_species != "unknown" and existing_species_name == "unknown":
-                    # Upgrade unknown → real species
-                    self.run_action(sql_update_animal_species,
-                                    {"serialId": serialId, "new_species_id": incoming_species_id},
-                                    keep_open=True, commit = True)
-                # Otherwise: do nothing to species
+    # tMovement columns in the order movement_metrics gives them
+    MOVEMENT_COLUMNS = ("step_km", "dt_s", "speed_kmh", "bearing_deg", "turn_deg", "day_displacement_km")
 
-        # ---------------------------------------------------------
-        # 3. tObservations: Insert only if (serialId, date) not present
-        # ---------------------------------------------------------
-        sql_select_obs = """
-            SELECT 1 FROM tObservations
-            WHERE serialId = :serialId AND date = :date;
+    def _update_movement(self, obs_id_after: int = 0) -> int:
         """
+        Recompute tMovement for every animal with an observation with
+        obs_id > obs_id_after, from its earliest such fix to the end of its
+        track. A few older fixes are read as well (the two before, for the
+        step and turn, and the start of that day, for the displacement)
+        but not rewritten. 0 rebuilds the whole table. Runs inside
+        whatever transaction is open and leaves the connection open.
 
-        sql_insert_obs = """
-            INSERT INTO tObservations (serialId, date, collarId, latitude, longitude, positionId)
-            VALUES (:serialId, :date, :collarId, :latitude, :longitude, :positionId);
+        Returns the number of fixes written.
         """
+        self._connect()
+        self.run_action("DROP TABLE IF EXISTS temp.tStageTails;", keep_open=True)
+        self.run_action("""
+            CREATE TEMP TABLE tStageTails (
+                serialId TEXT PRIMARY KEY,
+                from_epoch INTEGER,     -- rewritten from here on
+                context_epoch INTEGER   -- read from here on
+            )
+            ;""", keep_open=True)
+        self.run_action("""
+            INSERT INTO temp.tStageTails (serialId, from_epoch)
+            SELECT serialId, MIN(date_epoch)
+            FROM tObservations
+            WHERE obs_id > :obs_id_after
+              AND date_epoch IS NOT NULL
+              AND latitude IS NOT NULL AND longitude IS NOT NULL
+            GROUP BY serialId;
+            """, {"obs_id_after": obs_id_after}, keep_open=True)
+        self.run_action("""
+            UPDATE temp.tStageTails
+            SET context_epoch = MIN(
+                from_epoch - from_epoch % :day,
+                COALESCE((SELECT MIN(date_epoch) FROM (
+                              SELECT o.date_epoch
+                              FROM tObservations o
+                              WHERE o.serialId = tStageTails.serialId
+                                AND o.date_epoch < tStageTails.from_epoch
+                                AND o.latitude IS NOT NULL AND o.longitude IS NOT NULL
+                              ORDER BY o.date_epoch DESC
+                              LIMIT 2)),
+                         from_epoch));
+            """, {"day": SECONDS_PER_DAY}, keep_open=True)
 
-        for _, row in df.iterrows():
-            params = {
-                "serialId": row["serialId"],
-                "date": row["date"],  # already ISO string
-                "collarId": row["collarId"],
-                "latitude": float(row["latitude"]),
-                "longitude": float(row["longitude"]),
-                "positionId": row["positionId"],
-            }
+        fixes = self.run_query_columnar("""
+            SELECT o.obs_id, o.serialId, o.date_epoch, o.latitude, o.longitude, t.from_epoch
+            FROM temp.tStageTails t
+            JOIN tObservations o
+              ON o.serialId = t.serialId
+             AND o.date_epoch >= t.context_epoch
+            WHERE o.latitude IS NOT NULL AND o.longitude IS NOT NULL
+            ORDER BY t.serialId, o.date_epoch, o.obs_id;
+            """, dtypes={"obs_id": "int64", "serialId": "category",
+                         "date_epoch": "int64", "from_epoch": "int64"}, keep_open=True)
 
-            df_obs_exist = self.run_query(sql_select_obs,
-                                    {"serialId": params["serialId"],
-                                     "date": params["date"]}, keep_open = True)
+        metrics = movement_metrics(fixes["serialId"], fixes["date_epoch"],
+                                   fixes["latitude"], fixes["longitude"])
+        write = fixes["date_epoch"] >= fixes["from_epoch"]
+        serials = fixes.categories["serialId"][fixes["serialId"][write].astype(np.int64)]
+        # NaN goes in as NULL
+        columns = [np.where(np.isnan(metrics[name][write]), None, metrics[name][write]).tolist()
+                   for name in self.MOVEMENT_COLUMNS]
 
-            if df_obs_exist.empty:
-                self.run_action(sql_insert_obs, params, keep_open=True)
+        self.run_action("""
+            DELETE FROM tMovement
+            WHERE obs_id IN (SELECT m.obs_id
+                             FROM temp.tStageTails t
+                             JOIN tMovement m
+                               ON m.serialId = t.serialId
+                              AND m.date_epoch >= t.from_epoch);
+            """, keep_open=True)
+        written = self.run_many("""
+            INSERT OR REPLACE INTO tMovement
+                (obs_id, serialId, date_epoch, step_km, dt_s, speed_kmh,
+                 bearing_deg, turn_deg, day_displacement_km)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """, zip(fixes["obs_id"][write].tolist(), serials.tolist(),
+                     fixes["date_epoch"][write].tolist(), *columns),
+            keep_open=True)
 
-        self._commit_and_close()
-        return
\ No newline at end of file
+        self.run_action("DROP TABLE IF EXISTS temp.tStageTails;", keep_open=True)
+        return max(written, 0)
@@ -0,0 +1,365 @@
+import math
+import sqlite3
+
+'''
+Schema migrations for the Serengeti database, applied in order by
+BaseDB._migrate whenever a CWFACDB is opened. See BaseDB.MIGRATIONS
+for the format.
+
+Never edit or renumber a migration once it has been committed, databases
+out there have already recorded it as applied. Add a new one instead.
+
+Migrations only run SQL written out here, never CWFACDB methods such as
+_update_daily_summary: those follow the newest schema, a migration has to
+keep working on the schema as it was when the migration was written.
+'''
+
+# sqlite's math functions (sin, atan2, ...) are optional at compile time,
+# these stand in for them on builds without. NULL in gives NULL out like
+# the built in ones
+_MATH_FUNCTIONS = {
+    'sin': (1, math.sin),
+    'cos': (1, math.cos),
+    'asin': (1, math.asin),
+    'sqrt': (1, math.sqrt),
+    'radians': (1, math.radians),
+    'degrees': (1, math.degrees),
+    'atan2': (2, math.atan2),
+    'pow': (2, math.pow),
+    'mod': (2, math.fmod),
+}
+
+
+def _null_safe(func):
+    return lambda *args: None if None in args else func(*args)
+
+
+def register_math_functions(conn: sqlite3.Connection) -> None:
+    '''
+    Add Python versions of the math functions the migrations use to conn.
+    '''
+    for name, (n_args, func) in _MATH_FUNCTIONS.items():
+        conn.create_function(name, n_args, _null_safe(func), deterministic=True)
+    return
+
+
+def _add_math_functions(db) -> None:
+    # db is the CWFACDB being migrated
+    try:
+        db._conn.execute("SELECT sin(0), cos(0), asin(0), sqrt(0), radians(0), degrees(0), "
+                         "atan2(0, 1), pow(0, 1), mod(0, 1);").fetchall()
+    except sqlite3.OperationalError:
+        register_math_functions(db._conn)
+    return
+
+
+# great circle distance in km between the points (lat1, lon1) and (lat2, lon2)
+# of a SELECT, same formula and earth radius as db_code.tracks.haversine_km.
+# Part of migrations 5 and 7, so the same rule applies: never change it
+def _haversine_sql(lat1: str, lon1: str, lat2: str, lon2: str) -> str:
+    return f'''2 * 6371.0088 * asin(sqrt(min(max(
+                   pow(sin((radians({lat2}) - radians({lat1})) / 2), 2)
+                   + cos(radians({lat1})) * cos(radians({lat2}))
+                     * pow(sin((radians({lon2}) - radians({lon1})) / 2), 2),
+               0.0), 1.0)))'''
+
+# tMovement for every existing fix, computed like db_code.tracks.movement_metrics.
+# Used by migrations 7 and 10. obs_id comes from the rowid, which is obs_id
+# itself once migration 9 has made it the INTEGER PRIMARY KEY
+_MOVEMENT_BACKFILL = f"""
+    INSERT INTO tMovement
+        (obs_id, serialId, date_epoch, step_km, dt_s, speed_kmh,
+         bearing_deg, turn_deg, day_displacement_km)
+    WITH fixes AS (
+        SELECT rowid AS obs_id, serialId, date_epoch, latitude, longitude,
+               LAG(latitude) OVER track AS prev_lat,
+               LAG(longitude) OVER track AS prev_lon,
+               LAG(date_epoch) OVER track AS prev_epoch,
+               FIRST_VALUE(latitude) OVER day AS day_lat,
+               FIRST_VALUE(longitude) OVER day AS day_lon
+        FROM tObservations
+        WHERE date_epoch IS NOT NULL
+          AND latitude IS NOT NULL AND longitude IS NOT NULL
+        WINDOW track AS (PARTITION BY serialId ORDER BY date_epoch, rowid),
+               day AS (PARTITION BY serialId, date_epoch - date_epoch % 86400
+                       ORDER BY date_epoch, rowid)
+    ),
+    steps AS (
+        SELECT obs_id, serialId, date_epoch, latitude, longitude, day_lat, day_lon,
+               date_epoch - prev_epoch AS dt_s,
+               {_haversine_sql('prev_lat', 'prev_lon', 'latitude', 'longitude')} AS step_km,
+               -- initial bearing, 0 to 360
+               mod(degrees(atan2(
+                   sin(radians(longitude) - radians(prev_lon)) * cos(radians(latitude)),
+                   cos(radians(prev_lat)) * sin(radians(latitude))
+                   - sin(radians(prev_lat)) * cos(radians(latitude))
+                     * cos(radians(longitude) - radians(prev_lon))
+               )) + 360.0, 360.0) AS bearing
+        FROM fixes
+    ),
+    bearings AS (
+        -- no direction when the animal didn't move
+        SELECT *, CASE WHEN step_km > 0 THEN bearing END AS bearing_deg
+        FROM steps
+    )
+    SELECT obs_id, serialId, date_epoch, step_km, dt_s,
+           CASE WHEN dt_s > 0 THEN step_km / (dt_s / 3600.0) END,
+           bearing_deg,
+           -- -180 to 180, NULL when either bearing is
+           mod(bearing_deg - LAG(bearing_deg) OVER (PARTITION BY serialId ORDER BY date_epoch, obs_id)
+               + 540.0, 360.0) - 180.0,
+           {_haversine_sql('day_lat', 'day_lon', 'latitude', 'longitude')}
+    FROM bearings
+    ;"""
+
+
+MIGRATIONS = [
+    (1, "index tAnimal.species_id for species filters", [
+        """
+        CREATE INDEX IF NOT EXISTS idx_tAnimal_species_id
+        ON tAnimal (species_id)
+        ;""",
+    ]),
+    (2, "covering index on tObservations for date filters and the map query", [
+        # the planner walks tAnimal and looks up each serial's date range, so
+        # (serialId, date) serves every date filter. The map columns ride along
+        # so the map query never has to visit the table itself
+        """
+        CREATE INDEX IF NOT EXISTS idx_tObservations_map
+        ON tObservations (serialId, date, latitude, longitude)
+        ;""",
+        # give the query planner row counts to choose between indexes with
+        "ANALYZE;",
+    ]),
+    (3, "R*Tree spatial index rtObservations for bounding box filters", [
+        # one point-sized box per observation, id is the tObservations rowid.
+        # _load_data adds the rows for new observations. tObservations has no
+        # INTEGER PRIMARY KEY yet, so a VACUUM could renumber rowids, migration
+        # 9 adds one (obs_id) and rebuilds this table on it
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS rtObservations USING rtree (
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        )
+        ;""",
+        """
+        INSERT INTO rtObservations (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT rowid, latitude, latitude, longitude, longitude
+        FROM tObservations
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ;""",
+    ]),
+    (4, "integer UTC epoch column tObservations.date_epoch for range filters", [
+        # date is whatever text the scraper returned, date_epoch is the same
+        # instant as whole seconds since 1970 UTC. sqlite's strftime copes with
+        # the trailing Z / +00:00 and fractional seconds. _load_data fills it
+        # for new rows
+        """
+        ALTER TABLE tObservations ADD COLUMN date_epoch INTEGER
+        ;""",
+        """
+        UPDATE tObservations
+        SET date_epoch = CAST(strftime('%s', date) AS INTEGER)
+        ;""",
+        # same covering index as migration 2 but on the epoch column, every
+        # date filter and sort now goes through date_epoch
+        """
+        DROP INDEX IF EXISTS idx_tObservations_map
+        ;""",
+        """
+        CREATE INDEX IF NOT EXISTS idx_tObservations_map_epoch
+        ON tObservations (serialId, date_epoch, latitude, longitude)
+        ;""",
+        "ANALYZE;",
+    ]),
+    (5, "per animal per day summary table tAnimalDaily", [
+        # one row per serial per UTC day (day_epoch is midnight), for the
+        # overview map. distance_km only adds up steps between fixes on the
+        # same day. _load_data recomputes the days that get new fixes
+        """
+        CREATE TABLE IF NOT EXISTS tAnimalDaily (
+            serialId TEXT NOT NULL REFERENCES tAnimal(serialId),
+            day_epoch INTEGER NOT NULL,
+            n_fixes INTEGER NOT NULL,
+            lat_mean FLOAT,
+            lon_mean FLOAT,
+            lat_min FLOAT,
+            lat_max FLOAT,
+            lon_min FLOAT,
+            lon_max FLOAT,
+            first_epoch INTEGER,
+            last_epoch INTEGER,
+            distance_km FLOAT,
+            PRIMARY KEY (serialId, day_epoch)
+        )
+        ;""",
+        # every existing day, computed like db_code.tracks.daily_summary
+        _add_math_functions,
+        f"""
+        INSERT INTO tAnimalDaily
+            (serialId, day_epoch, n_fixes, lat_mean, lon_mean, lat_min, lat_max,
+             lon_min, lon_max, first_epoch, last_epoch, distance_km)
+        WITH fixes AS (
+            SELECT serialId, date_epoch, latitude, longitude,
+                   date_epoch - date_epoch % 86400 AS day_epoch,
+                   LAG(latitude) OVER day AS prev_lat,
+                   LAG(longitude) OVER day AS prev_lon
+            FROM tObservations
+            WHERE date_epoch IS NOT NULL
+              AND latitude IS NOT NULL AND longitude IS NOT NULL
+            WINDOW day AS (PARTITION BY serialId, date_epoch - date_epoch % 86400
+                           ORDER BY date_epoch, rowid)
+        )
+        SELECT serialId, day_epoch, COUNT(*),
+               AVG(latitude), AVG(longitude),
+               MIN(latitude), MAX(latitude), MIN(longitude), MAX(longitude),
+               MIN(date_epoch), MAX(date_epoch),
+               -- the first fix of the day has no step, TOTAL skips it and gives 0.0 for one fix
+               TOTAL({_haversine_sql('prev_lat', 'prev_lon', 'latitude', 'longitude')})
+        FROM fixes
+        GROUP BY serialId, day_epoch
+        ;""",
+    ]),
+    (6, "validators of the last loaded download, tDownloadState", [
+        # ETag / Last-Modified the server sent with the last records.json that
+        # made it into the database, sent back on the next scrape so an
+        # unchanged file isn't downloaded again. _load_data writes it in the
+        # same transaction as the data
+        """
+        CREATE TABLE IF NOT EXISTS tDownloadState (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            updated_at TIMESTAMP
+        )
+        ;""",
+    ]),
+    (7, "per fix movement metrics table tMovement", [
+        # step length, speed, turning angle and displacement since the start
+        # of the day for every fix with a position, against the animal's fix
+        # before it. obs_id is the fix's rowid in tObservations (the table is
+        # rebuilt on obs_id by migration 10). _load_data recomputes each
+        # animal's track from its earliest new fix onwards
+        """
+        CREATE TABLE IF NOT EXISTS tMovement (
+            obs_id INTEGER PRIMARY KEY,
+            serialId TEXT NOT NULL REFERENCES tAnimal(serialId),
+            date_epoch INTEGER NOT NULL,
+            step_km FLOAT,
+            dt_s INTEGER,
+            speed_kmh FLOAT,
+            bearing_deg FLOAT,
+            turn_deg FLOAT,
+            day_displacement_km FLOAT
+        )
+        ;""",
+        # the tail of a track, for the recompute and the daily overview filter
+        """
+        CREATE INDEX IF NOT EXISTS idx_tMovement_serial_epoch
+        ON tMovement (serialId, date_epoch)
+        ;""",
+        # speed filters
+        """
+        CREATE INDEX IF NOT EXISTS idx_tMovement_speed
+        ON tMovement (speed_kmh)
+        ;""",
+        # every existing fix, computed like db_code.tracks.movement_metrics
+        _add_math_functions,
+        _MOVEMENT_BACKFILL,
+    ]),
+    (8, "time first index on tObservations for scene matching", [
+        # fixes in a time window and a bounding box, read from the index
+        # alone (see app_functions/scenes.py)
+        """
+        CREATE INDEX IF NOT EXISTS idx_tObservations_time
+        ON tObservations (date_epoch, latitude, longitude)
+        ;""",
+        "ANALYZE;",
+    ]),
+    (9, "explicit obs_id INTEGER PRIMARY KEY on tObservations, R*Tree keyed on it", [
+        # rtObservations.id (and tMovement.obs_id) pointed at the implicit
+        # rowid, which a VACUUM is free to renumber in a table without an
+        # INTEGER PRIMARY KEY. obs_id is that key, copied from the rowid so
+        # nothing pointing at a fix changes now, and never renumbered after.
+        # (serialId, date) stays unique. obs_id first, then the old columns
+        # in their old order
+        """
+        CREATE TABLE tObservations_new (
+            obs_id INTEGER PRIMARY KEY,
+            serialId TEXT NOT NULL REFERENCES tAnimal(serialId),
+            date TIMESTAMP,
+            collarId TEXT NOT NULL,
+            latitude FLOAT,
+            longitude FLOAT,
+            positionId TEXT NOT NULL,
+            date_epoch INTEGER,
+            UNIQUE (serialId, date)
+        )
+        ;""",
+        """
+        INSERT INTO tObservations_new
+            (obs_id, serialId, date, collarId, latitude, longitude, positionId, date_epoch)
+        SELECT rowid, serialId, date, collarId, latitude, longitude, positionId, date_epoch
+        FROM tObservations
+        ORDER BY rowid
+        ;""",
+        "DROP TABLE tObservations;",
+        "ALTER TABLE tObservations_new RENAME TO tObservations;",
+        # the indexes of migrations 4 and 8 went with the old table
+        """
+        CREATE INDEX IF NOT EXISTS idx_tObservations_map_epoch
+        ON tObservations (serialId, date_epoch, latitude, longitude)
+        ;""",
+        """
+        CREATE INDEX IF NOT EXISTS idx_tObservations_time
+        ON tObservations (date_epoch, latitude, longitude)
+        ;""",
+        # rebuilt rather than trusted, in case a VACUUM already ran
+        "DROP TABLE IF EXISTS rtObservations;",
+        """
+        CREATE VIRTUAL TABLE rtObservations USING rtree (
+            id,
+            min_lat, max_lat,
+            min_lon, max_lon
+        )
+        ;""",
+        """
+        INSERT INTO rtObservations (id, min_lat, max_lat, min_lon, max_lon)
+        SELECT obs_id, latitude, latitude, longitude, longitude
+        FROM tObservations
+        WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ;""",
+        "ANALYZE;",
+    ]),
+    (10, "tMovement keyed on tObservations.obs_id", [
+        # tMovement.obs_id was the tObservations rowid as well. Recomputed
+        # rather than carried over, in case a VACUUM renumbered the rowids
+        # before migration 9 pinned them
+        "DROP TABLE IF EXISTS tMovement;",
+        """
+        CREATE TABLE tMovement (
+            obs_id INTEGER PRIMARY KEY REFERENCES tObservations(obs_id),
+            serialId TEXT NOT NULL REFERENCES tAnimal(serialId),
+            date_epoch INTEGER NOT NULL,
+            step_km FLOAT,
+            dt_s INTEGER,
+            speed_kmh FLOAT,
+            bearing_deg FLOAT,
+            turn_deg FLOAT,
+            day_displacement_km FLOAT
+        )
+        ;""",
+        """
+        CREATE INDEX IF NOT EXISTS idx_tMovement_serial_epoch
+        ON tMovement (serialId, date_epoch)
+        ;""",
+        """
+        CREATE INDEX IF NOT EXISTS idx_tMovement_speed
+        ON tMovement (speed_kmh)
+        ;""",
+        _add_math_functions,
+        _MOVEMENT_BACKFILL,
+        "ANALYZE;",
+    ]),
+]
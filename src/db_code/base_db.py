@@ -3,9 +3,13 @@
 
 import os
 import sqlite3
+import threading
 import numpy as np
 import pandas as pd
 
+from db_code.connection_manager import CONNECTIONS, ConnectionManager
+from db_code.columnar import ColumnarResult, fetch_columnar
+
 # telling sqlite when you see something of first datatype, do this function
 sqlite3.register_adapter(np.int64, lambda x: int(x))
 # so when see np.int64 turn into native python int
@@ -17,9 +21,42 @@ class BaseDB:
     This class contains code that can be used with any sqlite database. Or at least, that's what it's designed to do.
     '''
 
+    # Named connection profiles. Each one is a set of PRAGMAs applied every time a
+    # connection is opened. 'default' leaves sqlite alone (plain rollback journal).
+    # WAL lets readers keep reading while a writer is busy, and is remembered by the
+    # database file itself once set.
+    PROFILES = {
+        'default': {},
+        'ingest': {
+            'busy_timeout': 30000,     # ms, wait for readers/writers instead of failing
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',   # safe with WAL, skips an fsync per commit
+            'cache_size': -65536,      # negative means KiB, so 64 MB
+            'mmap_size': 268435456,    # 256 MB
+            'temp_store': 'MEMORY',    # staging tables live in memory
+        },
+        'interactive-read': {
+            'busy_timeout': 5000,
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'cache_size': -16384,      # 16 MB
+            'mmap_size': 268435456,
+            'temp_store': 'MEMORY',
+        },
+    }
+
+    # Ordered schema migrations, filled in by subclasses. Each one is a tuple of
+    # (version, description, steps) where a step is either a SQL string or a
+    # function that takes this object and runs its own SQL with keep_open=True.
+    # Pending migrations are applied in order every time the database is opened,
+    # and recorded in tSchemaVersion.
+    MIGRATIONS = []
+
     def __init__(self,
                  path: str,
-                 create: bool = False
+                 create: bool = False,
+                 profile: str = 'default',
+                 manager: ConnectionManager = None
                 ):
         '''
         Arguments
@@ -28,7 +65,22 @@ class BaseDB:
             create: If the databse does not exist, it will be created
                     if this is set to True, otherwise a FileNotFound
                     error will be raised.
+
+            profile: Name of the connection profile (see PROFILES) used
+                    when connecting to the database.
+
+            manager: ConnectionManager to borrow connections from, defaults
+                    to the shared one in connection_manager.
         '''
+        if profile not in self.PROFILES:
+            raise ValueError(f'unknown connection profile {profile}, expected one of {list(self.PROFILES)}')
+        self.profile = profile
+        self.manager = manager if manager is not None else CONNECTIONS
+
+        # connection state is kept per thread so one object can be shared
+        # between the Dash callback threads
+        self._local = threading.local()
+
         self.path = path # needs to occur BEFORE things that use it, such as self._check_exists
         #set to not connected by default
         self._connected = False
@@ -42,8 +94,36 @@ class BaseDB:
             # whenever have new data to load into databse, so wouldn't include create tables AND
             # load data
 
+        # brings old database files up to date, and new ones up to the same point
+        self._migrate()
+
         return
 
+    # _conn, _curs and _connected read and write the current thread's state
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        return self._local.conn
+
+    @_conn.setter
+    def _conn(self, value) -> None:
+        self._local.conn = value
+
+    @property
+    def _curs(self) -> sqlite3.Cursor:
+        return self._local.curs
+
+    @_curs.setter
+    def _curs(self, value) -> None:
+        self._local.curs = value
+
+    @property
+    def _connected(self) -> bool:
+        return getattr(self._local, 'connected', False)
+
+    @_connected.setter
+    def _connected(self, value: bool) -> None:
+        self._local.connected = value
+
     def _create_tables(self) -> None:
 
         # needs to be in format of:
@@ -58,6 +138,81 @@ class BaseDB:
 
         return
 
+    def _migrate(self) -> None:
+        '''
+        Apply any migrations in MIGRATIONS newer than the version recorded
+        in tSchemaVersion. Each migration runs in its own transaction, so a
+        failure leaves the database at the last good version.
+        '''
+        if not self.MIGRATIONS:
+            return
+
+        self._connect(profile='ingest')
+
+        # a plain read without any lock first, almost every open has nothing
+        # to apply and shouldn't have to wait for a writer (a scrape) to finish
+        exists = self.run_query("""
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tSchemaVersion';
+            """, keep_open=True)
+        current = 0
+        if not exists.empty:
+            version = self.run_query("SELECT MAX(version) AS version FROM tSchemaVersion;",
+                                     keep_open=True).iloc[0]["version"]
+            current = 0 if pd.isnull(version) else int(version)
+        pending = [m for m in sorted(self.MIGRATIONS, key=lambda m: m[0]) if m[0] > current]
+        if not pending:
+            self._close()
+            return
+
+        self.run_action("""
+            CREATE TABLE IF NOT EXISTS tSchemaVersion (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL
+            )
+            ;""", commit=True, keep_open=True)
+
+        for version, description, steps in pending:
+            # IMMEDIATE takes the write lock before checking again, so two
+            # processes opening the database at once can't both apply the same
+            # migration
+            self.run_action("BEGIN IMMEDIATE;", keep_open=True)
+            applied = self.run_query("SELECT 1 FROM tSchemaVersion WHERE version = :version;",
+                                     {"version": version}, keep_open=True)
+            if not applied.empty:
+                self._conn.rollback()
+                continue
+
+            print(f"applying migration {version}: {description}")
+            try:
+                for step in steps:
+                    if callable(step):
+                        step(self)
+                    else:
+                        self.run_action(step, keep_open=True)
+                self.run_action("""
+                    INSERT INTO tSchemaVersion (version, description, applied_at)
+                    VALUES (:version, :description, datetime('now'));
+                    """, {"version": version, "description": description}, keep_open=True)
+            except Exception:
+                # run_action has already rolled back and closed if it was the one that failed
+                if self._connected:
+                    self._conn.rollback()
+                    self._close()
+                raise
+            self._conn.commit()
+
+        self._close()
+        return
+
+    def schema_version(self) -> int:
+        '''
+        The newest migration applied to this database (0 if none).
+        '''
+        result = self.run_query("SELECT MAX(version) AS version FROM tSchemaVersion;")
+        version = result.iloc[0]["version"]
+        return 0 if pd.isnull(version) else int(version)
+
     def _load_data(self) -> None:
         # format of following for every table
         # tSong = pd.read_csv(self.PATH_SONG)
@@ -75,29 +230,71 @@ class BaseDB:
         return
 
     def _connect(self,
-                  foreign_keys: bool = True) -> None:
+                  foreign_keys: bool = True,
+                  profile: str = None) -> None:
         '''
         Establish a connection to the databse and create a cursor. If
         a connection is already opened, will not open a new one.
 
         If foreign_keys is set to False, foreign key constraints will
         not be enabled
+
+        profile picks the connection profile to apply, defaults to the
+        one this object was created with.
         '''
 
         if not self._connected:
-            self._conn = sqlite3.connect(self.path)
+            key, self._conn = self._acquire(foreign_keys, profile)
+            self._local.key = key
             self._curs = self._conn.cursor()
-            if foreign_keys:
-                self._curs.execute("PRAGMA foreign_keys=ON;") # pragma is like a database rule
-                # never want more than one connection at once is really bad will get in trouble so... is within this if loop
             self._connected = True
         return
 
+    def _acquire(self,
+                 foreign_keys: bool = True,
+                 profile: str = None):
+        '''
+        Borrow a connection from the manager, which only opens a new one
+        (and runs the PRAGMAs) when it has no idle one for these settings.
+
+        Returns the pool key and the connection, the key is needed to
+        hand the connection back.
+        '''
+        if profile is None:
+            profile = self.profile
+        key = (os.path.abspath(self.path), profile, foreign_keys)
+        conn = self.manager.acquire(key, lambda: self._open_connection(foreign_keys, profile))
+        return key, conn
+
+    def _open_connection(self,
+                         foreign_keys: bool,
+                         profile: str) -> sqlite3.Connection:
+        '''
+        Open a brand new connection to the database with the given settings.
+        '''
+        # the manager hands connections between threads, never to two at once
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        if foreign_keys:
+            conn.execute("PRAGMA foreign_keys=ON;") # pragma is like a database rule
+        self._apply_profile(conn, profile)
+        return conn
+
+    def _apply_profile(self,
+                       conn: sqlite3.Connection,
+                       profile: str) -> None:
+        '''
+        Run the PRAGMAs of the named connection profile on a connection.
+        '''
+        for pragma, value in self.PROFILES[profile].items():
+            conn.execute(f"PRAGMA {pragma}={value};")
+        return
+
     def _close(self) -> None:
         '''
-        Close the database connection.
+        Give the database connection back to the connection manager.
+        Uncommitted changes are rolled back, as with closing it.
         '''
-        self._conn.close()
+        self.manager.release(self._local.key, self._conn)
         self._connected = False
         return
 
@@ -129,6 +326,8 @@ class BaseDB:
         n = len(path_parts)
         for i in range(n):
             part = os.sep.join(path_parts[:i+1])
+            if part == '':
+                continue # an absolute path starts with an empty part, the root always exists
             if not os.path.exists(part):
                 self._existed = False # doesnt exist so should i be creating things
                 if not create:
@@ -169,7 +368,120 @@ class BaseDB:
             if not keep_open:
                 self._close()
         return results
-        
+
+    def run_query_columnar(self,
+                           sql: str,
+                           params: dict = None,
+                           dtypes: dict = None,
+                           keep_open: bool = False
+                          ) -> ColumnarResult:
+        '''
+        Version of run_query for code that works on NumPy arrays. Rows go
+        straight from the cursor into typed NumPy arrays without pd.read_sql.
+
+        Arguments
+            sql: A string containing SQL code
+            params: Optional dictionary of query parameters
+            dtypes: Optional column name -> type ('float64', 'int64', 'epoch',
+                        'category' or 'object'), see db_code/columnar.py
+            keep_open: If True, database connection will remain open
+                        after running the query (default is False).
+
+        Returns a ColumnarResult, call .to_frame() on it for a DataFrame.
+        '''
+        self._connect()
+        curs = self._conn.cursor()
+        try:
+            if params is None:
+                curs.execute(sql)
+            else:
+                curs.execute(sql, params)
+            results = fetch_columnar(curs, dtypes)
+        except Exception as e:
+            raise type(e)(f'sql: {sql}\n params: {params}') from e
+        finally:
+            curs.close()
+            if not keep_open:
+                self._close()
+        return results
+
+    def iter_query(self,
+                   sql: str,
+                   params: dict = None,
+                   chunksize: int = 50000,
+                   kind: str = 'dataframe',
+                   limit: int = None
+                  ):
+        '''
+        Streaming version of run_query, yields the results a chunk at a time
+        so memory use stays flat no matter how many rows match.
+
+        Arguments
+            sql: A string containing SQL code
+            params: Optional dictionary of query parameters
+            chunksize: Most rows in one chunk
+            kind: What each chunk is
+                    'dataframe' - a pandas DataFrame
+                    'records' - a NumPy record array
+                    'tuples' - a list of row tuples straight from sqlite
+            limit: Stop after this many rows in total (default is no limit)
+
+        An empty result (or limit 0) yields one empty chunk, so the column
+        names are still known. If this thread already has the connection open
+        (keep_open from an earlier call) that one is used, otherwise a
+        connection is borrowed just for this generator and handed back
+        when it is used up or closed.
+        '''
+        if kind not in ('dataframe', 'records', 'tuples'):
+            raise ValueError(f"kind must be 'dataframe', 'records' or 'tuples', not {kind}")
+
+        # not tied to this thread's _conn, the generator may be finished or
+        # garbage collected from somewhere else
+        if self._connected:
+            key, conn = None, self._conn
+        else:
+            key, conn = self._acquire()
+        # a cursor of our own so other calls on this connection don't reset it
+        curs = conn.cursor()
+        try:
+            try:
+                if params is None:
+                    curs.execute(sql)
+                else:
+                    curs.execute(sql, params)
+            except Exception as e:
+                raise type(e)(f'sql: {sql}\n params: {params}') from e
+            columns = [d[0] for d in curs.description]
+
+            remaining = limit
+            first = True
+            while True:
+                size = chunksize if remaining is None else min(chunksize, remaining)
+                # limit 0 still gives the one empty chunk
+                rows = curs.fetchmany(size) if size > 0 else []
+                if not rows and not first:
+                    break
+                first = False
+                if remaining is not None:
+                    remaining -= len(rows)
+
+                if kind == 'dataframe':
+                    yield pd.DataFrame.from_records(rows, columns=columns)
+                elif kind == 'records':
+                    if rows:
+                        yield np.rec.fromrecords(rows, names=columns)
+                    else:
+                        yield np.rec.fromarrays([np.array([])] * len(columns), names=columns)
+                else:
+                    yield rows
+                if not rows or remaining == 0:
+                    break
+        finally:
+            curs.close()
+            if key is not None:
+                self.manager.release(key, conn)
+        return
+
     def run_action(self,
                    sql: str,
                    params: dict = None,
@@ -206,6 +518,40 @@ class BaseDB:
             self._close()
         return self._curs.lastrowid
 
+    def run_many(self,
+                 sql: str,
+                 seq_of_params,
+                 commit: bool = False,
+                 keep_open: bool = False
+                ) -> int:
+        '''
+        Arguments
+            sql: A string containing SQL code
+            seq_of_params: An iterable of dictionaries (or tuples) of
+                        query parameters, the sql is run once per item
+            commit: If True, changes will be immediately committed
+            keep_open: If True, database connection will remain open
+                        after running the query (default is False).
+
+        Returns the rowcount property of the cursor (the total number of
+        rows modified by all the executions)
+        '''
+        # same as run_action but hands the whole batch to sqlite at once
+        self._connect()
+        try:
+            self._curs.executemany(sql, seq_of_params)
+            if commit:
+                self._conn.commit()
+        except Exception as e:
+            self._conn.rollback()
+            self._close()
+            raise type(e)(f'sql: {sql}\nparams: executemany batch') from e
+
+        rowcount = self._curs.rowcount
+        if not keep_open:
+            self._close()
+        return rowcount
+
 
         # as playing around with databases moving forward could add more code, but this is bare minimum, almost all is in billboard
         # dont just copy and paste from billboard.py
\ No newline at end of file
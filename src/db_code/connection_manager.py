@@ -0,0 +1,148 @@
+import atexit
+import sqlite3
+import threading
+
+'''
+Keeps sqlite connections open between calls instead of opening and closing
+a fresh one for every query.
+
+Connections are pooled per (database path, connection profile, foreign keys).
+A thread checks a connection out when BaseDB._connect is called and hands
+it back on BaseDB._close, so one connection is only ever used by one thread
+at a time, but the Dash worker threads (which come and go per request) all
+share the same few open connections.
+'''
+
+class ConnectionManager:
+    '''
+    A bounded pool of open sqlite connections.
+    '''
+
+    def __init__(self,
+                 max_connections: int = 8,
+                 acquire_timeout: float = 30.0
+                ):
+        '''
+        Arguments
+            max_connections: Most connections that can be open at once
+                        for one (path, profile) key.
+            acquire_timeout: Seconds to wait for a free connection before
+                        raising a TimeoutError.
+        '''
+        self.max_connections = max_connections
+        self.acquire_timeout = acquire_timeout
+
+        self._lock = threading.Lock()
+        self._idle = {}   # key -> list of idle connections
+        # key -> semaphore counting checked out connections. A new connection is
+        # only opened when there are no idle ones, so checked out + idle never
+        # goes above max_connections either
+        self._slots = {}
+        self._closed = False
+        return
+
+    def _slot(self, key) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._slots:
+                self._slots[key] = threading.BoundedSemaphore(self.max_connections)
+                self._idle[key] = []
+            return self._slots[key]
+
+    @staticmethod
+    def _healthy(conn: sqlite3.Connection) -> bool:
+        '''
+        Cheap check that a pooled connection is still usable.
+        '''
+        try:
+            conn.execute("SELECT 1;").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def acquire(self,
+                key,
+                factory) -> sqlite3.Connection:
+        '''
+        Check out a connection for key, reusing an idle one when possible.
+
+        Arguments
+            key: Hashable identifying the database and profile
+            factory: Function with no arguments that opens a new connection
+                        for key when there is no idle one.
+        '''
+        if self._closed:
+            raise RuntimeError('connection manager has been shut down')
+
+        slot = self._slot(key)
+        if not slot.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f'no free database connection for {key} after {self.acquire_timeout} seconds')
+
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle[key].pop() if self._idle[key] else None
+                if conn is None:
+                    return factory()
+                if self._healthy(conn):
+                    return conn
+                # stale connection, drop it and try the next one
+                self._discard(conn)
+        except Exception:
+            slot.release()
+            raise
+
+    def release(self,
+                key,
+                conn: sqlite3.Connection) -> None:
+        '''
+        Hand a connection back to the pool. Anything not committed is
+        rolled back, same as closing a plain connection would do.
+        '''
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            keep = not self._closed
+        except sqlite3.Error:
+            keep = False
+
+        if keep:
+            with self._lock:
+                self._idle[key].append(conn)
+        else:
+            self._discard(conn)
+        self._slots[key].release()
+        return
+
+    @staticmethod
+    def _discard(conn: sqlite3.Connection) -> None:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        return
+
+    def close_all(self) -> None:
+        '''
+        Close every idle connection and stop handing out new ones. Connections
+        still checked out are closed when they are released.
+        '''
+        with self._lock:
+            self._closed = True
+            idle = [conn for conns in self._idle.values() for conn in conns]
+            for conns in self._idle.values():
+                conns.clear()
+        for conn in idle:
+            self._discard(conn)
+        return
+
+    def stats(self) -> dict:
+        '''
+        Number of idle connections per key, handy for debugging.
+        '''
+        with self._lock:
+            return {key: len(conns) for key, conns in self._idle.items()}
+
+
+# shared by every BaseDB unless one is passed in explicitly
+CONNECTIONS = ConnectionManager()
+atexit.register(CONNECTIONS.close_all)
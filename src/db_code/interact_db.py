@@ -1,9 +1,12 @@
 import os
 import sqlite3
+import threading
+import uuid
 import numpy as np
 import pandas as pd
 
 from db_code.CWFAC_db import CWFACDB
+from db_code.query_cache import HANDLES, RESULTS, QueryCache
 
 '''
 This file is designed to re-work interaction with the database 
@@ -19,25 +22,252 @@ to prevent user error.
 
 PATH_TO_DB = os.path.join('db_code','databasefile')
 
+# One CWFACDB per (path, profile), made the first time it is needed.
+# Building one checks the path exists, after that every call reuses it
+# and borrows an already open connection from the connection manager.
+_DBS = {}
+_DBS_LOCK = threading.Lock()
+
+def _get_db(path_string: str,
+            profile: str) -> CWFACDB:
+    key = (os.path.abspath(path_string), profile)
+    with _DBS_LOCK:
+        if key not in _DBS:
+            _DBS[key] = CWFACDB(path = path_string,
+                                create = False,
+                                profile = profile
+                )
+        return _DBS[key]
+
 def add_new(data_DF:pd.DataFrame,
-            path_string = PATH_TO_DB) -> None:
+            path_string = PATH_TO_DB) -> dict:
+    '''
+    Load newly scraped data into the database. Returns the per-table
+    inserted/updated counts from CWFACDB._load_data.
+    '''
 
-    db = CWFACDB(path = path_string,
-                 create = False
-        )
-    db._load_data(df = data_DF)
+    db = _get_db(path_string, profile = 'ingest')
+    counts = db._load_data(df = data_DF)
     
+    return counts
+
+def save_download_state(url: str,
+                        state: dict,
+                        path_string = PATH_TO_DB) -> None:
+    '''
+    Remember the validators ({'etag': ..., 'last_modified': ...}) of a
+    download of url that has been fully loaded, see download_state. Only
+    writes tDownloadState, the query caches are left alone.
+    '''
+
+    db = _get_db(path_string, profile = 'ingest')
+    db._save_download_state(url, state)
     return
 
+def mark_scraped(url: str,
+                 serialIds,
+                 path_string = PATH_TO_DB) -> int:
+    '''
+    Record that url has just been scraped: every animal in the download
+    (serialIds, whether it had new fixes or not) gets its last_scraped
+    moved on, and so does tDownloadState.updated_at of url, also after a
+    download that hadn't changed (serialIds empty). Returns the number of
+    animals updated, see CWFACDB._mark_scraped.
+    '''
+
+    db = _get_db(path_string, profile = 'ingest')
+    return db._mark_scraped(url, serialIds)
+
+def last_scraped(path_string = PATH_TO_DB):
+    '''
+    ISO time of the last finished scrape, the newest of tAnimal.last_scraped
+    and tDownloadState.updated_at, or None if there has never been one.
+    '''
+    df = read_db("""
+        SELECT MAX(last) AS last FROM (
+            SELECT MAX(last_scraped) AS last FROM tAnimal
+            UNION ALL
+            SELECT MAX(updated_at) FROM tDownloadState
+        )
+        ;""", path_string = path_string)
+    return df.iloc[0]['last']
+
+def known_species(path_string = PATH_TO_DB) -> dict:
+    '''
+    serialId -> species_name for every animal whose species is already
+    known (not 'unknown'), so the scraper can skip their track pages.
+    A collared animal's species doesn't change.
+    '''
+    df = read_db("""
+        SELECT tAnimal.serialId, tSpecies.species_name
+        FROM tAnimal
+        JOIN tSpecies ON tAnimal.species_id = tSpecies.species_id
+        WHERE tSpecies.species_name <> 'unknown'
+        ;""", path_string = path_string)
+    return dict(zip(df['serialId'], df['species_name']))
+
+def download_state(url: str,
+                   path_string = PATH_TO_DB) -> dict:
+    '''
+    {'etag': ..., 'last_modified': ...} of the last download of url that was
+    loaded, or None if there hasn't been one. See webscraping.fetch_records.
+    '''
+    df = read_db("""
+        SELECT etag, last_modified
+        FROM tDownloadState
+        WHERE url = :url
+        ;""", {"url": url}, path_string = path_string)
+    if df.empty:
+        return None
+    return df.iloc[0].to_dict()
+
+def high_water_marks(path_string = PATH_TO_DB) -> dict:
+    '''
+    serialId -> date_epoch of its latest fix in tObservations, so the
+    scraper can drop fixes it already has (see webscraping.keep_new).
+    '''
+    df = read_db("""
+        SELECT serialId, MAX(date_epoch) AS date_epoch
+        FROM tObservations
+        GROUP BY serialId
+        ;""", path_string = path_string)
+    return dict(zip(df['serialId'], df['date_epoch']))
+
 def read_db(sql:str,
             params: dict = None,
-            path_string = PATH_TO_DB) -> pd.DataFrame:
+            path_string = PATH_TO_DB,
+            cache: bool = False) -> pd.DataFrame:
+    '''
+    Run a query and return the results as a DataFrame.
 
-    db = CWFACDB(path = path_string,
-                 create = False
-        )
+    If cache is True the result is looked up in / saved to the in-process
+    query cache (db_code/query_cache.py), which is emptied after every ingest.
+    '''
+
+    db = _get_db(path_string, profile = 'interactive-read')
+
+    if cache:
+        key = QueryCache.make_key(sql, params, scope = os.path.abspath(path_string))
+        cached = RESULTS.get(key)
+        if cached is not None:
+            return cached
+        # read before running the query, see QueryCache.put
+        generation = RESULTS.generation
     
     query_run = db.run_query(sql = sql, params = params)
 
+    if cache:
+        RESULTS.put(key, query_run, generation)
+
     return(query_run)
 
+def cache_stats() -> dict:
+    '''
+    Hit / miss / eviction counters of the read_db query cache.
+    '''
+    return RESULTS.stats()
+
+def store_result(df: pd.DataFrame) -> str:
+    '''
+    Keep a query result on the server and return an opaque handle for it,
+    so the dashboard only has to send the handle to the browser.
+    '''
+    handle = uuid.uuid4().hex
+    HANDLES.put(handle, df, HANDLES.generation)
+    return handle
+
+def resolve_result(handle: str,
+                   sql: str = None,
+                   params: dict = None,
+                   path_string = PATH_TO_DB,
+                   row_filter = None) -> pd.DataFrame:
+    '''
+    The result stored under handle. If it has been evicted (or the server
+    restarted) and sql is given, the query is run again (through row_filter
+    if given, as in write_csv) and stored back under the same handle.
+    Returns None if there is nothing to go on.
+    '''
+    df = HANDLES.get(handle) if handle else None
+    if df is None and sql:
+        df = read_db(sql, params, path_string = path_string, cache = True)
+        if row_filter is not None:
+            df = row_filter(df)
+        if handle:
+            HANDLES.put(handle, df, HANDLES.generation)
+    return df
+
+
+
+def read_db_columnar(sql:str,
+                     params: dict = None,
+                     dtypes: dict = None,
+                     path_string = PATH_TO_DB):
+    '''
+    Columnar fetch mode of read_db for code that works on NumPy arrays
+    (the daily summary and movement updates, scenes.py, interpolation.py and
+    proximity.py). Returns a ColumnarResult (NumPy arrays per column, floats
+    as float64, dates as int64 epoch seconds, ids as category codes) instead
+    of a DataFrame, call .to_frame() on it when a DataFrame is really needed.
+    Not faster than read_db end to end, but about 1/6 of the memory.
+    '''
+
+    db = _get_db(path_string, profile = 'interactive-read')
+
+    return db.run_query_columnar(sql = sql, params = params, dtypes = dtypes)
+
+def stream_db(sql:str,
+              params: dict = None,
+              chunksize: int = 50000,
+              kind: str = 'dataframe',
+              limit: int = None,
+              path_string = PATH_TO_DB):
+    '''
+    Like read_db but yields the results in chunks of at most chunksize rows.
+    kind is 'dataframe', 'records' (NumPy record arrays) or 'tuples',
+    see BaseDB.iter_query.
+    '''
+
+    db = _get_db(path_string, profile = 'interactive-read')
+
+    yield from db.iter_query(sql = sql, params = params, chunksize = chunksize,
+                             kind = kind, limit = limit)
+
+def write_csv(sql:str,
+              params: dict = None,
+              file = None,
+              chunksize: int = 50000,
+              path_string = PATH_TO_DB,
+              row_filter = None) -> int:
+    '''
+    Run a query and write the results as CSV to file (a path or an open
+    text file) one chunk at a time, so the full result is never in memory.
+    row_filter, if given, is called on each chunk DataFrame and returns the
+    rows of it to write. Returns the number of rows written.
+    '''
+    n_rows = 0
+    header = True
+    for chunk in stream_db(sql, params, chunksize = chunksize, path_string = path_string):
+        if row_filter is not None:
+            chunk = row_filter(chunk)
+        # header only on the first chunk, an empty result still writes the header
+        chunk.to_csv(file, header = header, index = False, mode = 'w' if header else 'a')
+        header = False
+        n_rows += len(chunk)
+    return n_rows
+
+def iter_csv(sql:str,
+             params: dict = None,
+             chunksize: int = 50000,
+             path_string = PATH_TO_DB,
+             row_filter = None):
+    '''
+    Like write_csv but yields the CSV text one chunk at a time instead of
+    writing it, for sending straight to a web response. The first piece
+    has the header, an empty result still yields it.
+    '''
+    header = True
+    for chunk in stream_db(sql, params, chunksize = chunksize, path_string = path_string):
+        if row_filter is not None:
+            chunk = row_filter(chunk)
+        yield chunk.to_csv(header = header, index = False)
+        header = False
@@ -0,0 +1,150 @@
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+'''
+In-process cache of query results, so pressing "Run query" again with the
+same filters doesn't go back to the database.
+
+Entries are keyed on the normalized (sql, params), evicted least recently
+used first once their total memory footprint goes over the limit, and all
+dropped whenever the data generation changes. _load_data bumps the
+generation after every ingest, so a cached result is never older than the
+data in the database (as long as all writes go through this process).
+'''
+
+class QueryCache:
+    '''
+    A size-bounded LRU cache of query result DataFrames.
+    '''
+
+    def __init__(self,
+                 max_bytes: int = 256 * 1024 * 1024
+                ):
+        '''
+        Arguments
+            max_bytes: Most memory (as measured by DataFrame.memory_usage)
+                        the cached results may take up together.
+        '''
+        self.max_bytes = max_bytes
+        self.generation = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (DataFrame, size in bytes)
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+        return
+
+    @staticmethod
+    def _freeze(value):
+        # lists (e.g. from dcc.Store) aren't hashable
+        if isinstance(value, (list, tuple)):
+            return tuple(QueryCache._freeze(v) for v in value)
+        if isinstance(value, dict):
+            return tuple(sorted((k, QueryCache._freeze(v)) for k, v in value.items()))
+        return value
+
+    @staticmethod
+    def make_key(sql: str,
+                 params: dict = None,
+                 scope: str = None) -> tuple:
+        '''
+        Normalized cache key. Whitespace in the sql doesn't matter and
+        neither does the order of params. scope separates e.g. different
+        database files.
+        '''
+        return (scope, ' '.join(sql.split()), QueryCache._freeze(params or {}))
+
+    def get(self,
+            key: tuple) -> pd.DataFrame:
+        '''
+        The cached result for key, or None on a miss. Hands back a shallow
+        copy so callers can add or replace columns without touching the cache.
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0].copy(deep=False)
+
+    def put(self,
+            key: tuple,
+            df: pd.DataFrame,
+            generation: int) -> None:
+        '''
+        Cache df under key. generation is the value of self.generation read
+        before the query ran, if an ingest has happened since then the
+        result may already be stale and is not kept.
+        '''
+        size = int(df.memory_usage(deep=True, index=True).sum())
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (df, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+        return
+
+    def bump_generation(self) -> int:
+        '''
+        Mark the data as changed, every cached result is dropped.
+        Returns the new generation.
+        '''
+        with self._lock:
+            self.generation += 1
+            self._invalidations += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+            return self.generation
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        return
+
+    def stats(self) -> dict:
+        '''
+        Counters for sizing the cache.
+        '''
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'generation': self.generation,
+            }
+
+
+# the one cache read_db uses
+RESULTS = QueryCache()
+
+def bump_generation() -> int:
+    '''
+    Called after every ingest, see CWFACDB._load_data.
+    '''
+    return RESULTS.bump_generation()
+
+
+# results the dashboard has on screen, keyed by an opaque handle instead of
+# the query (see interact_db.store_result). Nothing bumps its generation, a
+# handle keeps pointing at what its query returned until it is evicted
+HANDLES = QueryCache(max_bytes = 512 * 1024 * 1024)
@@ -0,0 +1,186 @@
+import numpy as np
+
+'''
+NumPy helpers for working on animal tracks: arrays of fixes sorted by
+serial and then by time, as they come out of the map query.
+'''
+
+EARTH_RADIUS_KM = 6371.0088
+
+SECONDS_PER_DAY = 86400
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+    '''
+    Great circle distance in km between two sets of points, element by element.
+
+    Arguments
+        lat1, lon1: Degrees, arrays (or scalars) of the start points
+        lat2, lon2: Degrees, arrays (or scalars) of the end points
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def group_starts(*keys) -> np.ndarray:
+    '''
+    Positions where a new group starts in arrays already sorted by the keys,
+    i.e. where any of the keys differs from the row before. Always starts with 0
+    (empty if there are no rows).
+    '''
+    n = len(keys[0])
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    changed = np.zeros(n, dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(changed)
+
+
+def daily_summary(serials: np.ndarray,
+                  epochs: np.ndarray,
+                  lat: np.ndarray,
+                  lon: np.ndarray) -> dict:
+    '''
+    One row per (serial, UTC day) with fix count, centroid, bounding box,
+    first / last fix and the distance travelled between fixes inside that day.
+
+    Arguments
+        serials: serial of each fix (labels or category codes)
+        epochs: int64 seconds since 1970 UTC of each fix
+        lat, lon: position of each fix, no missing values
+        All four sorted by serial and then by time.
+
+    Returns a dict of equal length arrays:
+        serial, day_epoch, n_fixes, lat_mean, lon_mean, lat_min, lat_max,
+        lon_min, lon_max, first_epoch, last_epoch, distance_km
+    '''
+    days = epochs - epochs % SECONDS_PER_DAY
+    starts = group_starts(serials, days)
+    if len(starts) == 0:
+        names = ('serial', 'day_epoch', 'n_fixes', 'lat_mean', 'lon_mean', 'lat_min', 'lat_max',
+                 'lon_min', 'lon_max', 'first_epoch', 'last_epoch', 'distance_km')
+        return {name: np.empty(0) for name in names}
+    ends = np.append(starts[1:], len(epochs))
+    counts = ends - starts
+
+    # distance of each step, steps that cross into another bucket don't count
+    legs = np.zeros(len(epochs), dtype=np.float64)
+    legs[1:] = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    legs[starts] = 0.0
+
+    return {
+        'serial': serials[starts],
+        'day_epoch': days[starts],
+        'n_fixes': counts,
+        'lat_mean': np.add.reduceat(lat, starts) / counts,
+        'lon_mean': np.add.reduceat(lon, starts) / counts,
+        'lat_min': np.minimum.reduceat(lat, starts),
+        'lat_max': np.maximum.reduceat(lat, starts),
+        'lon_min': np.minimum.reduceat(lon, starts),
+        'lon_max': np.maximum.reduceat(lon, starts),
+        'first_epoch': epochs[starts],
+        'last_epoch': epochs[ends - 1],
+        'distance_km': np.add.reduceat(legs, starts),
+    }
+
+
+def bearing_deg(lat1, lon1, lat2, lon2) -> np.ndarray:
+    '''
+    Initial compass bearing in degrees (0 north, 90 east, up to 360) of the
+    great circle from the start points to the end points, element by element.
+    '''
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+def movement_metrics(serials: np.ndarray,
+                     epochs: np.ndarray,
+                     lat: np.ndarray,
+                     lon: np.ndarray) -> dict:
+    '''
+    Per fix movement since the animal's fix before it.
+
+    Arguments
+        serials: serial of each fix (labels or category codes)
+        epochs: int64 seconds since 1970 UTC of each fix
+        lat, lon: position of each fix, no missing values
+        All four sorted by serial and then by time.
+
+    Returns a dict of arrays, one value per fix, NaN where there is nothing
+    to compare with:
+        step_km: distance from the fix before
+        dt_s: seconds since the fix before
+        speed_kmh: step_km over dt_s (NaN when both fixes have the same time)
+        bearing_deg: direction of that step, NaN if the animal didn't move
+        turn_deg: change of direction from the step before, -180 to 180,
+                  positive is a turn clockwise (to the right)
+        day_displacement_km: straight line distance from the animal's first
+                             fix of that UTC day
+    '''
+    n = len(epochs)
+    epochs = np.asarray(epochs, dtype=np.int64)
+    # True where the fix before belongs to the same animal
+    has_prev = np.ones(n, dtype=bool)
+    has_prev[group_starts(serials)] = False
+
+    step = np.full(n, np.nan)
+    dt = np.full(n, np.nan)
+    bearing = np.full(n, np.nan)
+    step[1:] = haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    dt[1:] = epochs[1:] - epochs[:-1]
+    bearing[1:] = bearing_deg(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    step[~has_prev] = np.nan
+    dt[~has_prev] = np.nan
+    bearing[~has_prev | (step == 0)] = np.nan
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(dt > 0, step / (dt / 3600.0), np.nan)
+
+    # NaN bearings (first step, standing still) carry through to NaN turns
+    turn = np.full(n, np.nan)
+    turn[1:] = (bearing[1:] - bearing[:-1] + 180.0) % 360.0 - 180.0
+    turn[~has_prev] = np.nan
+
+    # first fix of each (animal, day) group, spread over the group
+    days = epochs - epochs % SECONDS_PER_DAY
+    day_starts = group_starts(serials, days)
+    first = np.repeat(day_starts, np.diff(np.append(day_starts, n)))
+    displacement = haversine_km(lat[first], lon[first], lat, lon)
+
+    return {
+        'step_km': step,
+        'dt_s': dt,
+        'speed_kmh': speed,
+        'bearing_deg': bearing,
+        'turn_deg': turn,
+        'day_displacement_km': displacement,
+    }
+
+
+def great_circle_interpolate(lat1, lon1, lat2, lon2, fraction) -> tuple:
+    '''
+    Points the given fraction of the way along the great circle from the
+    start points to the end points, element by element (0 gives the start,
+    1 the end). Returns (lat, lon) in degrees.
+    '''
+    lat1, lon1, lat2, lon2, f = np.broadcast_arrays(*(np.asarray(a, dtype=np.float64)
+                                                      for a in (lat1, lon1, lat2, lon2, fraction)))
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    # as unit vectors, the angle between them from the chord so short steps stay accurate
+    p = np.stack((np.cos(lat1) * np.cos(lon1), np.cos(lat1) * np.sin(lon1), np.sin(lat1)))
+    q = np.stack((np.cos(lat2) * np.cos(lon2), np.cos(lat2) * np.sin(lon2), np.sin(lat2)))
+    angle = 2 * np.arcsin(np.clip(np.linalg.norm(q - p, axis=0) / 2, 0.0, 1.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # straight line weights once the points are too close for the sines to be exact
+        tiny = angle < 1e-9
+        w1 = np.where(tiny, 1 - f, np.sin((1 - f) * angle) / np.sin(angle))
+        w2 = np.where(tiny, f, np.sin(f * angle) / np.sin(angle))
+    x, y, z = w1 * p + w2 * q
+    return np.degrees(np.arctan2(z, np.hypot(x, y))), np.degrees(np.arctan2(y, x))
@@ -0,0 +1,126 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from app_functions.downsample import lttb_indices
+from app_functions.geometry import PreparedShape, points_in_shape
+from app_functions.interpolation import TrackIndex
+from app_functions.proximity import close_pairs, find_close_pairs
+from db_code.CWFAC_db import CWFACDB
+from db_code.tracks import group_starts, haversine_km
+from tests.conftest import random_tracks
+
+'''
+Rough timings of the vectorised helpers against the simple way of doing the
+same thing, on made up tracks (see tests/conftest.py). The tests check they
+give the same answers, this only says how long each takes.
+
+From the src folder:
+    uv run python -m tests.benchmark --animals 50 --fixes 2000
+'''
+
+
+def _time(label: str, func, *args, repeat: int = 3):
+    # best of a few runs
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    print(f"  {label:<40} {best * 1000:10.1f} ms")
+    return result
+
+
+def _pairs_brute_force(serials, epochs, lat, lon, distance_km, window_s):
+    # every fix against every other one, a row at a time to keep memory down
+    found = 0
+    for k in range(len(epochs) - 1):
+        close = ((serials[k + 1:] != serials[k])
+                 & (np.abs(epochs[k + 1:] - epochs[k]) <= window_s)
+                 & (haversine_km(lat[k], lon[k], lat[k + 1:], lon[k + 1:]) <= distance_km))
+        found += int(np.count_nonzero(close))
+    return found
+
+
+def _lttb_per_track(x, y, starts, max_points):
+    # lttb_indices called once per animal instead of all tracks together
+    ends = np.append(starts[1:], len(x))
+    return [lttb_indices(x[s:e], y[s:e], [0], max_points) for s, e in zip(starts, ends)]
+
+
+def _positions_per_target(serials, epochs, lat, lon, targets, times):
+    # one searchsorted per target on that animal's own fixes
+    tracks = {}
+    for serial in np.unique(serials):
+        mine = serials == serial
+        order = np.argsort(epochs[mine], kind='stable')
+        tracks[serial] = (epochs[mine][order], lat[mine][order], lon[mine][order])
+    out = np.full(len(times), np.nan)
+    for k, (serial, t) in enumerate(zip(targets, times)):
+        e, la, _ = tracks[serial]
+        b = np.searchsorted(e, t, side='right') - 1
+        if 0 <= b < len(e) - 1:
+            out[k] = la[b] + (la[b + 1] - la[b]) * (t - e[b]) / (e[b + 1] - e[b])
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the track helpers on made up data")
+    parser.add_argument('--animals', type=int, default=30, help="number of animals")
+    parser.add_argument('--fixes', type=int, default=2000, help="fixes per animal")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    df = random_tracks(n_animals=args.animals, n_fixes=args.fixes, seed=args.seed)
+    df = df.sort_values(['serialId', 'date_epoch'], kind='stable', ignore_index=True)
+    serials = df['serialId'].to_numpy()
+    epochs = df['date_epoch'].to_numpy()
+    lat = df['latitude'].to_numpy()
+    lon = df['longitude'].to_numpy()
+    print(f"{len(df)} fixes of {args.animals} animals")
+
+    print("close pairs, 1 km and 30 minutes")
+    i, _ = _time("grid hash (close_pairs)", close_pairs, serials, epochs, lat, lon, 1.0, 1800)
+    # quadratic, only worth waiting for on small runs
+    if len(df) <= 20_000:
+        n = _time("every pair", _pairs_brute_force, serials, epochs, lat, lon, 1.0, 1800, repeat=1)
+        assert n == len(i)
+
+    print("LTTB, 200 points per animal")
+    starts = group_starts(serials)
+    _time("all tracks together (lttb_indices)", lttb_indices, lon, lat, starts, 200)
+    _time("one track at a time", _lttb_per_track, lon, lat, starts, 200)
+
+    print("points in a 2000 edge polygon")
+    angles = np.linspace(0, 2 * np.pi, 2000, endpoint=False)
+    radii = 0.3 * (1 + 0.2 * np.sin(angles * 17))
+    shape = [[np.column_stack((lon.mean() + radii * np.cos(angles), lat.mean() + radii * np.sin(angles)))]]
+    prepared = PreparedShape(shape)
+    _time("slabs (PreparedShape.contains)", prepared.contains, lon, lat)
+    _time("every edge (points_in_shape)", points_in_shape, lon, lat, shape, repeat=1)
+
+    print("interpolated positions, 20000 targets")
+    rng = np.random.default_rng(args.seed)
+    targets = rng.choice(np.unique(serials), 20000)
+    times = rng.integers(epochs.min(), epochs.max(), 20000)
+    index = _time("build TrackIndex", TrackIndex, serials, epochs, lat, lon)
+    _time("one searchsorted (TrackIndex.positions)", index.positions, targets, times)
+    _time("a search per target", _positions_per_target, serials, epochs, lat, lon, targets, times, repeat=1)
+
+    print("database")
+    with tempfile.TemporaryDirectory() as folder:
+        db = CWFACDB(path=os.path.join(folder, 'benchmark.db'), create=True, profile='ingest')
+        half = df['date_epoch'] < df['date_epoch'].median()
+        _time("_load_data, first half", db._load_data, df[half].drop(columns='date_epoch'), repeat=1)
+        _time("_load_data, second half", db._load_data, df[~half].drop(columns='date_epoch'), repeat=1)
+        _time("_load_data, all again (nothing new)", db._load_data, df.drop(columns='date_epoch'), repeat=1)
+        _time("find_close_pairs, week chunks", find_close_pairs, 1.0, 1800, None, 7 * 86400,
+              db.path, repeat=1)
+    return
+
+
+if __name__ == '__main__':
+    main()
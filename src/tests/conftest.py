@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db_code.CWFAC_db import CWFACDB
+
+'''
+Shared pieces for the tests: made up tracks and a database built from them.
+Run from the src folder with
+    uv run --with pytest python -m pytest
+'''
+
+# 2024-01-01 00:00:00 UTC
+START_EPOCH = 1704067200
+
+
+def random_tracks(n_animals: int = 6,
+                  n_fixes: int = 300,
+                  seed: int = 0,
+                  spacing_s: int = 1800) -> pd.DataFrame:
+    '''
+    Random walks around the Serengeti, in the shape the scraper hands to
+    CWFACDB._load_data (dates as ISO text) plus date_epoch. Fixes are
+    spaced about spacing_s apart with some jitter, so days and gaps vary.
+    '''
+    rng = np.random.default_rng(seed)
+    parts = []
+    for a in range(n_animals):
+        gaps = rng.integers(spacing_s // 2, spacing_s * 2, n_fixes)
+        epochs = START_EPOCH + rng.integers(0, 3600) + np.cumsum(gaps)
+        lat = -2.3 + np.cumsum(rng.normal(0, 0.01, n_fixes))
+        lon = 34.8 + np.cumsum(rng.normal(0, 0.01, n_fixes))
+        parts.append(pd.DataFrame({
+            'latitude': lat,
+            'longitude': lon,
+            'date': pd.to_datetime(epochs, unit='s', utc=True).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'collarId': f'C{a:03d}',
+            'serialId': f'S{a:03d}',
+            'positionId': [f'P{a:03d}-{i}' for i in range(n_fixes)],
+            'date_epoch': epochs.astype(np.int64),
+            'species': ['wildebeest', 'zebra', 'unknown'][a % 3],
+        }))
+    return pd.concat(parts, ignore_index=True)
+
+
+@pytest.fixture
+def tracks() -> pd.DataFrame:
+    return random_tracks()
+
+
+@pytest.fixture
+def db_path(tmp_path, tracks) -> str:
+    '''
+    A new database with tracks loaded, as a path for the interact_db functions.
+    '''
+    path = os.path.join(str(tmp_path), 'test.db')
+    db = CWFACDB(path=path, create=True, profile='ingest')
+    db._load_data(tracks.drop(columns='date_epoch'))
+    return path
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from db_code.interact_db import stream_db
+
+SQL = "SELECT serialId, date_epoch FROM tObservations ORDER BY serialId, date_epoch"
+
+
+@pytest.mark.parametrize('kind', ['dataframe', 'records', 'tuples'])
+def test_iter_query_limits(db_path, tracks, kind):
+    n = len(tracks)
+    sizes = lambda **kw: [len(c) for c in stream_db(SQL, kind=kind, chunksize=500, path_string=db_path, **kw)]
+    assert sizes() == [500] * (n // 500) + ([n % 500] if n % 500 else [])
+    assert sizes(limit=1200) == [500, 500, 200]
+    assert sizes(limit=1000) == [500, 500]
+    assert sizes(limit=n + 10) == sizes()
+
+
+@pytest.mark.parametrize('kind', ['dataframe', 'records'])
+def test_iter_query_empty_chunk_has_columns(db_path, kind):
+    # limit 0 and a query matching nothing both give one empty chunk with the column names
+    for sql, limit in ((SQL, 0), (SQL.replace('ORDER', "WHERE serialId = 'none' ORDER"), None)):
+        chunks = list(stream_db(sql, kind=kind, limit=limit, path_string=db_path))
+        assert len(chunks) == 1 and len(chunks[0]) == 0
+        names = list(chunks[0].columns) if kind == 'dataframe' else list(chunks[0].dtype.names)
+        assert names == ['serialId', 'date_epoch']
+
+
+def test_iter_query_tuples_in_order(db_path, tracks):
+    rows = [row for chunk in stream_db(SQL, kind='tuples', chunksize=333, path_string=db_path) for row in chunk]
+    expected = tracks.sort_values(['serialId', 'date_epoch'])
+    assert [r[0] for r in rows] == expected['serialId'].tolist()
+    assert np.array_equal([r[1] for r in rows], expected['date_epoch'].to_numpy())
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+
+from app_functions.downsample import downsample_tracks, lttb_indices
+from db_code.tracks import group_starts
+from tests.conftest import random_tracks
+
+
+def _lttb_one(x, y, max_points):
+    # textbook LTTB over one track, a bucket at a time
+    n = len(x)
+    if n <= max_points:
+        return list(range(n))
+    every = (n - 2) / (max_points - 2)
+    kept = [0]
+    a = 0
+    for k in range(max_points - 2):
+        lo = int(np.floor(k * every)) + 1
+        hi = int(np.floor((k + 1) * every)) + 1
+        if k == max_points - 3:
+            hi = n - 1
+        if k + 1 < max_points - 2:
+            next_lo = hi
+            next_hi = n - 1 if k + 1 == max_points - 3 else int(np.floor((k + 2) * every)) + 1
+            bx, by = np.mean(x[next_lo:next_hi]), np.mean(y[next_lo:next_hi])
+        else:
+            bx, by = x[n - 1], y[n - 1]
+        best, best_area = lo, -1.0
+        for p in range(lo, hi):
+            area = abs((x[a] - bx) * (y[p] - y[a]) - (x[a] - x[p]) * (by - y[a]))
+            if area > best_area:
+                best, best_area = p, area
+        kept.append(best)
+        a = best
+    kept.append(n - 1)
+    return kept
+
+
+def test_lttb_matches_per_track_loop():
+    rng = np.random.default_rng(5)
+    # tracks shorter than, equal to and much longer than max_points
+    lengths = [3, 10, 11, 57, 400, 1000]
+    x = rng.normal(size=sum(lengths)).cumsum()
+    y = rng.normal(size=sum(lengths)).cumsum()
+    starts = np.cumsum([0] + lengths[:-1])
+    max_points = 10
+
+    expected = []
+    for s, n in zip(starts, lengths):
+        expected.extend(s + p for p in _lttb_one(x[s:s + n], y[s:s + n], max_points))
+    assert lttb_indices(x, y, starts, max_points).tolist() == expected
+
+
+def test_downsample_tracks_keeps_ends_and_order():
+    df = random_tracks(n_animals=3, n_fixes=700, seed=6).sample(frac=1, random_state=0)
+    out = downsample_tracks(df, max_points=50)
+    assert out.groupby('serialId').size().tolist() == [50, 50, 50]
+    for serial, track in df.groupby('serialId'):
+        kept = out[out['serialId'] == serial]
+        assert kept['date_epoch'].is_monotonic_increasing
+        assert kept['date_epoch'].iloc[0] == track['date_epoch'].min()
+        assert kept['date_epoch'].iloc[-1] == track['date_epoch'].max()
+
+
+def test_group_starts():
+    a = np.array([1, 1, 2, 2, 2, 3])
+    b = np.array([0, 1, 1, 1, 2, 2])
+    assert group_starts(a).tolist() == [0, 2, 5]
+    assert group_starts(a, b).tolist() == [0, 1, 2, 4, 5]
+    assert len(group_starts(np.empty(0))) == 0
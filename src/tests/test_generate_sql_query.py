@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app_functions.generate_sql_query import generate_query_and_params, to_epoch
+from db_code.interact_db import read_db
+from tests.conftest import START_EPOCH
+
+
+@pytest.mark.parametrize('value', [
+    START_EPOCH, float(START_EPOCH), np.int64(START_EPOCH), np.int32(START_EPOCH),
+    np.float64(START_EPOCH), np.uint64(START_EPOCH),
+    '2024-01-01T00:00:00', '2024-01-01T00:00:00Z', '2024-01-01T03:00:00+03:00',
+    datetime(2024, 1, 1, tzinfo=timezone.utc), datetime(2024, 1, 1),
+    datetime(2023, 12, 31, 19, tzinfo=timezone(timedelta(hours=-5))),
+    pd.Timestamp('2024-01-01', tz='UTC'),
+])
+def test_to_epoch(value):
+    assert to_epoch(value) == START_EPOCH
+    assert type(to_epoch(value)) is int
+
+
+def test_to_epoch_rejects_bool():
+    assert to_epoch(None) is None
+    with pytest.raises(TypeError):
+        to_epoch(True)
+
+
+def test_numpy_dates_filter_like_ints(db_path, tracks):
+    epochs = tracks['date_epoch']
+    lo, hi = epochs.quantile(0.25), epochs.quantile(0.5)
+    results = []
+    for datemin, datemax in ((np.int64(lo), np.int64(hi)), (int(lo), int(hi)), (np.float64(lo), np.float64(hi))):
+        sql, params, _ = generate_query_and_params(None, None, datemin, datemax, -2.5, -2.0, None, None,
+                                                   columns='map')
+        results.append(read_db(sql, params, path_string=db_path))
+    expected = tracks[(epochs >= int(lo)) & (epochs <= int(hi))
+                      & tracks['latitude'].between(-2.5, -2.0)]
+    for df in results:
+        assert len(df) == len(expected) > 0
+        assert sorted(df['date_epoch']) == sorted(expected['date_epoch'])
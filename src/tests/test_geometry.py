@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+
+from app_functions.geometry import (PreparedShape, geojson_shape, parse_shape, points_in_shape,
+                                    prepared_shape, shape_bounds, wkt_shape)
+
+
+def _ray_cast(px, py, shape):
+    # one point against one edge at a time
+    inside = False
+    for polygon in shape:
+        for ring in polygon:
+            ring = [tuple(p) for p in ring]
+            if ring[0] == ring[-1]:
+                ring = ring[:-1]
+            for k in range(len(ring)):
+                (x0, y0), (x1, y1) = ring[k], ring[(k + 1) % len(ring)]
+                if (y0 > py) != (y1 > py) and px < x0 + (py - y0) * (x1 - x0) / (y1 - y0):
+                    inside = not inside
+    return inside
+
+
+def _wobbly_ring(cx, cy, r, n, rng):
+    # a star shaped ring with n vertices, plenty of edges for the slabs
+    angles = np.sort(rng.uniform(0, 2 * np.pi, n))
+    radii = r * rng.uniform(0.5, 1.0, n)
+    return np.column_stack((cx + radii * np.cos(angles), cy + radii * np.sin(angles)))
+
+
+@pytest.fixture
+def shape():
+    rng = np.random.default_rng(7)
+    outer = _wobbly_ring(34.8, -2.3, 1.0, 300, rng)
+    hole = _wobbly_ring(34.8, -2.3, 0.3, 40, rng)
+    island = _wobbly_ring(36.5, -1.0, 0.4, 60, rng)
+    # the first polygon with a hole, a second one off to the side
+    return [[outer, hole], [island]]
+
+
+def test_prepared_shape_matches_brute_force(shape):
+    rng = np.random.default_rng(8)
+    lon = rng.uniform(33.5, 37.2, 3000)
+    lat = rng.uniform(-3.5, -0.4, 3000)
+    expected = np.array([_ray_cast(x, y, shape) for x, y in zip(lon, lat)])
+    assert expected.any() and not expected.all()
+    assert (points_in_shape(lon, lat, shape) == expected).all()
+    for slabs in (None, 1, 7, 500):
+        assert (PreparedShape(shape, slabs=slabs).contains(lon, lat) == expected).all()
+
+
+def test_hole_and_second_polygon(shape):
+    prepared = PreparedShape(shape)
+    # the centre is in the hole, the island centre is inside, far away is outside
+    got = prepared.contains(np.array([34.8, 36.5, 40.0]), np.array([-2.3, -1.0, 0.0]))
+    assert got.tolist() == [False, True, False]
+    assert len(prepared.contains(np.empty(0), np.empty(0))) == 0
+
+
+def test_wkt_and_geojson_agree():
+    wkt = 'MULTIPOLYGON (((0 0, 10 0, 10 10, 0 10, 0 0), (4 4, 6 4, 6 6, 4 6, 4 4)), ((20 0, 22 0, 21 3, 20 0)))'
+    geojson = {'type': 'Feature', 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+        [[[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]], [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]],
+        [[[20, 0], [22, 0], [21, 3], [20, 0]]],
+    ]}}
+    from_wkt = wkt_shape(wkt)
+    from_geojson = geojson_shape(geojson)
+    assert len(from_wkt) == len(from_geojson) == 2
+    for a, b in zip(from_wkt, from_geojson):
+        for ring_a, ring_b in zip(a, b):
+            assert np.array_equal(ring_a, ring_b)
+    assert shape_bounds(from_wkt) == (0.0, 0.0, 22.0, 10.0)
+
+    lon = np.array([1.0, 5.0, 21.0, 15.0])
+    lat = np.array([1.0, 5.0, 1.0, 5.0])
+    expected = [True, False, True, False]
+    assert prepared_shape(wkt).contains(lon, lat).tolist() == expected
+    assert prepared_shape(json.dumps(geojson)).contains(lon, lat).tolist() == expected
+    assert prepared_shape(geojson).contains(lon, lat).tolist() == expected
+    assert len(parse_shape('POLYGON Z ((0 0 1, 1 0 1, 1 1 1, 0 0 1))')[0][0]) == 4
+
+
+def test_bad_text():
+    with pytest.raises(ValueError):
+        wkt_shape('POINT (1 2)')
+    with pytest.raises(ValueError):
+        wkt_shape('POLYGON ((0 0, 1 0, 1 1, 0 0)')
+    with pytest.raises(ValueError):
+        geojson_shape({'type': 'LineString', 'coordinates': [[0, 0], [1, 1]]})
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+
+from app_functions.interpolation import TrackIndex, interpolate_positions
+from db_code.tracks import great_circle_interpolate
+from tests.conftest import START_EPOCH
+
+
+def _naive(tracks, serialId, t):
+    # scan the animal's fixes for the ones either side of t
+    track = tracks[tracks['serialId'] == serialId].sort_values('date_epoch')
+    epochs = track['date_epoch'].tolist()
+    before = [k for k, e in enumerate(epochs) if e <= t]
+    after = [k for k, e in enumerate(epochs) if e > t]
+    if not before or (not after and epochs[before[-1]] != t):
+        return np.nan, np.nan
+    b = before[-1]
+    if epochs[b] == t:
+        return track['latitude'].iloc[b], track['longitude'].iloc[b]
+    a = after[0]
+    fraction = (t - epochs[b]) / (epochs[a] - epochs[b])
+    lat, lon = great_circle_interpolate(track['latitude'].iloc[b], track['longitude'].iloc[b],
+                                        track['latitude'].iloc[a], track['longitude'].iloc[a], fraction)
+    return float(lat), float(lon)
+
+
+def test_positions_match_naive_search(tracks):
+    shuffled = tracks.sample(frac=1, random_state=1)
+    index = TrackIndex(shuffled['serialId'].to_numpy(), shuffled['date_epoch'].to_numpy(),
+                       shuffled['latitude'].to_numpy(), shuffled['longitude'].to_numpy())
+
+    rng = np.random.default_rng(9)
+    n = 400
+    serials = rng.choice(np.append(tracks['serialId'].unique(), 'NOPE'), n).astype(object)
+    times = rng.integers(START_EPOCH - 86400, tracks['date_epoch'].max() + 86400, n)
+    # some targets exactly on a fix
+    on_fix = tracks.sample(50, random_state=2)
+    serials[:50] = on_fix['serialId'].to_numpy()
+    times[:50] = on_fix['date_epoch'].to_numpy()
+
+    got = index.positions(serials, times)
+    for k in range(n):
+        lat, lon = _naive(tracks, serials[k], times[k])
+        assert np.isclose(got['latitude'][k], lat, equal_nan=True)
+        assert np.isclose(got['longitude'][k], lon, equal_nan=True)
+
+
+def test_great_circle_ends():
+    lat, lon = great_circle_interpolate(-2.0, 34.0, -2.5, 35.0, np.array([0.0, 1.0]))
+    assert np.allclose(lat, [-2.0, -2.5]) and np.allclose(lon, [34.0, 35.0])
+    # the same point twice stays put
+    lat, lon = great_circle_interpolate(-2.0, 34.0, -2.0, 34.0, 0.5)
+    assert np.isclose(lat, -2.0) and np.isclose(lon, 34.0)
+
+
+def test_interpolate_positions_from_db(db_path, tracks):
+    t = int(tracks['date_epoch'].median())
+    got = interpolate_positions([('S001', t), (None, t)], path_string=db_path)
+    lat, lon = _naive(tracks, 'S001', t)
+    assert np.isclose(got['latitude'][0], lat) and np.isclose(got['longitude'][0], lon)
+
+    every = got.iloc[1:]
+    for row in every.itertuples():
+        lat, lon = _naive(tracks, row.serialId, t)
+        assert np.isclose(row.latitude, lat) and np.isclose(row.longitude, lon)
+    expected = [s for s in sorted(tracks['serialId'].unique()) if not np.isnan(_naive(tracks, s, t)[0])]
+    assert every['serialId'].tolist() == expected
+    assert isinstance(got, pd.DataFrame)
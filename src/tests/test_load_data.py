@@ -0,0 +1,94 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from db_code.CWFAC_db import CWFACDB
+from tests.conftest import random_tracks
+
+
+def _new_db(tmp_path, name):
+    return CWFACDB(path=os.path.join(str(tmp_path), name), create=True, profile='ingest')
+
+
+def _read(db, sql):
+    with sqlite3.connect(db.path) as conn:
+        return pd.read_sql_query(sql, conn)
+
+
+def _derived(db):
+    # the tables kept from tObservations, keyed on (serialId, time) so two
+    # databases loaded in a different order can be compared
+    daily = _read(db, "SELECT * FROM tAnimalDaily ORDER BY serialId, day_epoch")
+    movement = _read(db, """
+        SELECT serialId, date_epoch, step_km, dt_s, speed_kmh, bearing_deg, turn_deg, day_displacement_km
+        FROM tMovement ORDER BY serialId, date_epoch""")
+    return daily, movement
+
+
+def _load(db, df):
+    return db._load_data(df.drop(columns='date_epoch'), now='2024-06-01T00:00:00+00:00')
+
+
+def test_counts_duplicates_and_species(tmp_path):
+    tracks = random_tracks(n_animals=3, n_fixes=50, seed=10)
+    db = _new_db(tmp_path, 'counts.db')
+
+    # the same fix twice in one batch, the first one wins
+    first = pd.concat([tracks.iloc[:100], tracks.iloc[[5]].assign(collarId='DUP')], ignore_index=True)
+    # S002 arrives without a species
+    first.loc[first['serialId'] == 'S002', 'species'] = None
+    counts = _load(db, first)
+    assert counts['tObservations']['inserted'] == 100
+    assert counts['tAnimal']['inserted'] == 2
+    assert _read(db, "SELECT collarId FROM tObservations WHERE positionId = 'P000-5'")['collarId'].tolist() == ['C000']
+
+    # old fixes again plus new ones, S002 now with its species
+    counts = _load(db, tracks.iloc[80:])
+    assert counts['tObservations']['inserted'] == 50
+    assert counts['tAnimal'] == {'inserted': 1, 'updated': 1}
+    species = _read(db, """
+        SELECT a.serialId, s.species_name FROM tAnimal a JOIN tSpecies s USING (species_id)
+        ORDER BY a.serialId""")
+    assert species['species_name'].tolist() == ['wildebeest', 'zebra', 'unknown']
+
+    n_obs = _read(db, "SELECT COUNT(*) AS n FROM tObservations")['n'][0]
+    assert n_obs == len(tracks)
+    # every fix is in the R*Tree once, in a box around its own position
+    # (the R*Tree keeps 32 bit floats, rounded outwards)
+    rtree = _read(db, """
+        SELECT COUNT(*) AS n,
+               SUM(o.latitude BETWEEN r.min_lat AND r.max_lat
+                   AND o.longitude BETWEEN r.min_lon AND r.max_lon) AS same
+        FROM tObservations o JOIN rtObservations r ON r.id = o.obs_id""")
+    assert rtree['n'][0] == rtree['same'][0] == n_obs
+    assert _read(db, "SELECT COUNT(*) AS n FROM rtObservations")['n'][0] == n_obs
+    assert (_read(db, "SELECT date_epoch FROM tObservations ORDER BY serialId, date")['date_epoch'].to_numpy()
+            == tracks.sort_values(['serialId', 'date'])['date_epoch'].to_numpy()).all()
+
+
+def test_incremental_loads_match_one_load(tmp_path):
+    tracks = random_tracks(n_animals=4, n_fixes=200, seed=11)
+    whole = _new_db(tmp_path, 'whole.db')
+    _load(whole, tracks)
+
+    # three batches, the last one with fixes older than ones already loaded
+    # so days and track tails in the middle get redone
+    rng = np.random.default_rng(12)
+    batch = rng.choice(3, len(tracks), p=[0.6, 0.3, 0.1])
+    batch[tracks.groupby('serialId').cumcount().to_numpy() < 20] = 0
+    parts = _new_db(tmp_path, 'parts.db')
+    for b in range(3):
+        _load(parts, tracks[batch == b])
+
+    for expected, got in zip(_derived(whole), _derived(parts)):
+        pd.testing.assert_frame_equal(expected, got)
+
+    # and both the same as rebuilding the tables from scratch
+    parts._connect(profile='ingest')
+    parts._update_daily_summary(0)
+    parts._update_movement(0)
+    parts._commit_and_close()
+    for expected, got in zip(_derived(whole), _derived(parts)):
+        pd.testing.assert_frame_equal(expected, got)
@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from db_code.CWFAC_db import CWFACDB
+from db_code.CWFAC_migrations import MIGRATIONS, register_math_functions
+
+
+def _table(path, sql):
+    with sqlite3.connect(path) as conn:
+        return pd.read_sql_query(sql, conn)
+
+
+DAILY = "SELECT * FROM tAnimalDaily ORDER BY serialId, day_epoch"
+MOVEMENT = "SELECT * FROM tMovement ORDER BY obs_id"
+
+
+@pytest.mark.parametrize('python_math', [False, True])
+def test_backfills_match_load_data(db_path, python_math):
+    # _load_data fills both tables with the NumPy code
+    expected = [_table(db_path, DAILY), _table(db_path, MOVEMENT)]
+
+    db = CWFACDB(path=db_path, profile='ingest')
+    db._connect(profile='ingest')
+    db.run_action("DROP TABLE tAnimalDaily;", keep_open=True)
+    db.run_action("DROP TABLE tMovement;", keep_open=True)
+    if python_math:
+        # what a sqlite built without math functions ends up running
+        register_math_functions(db._conn)
+    for version, _, steps in MIGRATIONS:
+        if version in (5, 7):
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.run_action(step, keep_open=True)
+    db._commit_and_close()
+
+    for want, sql in zip(expected, (DAILY, MOVEMENT)):
+        got = _table(db_path, sql)
+        assert list(got.columns) == list(want.columns)
+        assert len(got) == len(want)
+        for name in want.columns:
+            if not pd.api.types.is_numeric_dtype(want[name]):
+                assert (got[name] == want[name]).all()
+            else:
+                assert np.allclose(got[name].astype(float), want[name].astype(float),
+                                   rtol=1e-9, atol=1e-9, equal_nan=True), name
+
+
+def test_open_does_not_wait_for_a_writer(db_path):
+    # another connection in the middle of a write, as during a scrape
+    writer = sqlite3.connect(db_path)
+    writer.execute("BEGIN IMMEDIATE;")
+    try:
+        start = time.perf_counter()
+        opened = []
+        thread = threading.Thread(target=lambda: opened.append(CWFACDB(path=db_path)), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+        assert opened, "opening the database waited for the write lock"
+        assert time.perf_counter() - start < 5
+        assert opened[0].schema_version() == max(m[0] for m in MIGRATIONS)
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+class _BeforeObsId(CWFACDB):
+    # the schema as it was up to migration 8, tObservations keyed on its rowid
+    MIGRATIONS = [m for m in MIGRATIONS if m[0] <= 8]
+
+
+def test_obs_id_migration_keeps_ids(tmp_path, tracks):
+    path = str(tmp_path / 'old.db')
+    _BeforeObsId(path=path, create=True, profile='ingest')
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO tSpecies (species_name) VALUES ('zebra')")
+        conn.executemany("INSERT INTO tAnimal (serialId, species_id) VALUES (?, 1)",
+                         [(s,) for s in tracks['serialId'].unique()])
+        conn.executemany("""
+            INSERT INTO tObservations (serialId, date, collarId, latitude, longitude, positionId, date_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            tracks[['serialId', 'date', 'collarId', 'latitude', 'longitude', 'positionId', 'date_epoch']]
+            .itertuples(index=False, name=None))
+        # gaps in the rowids, the kind a VACUUM would close up
+        conn.execute("DELETE FROM tObservations WHERE rowid % 7 = 0")
+        conn.execute("""
+            INSERT INTO rtObservations (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT rowid, latitude, latitude, longitude, longitude FROM tObservations""")
+    before = _table(path, "SELECT rowid AS id, serialId, date FROM tObservations ORDER BY rowid")
+
+    db = CWFACDB(path=path)
+    assert db.schema_version() == max(m[0] for m in MIGRATIONS)
+    after = _table(path, "SELECT obs_id AS id, serialId, date FROM tObservations ORDER BY obs_id")
+    pd.testing.assert_frame_equal(before, after)
+    indexes = set(_table(path, "SELECT name FROM sqlite_master WHERE type = 'index'")['name'])
+    assert {'idx_tObservations_map_epoch', 'idx_tObservations_time',
+            'idx_tMovement_serial_epoch', 'idx_tMovement_speed'} <= indexes
+    # tMovement rebuilt on the same ids
+    movement = _table(path, """
+        SELECT COUNT(*) AS n, SUM(m.serialId = o.serialId AND m.date_epoch = o.date_epoch) AS same
+        FROM tMovement m JOIN tObservations o ON o.obs_id = m.obs_id""")
+    assert movement['n'][0] == movement['same'][0] == len(before)
+
+    # the R*Tree follows obs_id, and obs_id survives a VACUUM
+    with sqlite3.connect(path) as conn:
+        conn.execute("VACUUM")
+    rtree = _table(path, "SELECT id FROM rtObservations ORDER BY id")['id']
+    assert rtree.tolist() == before['id'].tolist()
+    pd.testing.assert_frame_equal(before, _table(path, "SELECT obs_id AS id, serialId, date FROM tObservations ORDER BY obs_id"))
+
+    # loading again only adds what is missing, with new ids after the old ones
+    db = CWFACDB(path=path, profile='ingest')
+    counts = db._load_data(tracks.drop(columns='date_epoch'))
+    assert counts['tObservations']['inserted'] == len(tracks) - len(before)
+    ids = _table(path, "SELECT obs_id FROM tObservations ORDER BY obs_id")['obs_id']
+    assert ids.is_unique and ids.iloc[len(before):].min() > before['id'].max()
+    assert _table(path, "SELECT COUNT(*) AS n FROM rtObservations")['n'][0] == len(tracks)
@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+from app_functions.proximity import PAIR_COLUMNS, close_pairs, find_close_pairs
+from db_code.tracks import haversine_km
+from tests.conftest import random_tracks
+
+
+def _brute_force(serials, epochs, lat, lon, distance_km, window_s):
+    # every pair of fixes, smaller position first
+    i, j = np.triu_indices(len(epochs), k=1)
+    close = ((serials[i] != serials[j])
+             & (np.abs(epochs[i] - epochs[j]) <= window_s)
+             & (haversine_km(lat[i], lon[i], lat[j], lon[j]) <= distance_km))
+    return set(zip(i[close].tolist(), j[close].tolist()))
+
+
+def _as_set(i, j):
+    pairs = [tuple(sorted(p)) for p in zip(i.tolist(), j.tolist())]
+    # each pair only once
+    assert len(pairs) == len(set(pairs))
+    return set(pairs)
+
+
+def _check(df, distance_km, window_s):
+    serials = df['serialId'].to_numpy()
+    epochs = df['date_epoch'].to_numpy()
+    lat = df['latitude'].to_numpy()
+    lon = df['longitude'].to_numpy()
+    expected = _brute_force(serials, epochs, lat, lon, distance_km, window_s)
+    got = _as_set(*close_pairs(serials, epochs, lat, lon, distance_km, window_s))
+    assert got == expected
+    return expected
+
+
+def test_scattered_tracks():
+    df = random_tracks(n_animals=8, n_fixes=200, seed=2)
+    assert _check(df, 2.0, 3600)
+
+
+def test_dense_herd():
+    # every animal within a few hundred metres, most pairs are close
+    rng = np.random.default_rng(3)
+    n = 1500
+    df = pd.DataFrame({
+        'serialId': rng.integers(0, 20, n),
+        'date_epoch': rng.integers(0, 6 * 3600, n),
+        'latitude': -2.3 + rng.normal(0, 0.002, n),
+        'longitude': 34.8 + rng.normal(0, 0.002, n),
+    })
+    assert len(_check(df, 0.3, 900)) > 1000
+
+
+def test_high_latitude_and_cell_edges():
+    # longitude cells get wide near the pole, and fixes sitting on cell
+    # boundaries (distance and time exactly on the limit) still count
+    rng = np.random.default_rng(4)
+    n = 800
+    df = pd.DataFrame({
+        'serialId': rng.integers(0, 5, n),
+        'date_epoch': rng.integers(0, 20, n) * 600,
+        'latitude': 80 + rng.uniform(0, 0.2, n),
+        'longitude': rng.uniform(-1, 1, n),
+    })
+    _check(df, 1.5, 1200)
+
+
+def test_find_close_pairs_matches_brute_force(db_path, tracks):
+    # small chunks so plenty of pairs straddle a chunk boundary
+    distance_km, window_s = 3.0, 2 * 3600
+    pairs = find_close_pairs(distance_km, window_s, chunk_s=86400, path_string=db_path)
+    assert list(pairs.columns) == PAIR_COLUMNS
+
+    serials = tracks['serialId'].to_numpy()
+    epochs = tracks['date_epoch'].to_numpy()
+    lat = tracks['latitude'].to_numpy()
+    lon = tracks['longitude'].to_numpy()
+    expected = {tuple(sorted([(serials[a], epochs[a]), (serials[b], epochs[b])]))
+                for a, b in _brute_force(serials, epochs, lat, lon, distance_km, window_s)}
+    got = [tuple(sorted([(row.serialId_a, row.date_epoch_a), (row.serialId_b, row.date_epoch_b)]))
+           for row in pairs.itertuples()]
+    assert expected
+    assert len(got) == len(set(got))
+    assert set(got) == expected
+    assert (pairs['serialId_a'] < pairs['serialId_b']).all()
+    earlier = np.minimum(pairs['date_epoch_a'], pairs['date_epoch_b'])
+    assert (np.diff(earlier) >= 0).all()
+
+
+def test_no_candidates():
+    # two fixes far apart in space and time, no cell has a neighbour to check
+    i, j = close_pairs(np.array([1, 2]), np.array([0, 10 * 86400]), np.array([-2.0, 1.0]),
+                       np.array([34.0, 36.0]), 0.01, 10)
+    assert i.dtype == j.dtype == np.int64
+    assert len(i) == len(j) == 0
+
+
+def test_find_close_pairs_none_found(db_path):
+    pairs = find_close_pairs(0.01, 10, {}, chunk_s=86400, path_string=db_path)
+    assert pairs.empty
+    assert list(pairs.columns) == PAIR_COLUMNS
@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+
+from db_code.tracks import SECONDS_PER_DAY, daily_summary, haversine_km, movement_metrics
+from tests.conftest import random_tracks
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    # one pair at a time with the math module
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((p2 - p1) / 2) ** 2
+         + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
+
+def _bearing(lat1, lon1, lat2, lon2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dlon = math.radians(lon2 - lon1)
+    y = math.sin(dlon) * math.cos(p2)
+    x = math.cos(p1) * math.sin(p2) - math.sin(p1) * math.cos(p2) * math.cos(dlon)
+    return math.degrees(math.atan2(y, x)) % 360.0
+
+
+def _sorted_arrays(seed=0):
+    df = random_tracks(n_animals=4, n_fixes=150, seed=seed, spacing_s=5000)
+    df = df.sort_values(['serialId', 'date_epoch'], kind='stable')
+    return (df['serialId'].to_numpy(), df['date_epoch'].to_numpy().copy(),
+            df['latitude'].to_numpy().copy(), df['longitude'].to_numpy().copy())
+
+
+def test_haversine_known_distance():
+    # a degree of latitude along a meridian
+    assert np.isclose(haversine_km(0, 0, 1, 0), 111.195, atol=1e-3)
+    assert haversine_km(-2.3, 34.8, -2.3, 34.8) == 0
+
+
+def test_daily_summary_matches_loop():
+    serials, epochs, lat, lon = _sorted_arrays()
+    got = daily_summary(serials, epochs, lat, lon)
+
+    expected = {}
+    for i in range(len(epochs)):
+        key = (serials[i], epochs[i] - epochs[i] % SECONDS_PER_DAY)
+        row = expected.setdefault(key, {'lat': [], 'lon': [], 'epochs': [], 'distance_km': 0.0})
+        if row['lat']:
+            row['distance_km'] += _haversine(row['lat'][-1], row['lon'][-1], lat[i], lon[i])
+        row['lat'].append(lat[i])
+        row['lon'].append(lon[i])
+        row['epochs'].append(epochs[i])
+
+    assert len(got['serial']) == len(expected)
+    for k, key in enumerate(zip(got['serial'], got['day_epoch'])):
+        row = expected[key]
+        assert got['n_fixes'][k] == len(row['lat'])
+        assert np.isclose(got['lat_mean'][k], np.mean(row['lat']))
+        assert np.isclose(got['lon_mean'][k], np.mean(row['lon']))
+        assert got['lat_min'][k] == min(row['lat']) and got['lat_max'][k] == max(row['lat'])
+        assert got['lon_min'][k] == min(row['lon']) and got['lon_max'][k] == max(row['lon'])
+        assert got['first_epoch'][k] == row['epochs'][0] and got['last_epoch'][k] == row['epochs'][-1]
+        assert np.isclose(got['distance_km'][k], row['distance_km'])
+
+
+def test_movement_metrics_matches_loop():
+    serials, epochs, lat, lon = _sorted_arrays(seed=1)
+    # an animal standing still for a step and two fixes at the same time
+    lat[10], lon[10] = lat[9], lon[9]
+    epochs[20] = epochs[19]
+    got = movement_metrics(serials, epochs, lat, lon)
+
+    day_first = {}
+    for i in range(len(epochs)):
+        day = (serials[i], epochs[i] - epochs[i] % SECONDS_PER_DAY)
+        first = day_first.setdefault(day, i)
+        assert np.isclose(got['day_displacement_km'][i], _haversine(lat[first], lon[first], lat[i], lon[i]))
+
+        if i == 0 or serials[i - 1] != serials[i]:
+            for name in ('step_km', 'dt_s', 'speed_kmh', 'bearing_deg', 'turn_deg'):
+                assert np.isnan(got[name][i])
+            continue
+        step = _haversine(lat[i - 1], lon[i - 1], lat[i], lon[i])
+        dt = epochs[i] - epochs[i - 1]
+        assert np.isclose(got['step_km'][i], step)
+        assert got['dt_s'][i] == dt
+        if dt > 0:
+            assert np.isclose(got['speed_kmh'][i], step / (dt / 3600))
+        else:
+            assert np.isnan(got['speed_kmh'][i])
+        if step == 0:
+            assert np.isnan(got['bearing_deg'][i])
+        else:
+            assert np.isclose(got['bearing_deg'][i], _bearing(lat[i - 1], lon[i - 1], lat[i], lon[i]))
+
+        before = got['bearing_deg'][i - 1]
+        if np.isnan(before) or np.isnan(got['bearing_deg'][i]):
+            assert np.isnan(got['turn_deg'][i])
+        else:
+            turn = (got['bearing_deg'][i] - before + 180) % 360 - 180
+            assert np.isclose(got['turn_deg'][i], turn)
+            assert -180 <= got['turn_deg'][i] < 180
@@ -0,0 +1,144 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from bs4 import BeautifulSoup
+from selenium.common.exceptions import WebDriverException
+
+from app_functions.scrape_jobs import ScrapeCancelled
+from app_functions.webscraping import iter_species, resolve_species
+
+'''
+iter_species / resolve_species against track pages served by http.server.
+There is no browser here, so make_driver hands out PageDriver, which fetches
+the page with requests and offers the bits of the webdriver API that
+read_species uses.
+'''
+
+SPECIES = {f'S{k:03d}': ['wildebeest', 'zebra', 'Thomson gazelle'][k % 3] for k in range(30)}
+
+# pages that fail a couple of times before they work, and ones that never do
+FLAKY = {'S004': 2, 'S011': 1}
+MISSING = {'S007', 'S023'}
+
+PAGE = '''<html><body>
+<div class="header">SERENGETI TRACKER</div>
+<div class="details">SERIAL {serial} SPECIES {species}
+LAST TRACKED 2024-01-01</div>
+</body></html>'''
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        serial = self.path.rstrip('/').rsplit('/', 1)[-1]
+        with self.server.lock:
+            self.server.hits[serial] = self.server.hits.get(serial, 0) + 1
+            hits = self.server.hits[serial]
+        if serial in MISSING or serial not in SPECIES:
+            self.send_error(404)
+            return
+        if hits <= FLAKY.get(serial, 0):
+            self.send_error(503)
+            return
+        body = PAGE.format(serial=serial, species=SPECIES[serial]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Element:
+
+    def __init__(self, text):
+        self.text = text
+
+
+class PageDriver:
+    '''
+    Just enough of a webdriver for read_species: get, find_elements by class
+    name, quit. HTTP errors come out as WebDriverException like a browser
+    failing to load the page.
+    '''
+
+    opened = []
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.soup = None
+        self.closed = False
+        PageDriver.opened.append(self)
+
+    def get(self, url):
+        response = self.session.get(url, timeout=5)
+        if response.status_code >= 400:
+            raise WebDriverException(f'{response.status_code} for {url}')
+        self.soup = BeautifulSoup(response.text, 'html.parser')
+
+    def find_elements(self, by, value):
+        return [_Element(e.get_text(' ')) for e in self.soup.find_all(class_=value)]
+
+    def quit(self):
+        self.closed = True
+        self.session.close()
+
+
+@pytest.fixture
+def track_pages():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.hits = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    PageDriver.opened = []
+    yield server, f'http://127.0.0.1:{server.server_address[1]}/track/'
+    server.shutdown()
+    server.server_close()
+
+
+def _resolve(url, workers, **kw):
+    return resolve_species(list(SPECIES), url, workers=workers, page_timeout=1, retries=2,
+                           backoff=0.0, make_driver=PageDriver, **kw)
+
+
+def test_pool_matches_sequential(track_pages):
+    server, url = track_pages
+    sequential = _resolve(url, workers=1)
+    server.hits.clear()
+    pooled = _resolve(url, workers=6)
+
+    expected = [('unknown' if s in MISSING else SPECIES[s]) for s in SPECIES]
+    assert sequential['serialId'].tolist() == pooled['serialId'].tolist() == list(SPECIES)
+    assert sequential['species'].tolist() == pooled['species'].tolist() == expected
+    # flaky pages were retried until they worked, missing ones given up after the retries
+    assert server.hits['S004'] == 3 and server.hits['S011'] == 2
+    assert server.hits['S007'] == 3
+    # every browser is closed at the end, including ones replaced after an error
+    assert all(driver.closed for driver in PageDriver.opened)
+
+
+def test_iter_species_progress_and_order(track_pages):
+    _, url = track_pages
+    counts = []
+    found = list(iter_species(list(SPECIES), url, workers=4, page_timeout=1, retries=2, backoff=0.0,
+                              progress=lambda **c: counts.append(c['serials_resolved']),
+                              make_driver=PageDriver))
+    assert sorted(found) == sorted((s, 'unknown' if s in MISSING else SPECIES[s]) for s in SPECIES)
+    assert sorted(counts) == list(range(1, len(SPECIES) + 1))
+
+
+def test_cancel(track_pages):
+    _, url = track_pages
+    stop = threading.Event()
+    seen = []
+    with pytest.raises(ScrapeCancelled):
+        resolve_species(list(SPECIES), url, workers=2, page_timeout=1, retries=0, backoff=0.0,
+                        progress=lambda **c: (seen.append(c), c['serials_resolved'] >= 5 and stop.set()),
+                        should_stop=stop.is_set, make_driver=PageDriver)
+    assert len(seen) < len(SPECIES)
+    assert all(driver.closed for driver in PageDriver.opened)